@@ -7,12 +7,14 @@ from urllib.parse import urlparse
 import git
 import chromadb
 from sentence_transformers import SentenceTransformer
-import ollama
 import PyPDF2
 import numpy as np
 from typing import List, Dict
-import httpx
 import logging
+from index_registry import IndexRegistry
+from chunkers import chunk_file
+from token_budget import TokenCounter, fit_chunks_to_budget
+from llm_scheduler import get_llm_scheduler
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,7 +26,10 @@ CORS(app)
 # Initialize global variables
 try:
     encoder = SentenceTransformer('all-MiniLM-L6-v2')
+    token_counter = TokenCounter.for_encoder(encoder)
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    # Registering each chat's collection lets the RAG app's janitor expire idle ones
+    collection_registry = IndexRegistry("./chroma_db/index_registry.db")
     logger.info("Successfully initialized encoder and ChromaDB client")
 except Exception as e:
     logger.error(f"Error initializing components: {str(e)}")
@@ -34,6 +39,7 @@ except Exception as e:
 active_collections = {}
 
 OLLAMA_URL = 'https://c672-35-240-236-97.ngrok-free.app/'
+llm_client = get_llm_scheduler(OLLAMA_URL)
 
 def is_code_file(file_path: str) -> bool:
     """Check if the file is a relevant code file."""
@@ -74,6 +80,7 @@ def get_collection_for_chat(chat_id: str) -> chromadb.Collection:
         
         try:
             collection = chroma_client.get_or_create_collection(name=collection_name)
+            collection_registry.touch_collection(collection_name)
             logger.info(f"Retrieved or created collection: {collection_name}")
             return collection
         except Exception as e:
@@ -147,55 +154,8 @@ def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, chunk_si
         raise
 
 def create_chunks(content: str, file_path: str, chunk_size: int = 1500) -> List[Dict[str, str]]:
-    """Create chunks from content with smart splitting and metadata."""
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    
-    # Split content into lines for better context preservation
-    lines = content.split('\n')
-    
-    for line in lines:
-        # Start new chunk if adding this line would exceed chunk size
-        if current_length + len(line) > chunk_size and current_chunk:
-            chunk_text = '\n'.join(current_chunk)
-            chunks.append({
-                'content': chunk_text,
-                'file_path': file_path,
-                'start_line': len(chunks) * len(current_chunk) + 1,
-                'end_line': (len(chunks) + 1) * len(current_chunk)
-            })
-            current_chunk = []
-            current_length = 0
-        
-        # Add line to current chunk
-        current_chunk.append(line)
-        current_length += len(line) + 1  # +1 for newline
-        
-        # Check if we should create a new chunk based on code structure
-        if any(marker in line for marker in ['class ', 'def ', 'function ', '@app.route', 'public class']):
-            if current_chunk:
-                chunk_text = '\n'.join(current_chunk)
-                chunks.append({
-                    'content': chunk_text,
-                    'file_path': file_path,
-                    'start_line': len(chunks) * len(current_chunk) + 1,
-                    'end_line': (len(chunks) + 1) * len(current_chunk)
-                })
-                current_chunk = []
-                current_length = 0
-    
-    # Add any remaining content as the last chunk
-    if current_chunk:
-        chunk_text = '\n'.join(current_chunk)
-        chunks.append({
-            'content': chunk_text,
-            'file_path': file_path,
-            'start_line': len(chunks) * len(current_chunk) + 1,
-            'end_line': (len(chunks) + 1) * len(current_chunk)
-        })
-    
-    return chunks
+    """Create chunks from content with structure-aware splitting and exact line spans."""
+    return fit_chunks_to_budget(chunk_file(content, file_path, chunk_size), token_counter)
 
 def add_chunks_to_vector_db(collection: chromadb.Collection, chunks: List[Dict[str, str]], chat_id: str, file_path: str):
     """Add chunks to the vector database with metadata."""
@@ -215,7 +175,8 @@ def add_chunks_to_vector_db(collection: chromadb.Collection, chunks: List[Dict[s
                 "file_path": file_path,
                 "start_line": chunk['start_line'],
                 "end_line": chunk['end_line'],
-                "chunk_index": i
+                "chunk_index": i,
+                "token_count": chunk['token_count']
             }
             metadatas.append(metadata)
 
@@ -283,9 +244,7 @@ def generate_response(chat_id: str, conversation_history: str, query: str) -> st
             "content": query
         })
 
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            response = ollama_client.chat(model='llama3.2:3b', messages=messages)
+        response = llm_client.chat(model='llama3.2:3b', messages=messages)
         logger.info("Generated response from RAG pipeline")
         return response['message']['content']
 
@@ -6,10 +6,10 @@ from urllib.parse import urlparse
 import git
 import chromadb
 from sentence_transformers import SentenceTransformer
-import ollama
 import logging
+from index_registry import IndexRegistry
 import re
-import httpx
+from llm_scheduler import get_llm_scheduler
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,6 +22,8 @@ CORS(app)
 try:
     encoder = SentenceTransformer('all-MiniLM-L6-v2')
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    # Registering each chat's collection lets the RAG app's janitor expire idle ones
+    collection_registry = IndexRegistry("./chroma_db/index_registry.db")
     logger.info("Successfully initialized encoder and ChromaDB client")
 except Exception as e:
     logger.error(f"Error initializing components: {str(e)}")
@@ -32,6 +34,7 @@ active_collections = {}
 active_file_contexts = {}
 
 OLLAMA_URL = 'https://9f9d-104-155-219-93.ngrok-free.app/'
+llm_client = get_llm_scheduler(OLLAMA_URL)
 
 def set_active_file(chat_id: str, filename: str) -> None:
     """Set the active file context for a specific chat."""
@@ -90,6 +93,7 @@ def get_collection_for_chat(chat_id: str) -> chromadb.Collection:
     try:
         collection_name = f"chat_{chat_id}"
         collection = chroma_client.get_or_create_collection(name=collection_name)
+        collection_registry.touch_collection(collection_name)
         logger.info(f"Retrieved or created collection: {collection_name}")
         return collection
     except Exception as e:
@@ -271,9 +275,7 @@ def generate_response(chat_id: str, conversation_history: str, query: str) -> st
 
         messages.append({"role": "user", "content": actual_query})
 
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            response = ollama_client.chat(model='deepseek-coder-v2:latest', messages=messages)
+        response = llm_client.chat(model='deepseek-coder-v2:latest', messages=messages)
         
         logger.info("Generated response from RAG pipeline")
         return response['message']['content']
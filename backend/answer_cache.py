@@ -0,0 +1,180 @@
+import os
+import time
+import hashlib
+import itertools
+import threading
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from single_flight import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Cosine similarity above which a cached answer is served for a differently worded question
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0.92))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', 6 * 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 2000))
+
+
+def answer_scope(index_version: str, model: str, history: str = '') -> str:
+    """Cache partition for one index version, model and conversation history.
+
+    Answers are only reused within a scope, so reloading a repository at a
+    new commit (a new index version) or switching models never serves a
+    stale answer, and follow-up questions only match under the same history.
+    Stand-alone questions (empty history) are shared by every chat on the
+    same index.
+    """
+    history_digest = hashlib.sha1(' '.join(history.split()).encode('utf-8')).hexdigest()
+    return f"{index_version}\0{model}\0{history_digest}"
+
+
+class _Entry:
+    __slots__ = ('scope', 'query', 'vector', 'answer', 'metadata', 'created_at', 'hits')
+
+    def __init__(self, scope: str, query: str, vector: Optional[np.ndarray], answer: str, metadata: Dict[str, any]):
+        self.scope = scope
+        self.query = query
+        self.vector = vector
+        self.answer = answer
+        self.metadata = metadata
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class AnswerCache:
+    """LRU cache of generated answers, matched by query embedding similarity.
+
+    A lookup first tries the normalized query text, then the most similar
+    cached question in the same scope whose cosine similarity reaches
+    ``similarity_threshold``. Without an ``embed`` function only exact
+    matches hit. Entries expire after ``ttl_seconds`` and the least recently
+    used go first once ``max_entries`` is reached.
+    """
+
+    def __init__(self, embed: Optional[Callable[[List[str]], np.ndarray]] = None,
+                 similarity_threshold: float = ANSWER_CACHE_SIMILARITY,
+                 ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[int, _Entry]' = OrderedDict()
+        self._scopes: Dict[str, List[int]] = {}
+        self._ids = itertools.count()
+        self._stats = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0, 'bypassed': 0,
+                       'stores': 0, 'evicted': 0, 'expired': 0}
+
+    def _vector(self, query: str) -> Optional[np.ndarray]:
+        if self.embed is None:
+            return None
+        try:
+            vector = np.asarray(self.embed([query]), dtype=np.float32)[0]
+            return vector / max(float(np.linalg.norm(vector)), 1e-12)
+        except Exception as e:
+            logger.warning(f"Answer cache falls back to exact matching: {str(e)}")
+            return None
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        ids = self._scopes.get(entry.scope)
+        if ids is not None:
+            ids.remove(entry_id)
+            if not ids:
+                del self._scopes[entry.scope]
+
+    def _live_ids(self, scope: str, now: float) -> List[int]:
+        """Entry ids of a scope, dropping expired ones on the way; caller holds the lock."""
+        live = []
+        for entry_id in list(self._scopes.get(scope, [])):
+            if now - self._entries[entry_id].created_at > self.ttl_seconds:
+                self._remove(entry_id)
+                self._stats['expired'] += 1
+            else:
+                live.append(entry_id)
+        return live
+
+    def lookup(self, scope: str, query: str) -> Optional[Dict[str, any]]:
+        """The cached answer for ``query`` in ``scope``, or None on a miss."""
+        normalized = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            live = self._live_ids(scope, now)
+            for entry_id in live:
+                if self._entries[entry_id].query == normalized:
+                    self._stats['exact_hits'] += 1
+                    return self._hit(entry_id, 1.0, now)
+            candidates = [entry_id for entry_id in live if self._entries[entry_id].vector is not None]
+
+        vector = self._vector(normalized) if candidates else None
+        if vector is None:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            candidates = [entry_id for entry_id in candidates if entry_id in self._entries]
+            if candidates:
+                similarities = np.stack([self._entries[entry_id].vector for entry_id in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self._stats['semantic_hits'] += 1
+                    return self._hit(candidates[best], float(similarities[best]), now)
+            self._stats['misses'] += 1
+            return None
+
+    def _hit(self, entry_id: int, similarity: float, now: float) -> Dict[str, any]:
+        entry = self._entries[entry_id]
+        entry.hits += 1
+        self._entries.move_to_end(entry_id)
+        return {
+            'answer': entry.answer,
+            'metadata': dict(entry.metadata),
+            'similarity': round(similarity, 4),
+            'age_seconds': round(now - entry.created_at, 1)
+        }
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats['bypassed'] += 1
+
+    def store(self, scope: str, query: str, answer: str, metadata: Optional[Dict[str, any]] = None):
+        """Cache a complete answer; replaces an earlier answer to the same question."""
+        if not answer or not answer.strip():
+            return
+        normalized = normalize_query(query)
+        vector = self._vector(normalized)
+        with self._lock:
+            for entry_id in list(self._scopes.get(scope, [])):
+                if self._entries[entry_id].query == normalized:
+                    self._remove(entry_id)
+            entry_id = next(self._ids)
+            self._entries[entry_id] = _Entry(scope, normalized, vector, answer, metadata or {})
+            self._scopes.setdefault(scope, []).append(entry_id)
+            self._stats['stores'] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats['evicted'] += 1
+
+    def invalidate(self, index_version: str) -> int:
+        """Drop every entry of an index version; returns how many were removed."""
+        prefix = f"{index_version}\0"
+        with self._lock:
+            doomed = [entry_id for entry_id, entry in self._entries.items() if entry.scope.startswith(prefix)]
+            for entry_id in doomed:
+                self._remove(entry_id)
+        return len(doomed)
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['scopes'] = len(self._scopes)
+        lookups = stats['exact_hits'] + stats['semantic_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['exact_hits'] + stats['semantic_hits']) / lookups, 4) if lookups else None
+        stats['similarity_threshold'] = self.similarity_threshold
+        return stats
@@ -7,12 +7,12 @@ from urllib.parse import urlparse
 import git
 import chromadb
 from sentence_transformers import SentenceTransformer
-import ollama
 import PyPDF2
 import numpy as np
 from typing import List, Dict
-import httpx
 import logging
+from index_registry import IndexRegistry
+from llm_scheduler import get_llm_scheduler
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,6 +25,8 @@ CORS(app)
 try:
     encoder = SentenceTransformer('all-MiniLM-L6-v2')
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    # Registering each chat's collection lets the RAG app's janitor expire idle ones
+    collection_registry = IndexRegistry("./chroma_db/index_registry.db")
     logger.info("Successfully initialized encoder and ChromaDB client")
 except Exception as e:
     logger.error(f"Error initializing components: {str(e)}")
@@ -34,6 +36,7 @@ except Exception as e:
 active_collections = {}
 
 OLLAMA_URL = 'https://5884-35-240-234-23.ngrok-free.app/'
+llm_client = get_llm_scheduler(OLLAMA_URL)
 
 def is_code_file(file_path: str) -> bool:
     """Check if the file is a relevant code file."""
@@ -75,6 +78,7 @@ def get_collection_for_chat(chat_id: str) -> chromadb.Collection:
         # Try to get existing collection
         try:
             collection = chroma_client.get_or_create_collection(name=collection_name)
+            collection_registry.touch_collection(collection_name)
             logger.info(f"Retrieved or created collection: {collection_name}")
             return collection
         except Exception as e:
@@ -288,9 +292,7 @@ def generate_response(chat_id: str, conversation_history: str, query: str) -> st
             "content": query
         })
 
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            response = ollama_client.chat(model='llama3.2:3b', messages=messages)
+        response = llm_client.chat(model='llama3.2:3b', messages=messages)
         
         return response['message']['content']
 
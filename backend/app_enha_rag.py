@@ -3,16 +3,35 @@ from flask_cors import CORS
 import os
 import tempfile
 import shutil
+import time
+import hmac
 from urllib.parse import urlparse
 import git
 import chromadb
 from sentence_transformers import SentenceTransformer
-import ollama
 import PyPDF2
 import numpy as np
-from typing import List, Dict, Tuple
-import httpx
+from typing import List, Dict, Tuple, Optional, Iterator
+from collections import Counter
+import threading
 import logging
+from file_metadata import FileMetadataStore, make_file_id
+from index_registry import IndexRegistry, normalize_repo_url, make_index_id, resolve_commit_sha
+from chunkers import chunk_file, iter_large_file_chunks, read_text_sample
+from token_budget import TokenCounter, fit_chunks_to_budget
+from file_filters import classify_file, strip_license_header, IngestStats
+from dedup import NearDuplicateIndex
+from janitor import Janitor
+from streaming import sse_response, stream_chat_events, cached_answer_events, with_answer, join_stream, PrefetchedStream
+from retrieval_policy import should_refine, distance_to_similarity, REFINE_MIN_GAIN
+from answer_cache import AnswerCache, answer_scope
+from chat_sessions import ChatSessions, llm_summarizer, parse_history, history_text
+from cancellation import CancelToken, ChatCancellations, RequestCancelled
+from deadlines import Deadline, DEGRADE_FEWER_RESULTS, DEGRADE_SKIPPED_REFINEMENT
+from single_flight import SingleFlight, flight_key
+from llm_scheduler import get_llm_scheduler, llm_stats, SchedulerBusy, PRIORITY_REFINE
+from prompt_layout import build_messages
+from model_routes import load_model_routes, TASK_ANSWER, TASK_REFINE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,10 +40,26 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+# Part of every shared index key; bump when chunking or embedding changes
+INDEX_VERSION = f"chunker-v1:{EMBEDDING_MODEL}:cosine"
+# Retrieval thresholds are cosine similarities, so indexes are built in cosine space
+COLLECTION_METADATA = {'hnsw:space': 'cosine'}
+
 # Initialize global variables
 try:
-    encoder = SentenceTransformer('all-MiniLM-L6-v2')
+    encoder = SentenceTransformer(EMBEDDING_MODEL)
+    token_counter = TokenCounter.for_encoder(encoder)
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    file_store = FileMetadataStore("./chroma_db/file_metadata.db")
+    index_registry = IndexRegistry("./chroma_db/index_registry.db")
+    janitor = Janitor(
+        index_registry, chroma_client, file_store, persist_dir="./chroma_db",
+        disk_quota_bytes=int(os.environ.get('CHROMA_DISK_QUOTA_MB', 2048)) * 1024 * 1024,
+        chat_ttl_seconds=int(os.environ.get('CHAT_TTL_DAYS', 14)) * 24 * 3600,
+        interval_seconds=int(os.environ.get('JANITOR_INTERVAL_SECONDS', 600)),
+        index_grace_seconds=int(os.environ.get('INDEX_GRACE_SECONDS', 3600))
+    )
     logger.info("Successfully initialized encoder and ChromaDB client")
 except Exception as e:
     logger.error(f"Error initializing components: {str(e)}")
@@ -34,6 +69,48 @@ except Exception as e:
 active_collections = {}
 
 OLLAMA_URL = 'https://2323-34-90-181-140.ngrok-free.app/'
+llm_client = get_llm_scheduler(OLLAMA_URL)
+chat_flights = SingleFlight()
+chat_cancellations = ChatCancellations()
+answer_cache = AnswerCache(lambda texts: encoder.encode(texts, show_progress_bar=False))
+# Refinement only needs one short line, so it gets a tight output cap; deployments can re-route each task
+model_routes = load_model_routes({
+    TASK_ANSWER: {'model': 'llama3.2:3b'},
+    TASK_REFINE: {'model': 'llama3.2:3b', 'max_tokens': 64},
+}, serves=llm_client.pool.serves)
+CHAT_MODEL = model_routes.model(TASK_ANSWER)
+# Older turns are summarized in the background by the summarize route's model
+chat_sessions = ChatSessions(llm_summarizer(llm_client, model_routes))
+
+# Chunks retrieved per question; a request short on time retrieves fewer and skips refinement
+RETRIEVAL_RESULTS = 3
+REDUCED_RETRIEVAL_RESULTS = 2
+FULL_RETRIEVAL_MIN_SECONDS = 15
+REFINE_MIN_SECONDS = 20
+
+# How often refinement was skipped, run with the speculative answer kept, or run and used
+refinement_outcomes = Counter()
+refinement_lock = threading.Lock()
+
+# Near-duplicate suppression at ingest (estimated Jaccard similarity of token shingles)
+DEDUP_ENABLED = True
+DEDUP_THRESHOLD = 0.85
+DEDUP_NUM_PERM = 64
+DEDUP_BANDS = 8
+
+# File size limits: files up to MAX_FILE_SIZE_MB are read whole, larger text
+# files up to MAX_STREAMED_FILE_MB are streamed through mmap in batches
+MAX_FILE_SIZE_MB = 1
+MAX_STREAMED_FILE_MB = 64
+MAX_CHUNKS_PER_FILE = 2000
+STREAM_BATCH_SIZE = 64
+REPO_BYTE_BUDGET = 200 * 1024 * 1024
+# Near-duplicate locations named in a chunk's header; the rest are only counted
+MAX_LISTED_ALIASES = 5
+
+# Admin endpoints require this bearer token; without one they only answer requests from this host
+ADMIN_TOKEN = os.environ.get('REPOCHAT_ADMIN_TOKEN')
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
 
 def is_code_file(file_path: str) -> bool:
     """Check if the file is a relevant code file."""
@@ -67,51 +144,53 @@ def is_binary_or_large_file(file_path: str, max_size_mb: int = 1) -> bool:
     except (UnicodeDecodeError, IOError):
         return True
 
+def is_binary_file(file_path: str) -> bool:
+    """Check if file is binary, regardless of its size."""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            file.read(1024)
+            return False
+    except (UnicodeDecodeError, IOError):
+        return True
+
 def get_collection_for_chat(chat_id: str) -> chromadb.Collection:
-    """Get or create a collection for a specific chat."""
+    """Get the shared index collection a chat references."""
     try:
-        collection_name = f"chat_{chat_id}"
+        entry = index_registry.index_for_chat(chat_id)
+        if not entry or entry['status'] != 'ready':
+            raise ValueError("Repository not loaded. Please load a repository first.")
+        index_registry.touch_chat(chat_id)
         
-        try:
-            collection = chroma_client.get_or_create_collection(name=collection_name)
-            logger.info(f"Retrieved or created collection: {collection_name}")
-            return collection
-        except Exception as e:
-            logger.error(f"Error getting/creating collection: {str(e)}")
-            raise
+        collection = chroma_client.get_collection(name=entry['collection_name'])
+        logger.info(f"Retrieved collection {entry['collection_name']} for chat: {chat_id}")
+        return collection
             
     except Exception as e:
         logger.error(f"Error in get_collection_for_chat: {str(e)}")
         raise
 
-def extract_code_metadata(content: str) -> dict:
-    """Extract metadata from code content."""
-    metadata = {
-        'functions': [],
-        'classes': [],
-        'imports': [],
-        'file_type': None
-    }
-    
-    lines = content.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line.startswith('def '):
-            metadata['functions'].append(line[4:].split('(')[0])
-        elif line.startswith('class '):
-            metadata['classes'].append(line[6:].split('(')[0].split(':')[0])
-        elif line.startswith('import ') or line.startswith('from '):
-            metadata['imports'].append(line)
-            
-    return metadata
+def index_version_for_chat(chat_id: str) -> str:
+    """The shared index a chat references; identical questions are only coalesced within one index."""
+    entry = index_registry.index_for_chat(chat_id)
+    if not entry or entry['status'] != 'ready':
+        raise ValueError("Repository not loaded. Please load a repository first.")
+    return entry['index_id']
+
+def collect_unreferenced_indexes():
+    """Drop the collections and file rows of shared indexes no chat references any more."""
+    try:
+        janitor.collect_unreferenced()
+    except Exception as e:
+        # The periodic janitor pass retries
+        logger.error(f"Error in collect_unreferenced_indexes: {str(e)}")
 
-def extract_code_metadata(content: str) -> dict:
-    """Extract metadata from code content."""
+def extract_code_metadata(content: str, file_path: str = '') -> dict:
+    """Extract file-level metadata from code content."""
     metadata = {
         'functions': '',  # Changed from list to string
         'classes': '',    # Changed from list to string
         'imports': '',    # Changed from list to string
-        'file_type': ''
+        'file_type': os.path.splitext(file_path)[1].lower().lstrip('.') or os.path.basename(file_path)
     }
     
     lines = content.split('\n')
@@ -135,13 +214,159 @@ def extract_code_metadata(content: str) -> dict:
             
     return metadata
 
-def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, auth_token: str = None, chunk_size: int = 1500):
-    """Parse repository and add chunks to the chat-specific collection."""
+def add_file_chunks(collection: chromadb.Collection, index_id: str, file_id: str, chunks: List[dict],
+                    first_index: int, dedup_index: NearDuplicateIndex, alias_rows: list,
+                    stats: IngestStats) -> int:
+    """Deduplicate, embed and store a batch of one file's chunks.
+
+    Returns the number of chunks actually embedded.
+    """
+    indexed_chunks = [(first_index + i, chunk) for i, chunk in enumerate(chunks)]
+    
+    # Keep one representative per near-duplicate cluster; aliases are recorded, not embedded
+    if dedup_index is not None:
+        kept = []
+        for index, chunk in indexed_chunks:
+            representative = dedup_index.find_or_add(f"{file_id}_{index}", chunk['content'])
+            if representative:
+                alias_rows.append((representative, file_id, chunk['start_line'], chunk['end_line']))
+                stats.chunks_deduplicated += 1
+            else:
+                kept.append((index, chunk))
+        indexed_chunks = kept
+    
+    if not indexed_chunks:
+        return 0
+    
+    documents = [chunk['content'] for _, chunk in indexed_chunks]
+    embeddings = encoder.encode(documents)
+    collection.add(
+        embeddings=embeddings.tolist(),
+        documents=documents,
+        metadatas=[{
+            'index_id': index_id,
+            'file_id': file_id,
+            'chunk_index': index,
+            'start_line': chunk['start_line'],
+            'end_line': chunk['end_line'],
+            'type': chunk['type'],
+            'name': chunk['name'],
+            'parent': chunk['parent'],
+            'token_count': chunk['token_count']
+        } for index, chunk in indexed_chunks],
+        ids=[f"{file_id}_{index}" for index, _ in indexed_chunks]
+    )
+    stats.chunks_indexed += len(indexed_chunks)
+    return len(indexed_chunks)
+
+def index_large_file(collection: chromadb.Collection, index_id: str, file_path: str, relative_path: str,
+                     chunk_size: int, dedup_index: NearDuplicateIndex, alias_rows: list, stats: IngestStats):
+    """Index a text file above the in-memory size limit by streaming it through mmap."""
+    file_size = os.path.getsize(file_path)
+    sample = read_text_sample(file_path)
+    keep, reason = classify_file(relative_path, sample)
+    if not keep:
+        stats.skip(reason, file_size)
+        return
+    
+    file_id = make_file_id(index_id, relative_path)
+    embedded = 0
+    next_index = 0
+    batch = []
+    
+    def flush(batch: List[dict]):
+        nonlocal embedded, next_index
+        fitted = fit_chunks_to_budget(batch, token_counter)
+        embedded += add_file_chunks(collection, index_id, file_id, fitted, next_index,
+                                    dedup_index, alias_rows, stats)
+        next_index += len(fitted)
+    
+    for chunk in iter_large_file_chunks(file_path, relative_path, chunk_size, MAX_CHUNKS_PER_FILE):
+        batch.append(chunk)
+        if len(batch) >= STREAM_BATCH_SIZE:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    
+    # The row is stored even when every chunk was a near-duplicate, so aliases resolve to this path
+    file_store.upsert_file(index_id, relative_path, extract_code_metadata(sample, relative_path), embedded)
+    if embedded:
+        stats.files_indexed += 1
+        stats.bytes_indexed += file_size
+        stats.large_files_streamed += 1
+    logger.info(f"Streamed large file {relative_path} ({file_size} bytes, {embedded} chunks)")
+
+def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, auth_token: str = None, chunk_size: int = 1500) -> dict:
+    """Load a repository for a chat, reusing the shared index for the same repo@commit.
+
+    Indexes are keyed by (normalized repo URL, commit SHA, INDEX_VERSION); the
+    chat only holds a reference. Returns the ingest stats of the build, with
+    ``shared`` set when an existing index was reused.
+    """
     try:
         parsed_url = urlparse(repo_url)
         if not parsed_url.scheme or not parsed_url.netloc or not parsed_url.path:
             raise ValueError("Invalid GitHub repository URL")
 
+        clone_url = repo_url
+        if auth_token:
+            # Insert token into clone URL for authentication
+            clone_url = f"https://{auth_token}@{parsed_url.netloc}{parsed_url.path}"
+        
+        normalized_url = normalize_repo_url(repo_url)
+        commit_sha = resolve_commit_sha(clone_url)
+        index_id = make_index_id(normalized_url, commit_sha, INDEX_VERSION)
+        
+        with index_registry.build_lock(index_id):
+            entry = index_registry.get_index(index_id)
+            if entry and entry['status'] == 'ready':
+                index_registry.attach_chat(chat_id, index_id)
+                logger.info(f"Reusing shared index {index_id} for {normalized_url}@{commit_sha[:12]}")
+                stats = {**entry['stats'], 'shared': True}
+            else:
+                collection_name = f"repo_{index_id}"
+                index_registry.register_index(index_id, normalized_url, commit_sha, INDEX_VERSION, collection_name)
+                # Reference the index before building so garbage collection never races the build
+                previous = index_registry.attach_chat(chat_id, index_id)
+                try:
+                    stats = build_repository_index(clone_url, parsed_url, commit_sha, index_id, collection_name, chunk_size)
+                except Exception:
+                    # A partial collection must not be appended to by the retry
+                    discard_index_data(index_id, collection_name)
+                    index_registry.register_index(index_id, normalized_url, commit_sha, INDEX_VERSION,
+                                                  collection_name, status='failed')
+                    if previous:
+                        index_registry.attach_chat(chat_id, previous)
+                    else:
+                        index_registry.detach_chat(chat_id)
+                    raise
+                index_registry.mark_ready(index_id, stats)
+                stats = {**stats, 'shared': False}
+        
+        collect_unreferenced_indexes()
+        return stats
+
+    except Exception as e:
+        logger.error(f"Error in parse_github_repo_and_add_to_vector_db: {str(e)}")
+        raise
+
+def discard_index_data(index_id: str, collection_name: str):
+    """Delete an index's collection and file rows, e.g. what a failed build left behind."""
+    try:
+        chroma_client.delete_collection(name=collection_name)
+    except ValueError:
+        # Collection was never created
+        pass
+    file_store.delete_index(index_id)
+
+def build_repository_index(clone_url: str, parsed_url, commit_sha: str, index_id: str, collection_name: str,
+                           chunk_size: int = 1500) -> dict:
+    """Clone a repository at ``commit_sha`` and embed it into a new shared index collection.
+
+    Returns ingest stats describing what was embedded and what was skipped.
+    """
+    try:
         repo_name = os.path.splitext(parsed_url.path.split('/')[-1])[0]
         logger.info(f"Parsing repository: {repo_name}")
 
@@ -154,12 +379,6 @@ def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, auth_tok
         with tempfile.TemporaryDirectory() as temp_dir:
             logger.info("Created temporary directory")
             try:
-                clone_url = repo_url
-                if auth_token:
-                    # Insert token into clone URL for authentication
-                    parsed = urlparse(repo_url)
-                    clone_url = f"https://{auth_token}@{parsed.netloc}{parsed.path}"
-                
                 repo = git.Repo.clone_from(clone_url, os.path.join(temp_dir, repo_name))
                 logger.info(f"Cloned repository: {repo_name}")
             except git.exc.GitCommandError as e:
@@ -167,9 +386,19 @@ def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, auth_tok
                     raise ValueError("Authentication failed. Please check your GitHub token.")
                 logger.error(f"Git clone failed: {str(e)}")
                 raise ValueError("Failed to clone repository. Please check the URL and permissions.")
-
-            collection = get_collection_for_chat(chat_id)
-            collection.delete(where={"chat_id": chat_id})
+            # The index is keyed by the resolved commit; a push since then must not leak into it
+            try:
+                repo.git.checkout(commit_sha)
+            except git.exc.GitCommandError as e:
+                logger.error(f"Checkout of {commit_sha[:12]} failed: {str(e)}")
+                raise ValueError("The repository changed while it was being loaded. Please try again.")
+
+            # Start from an empty collection even if an earlier build died without cleaning up
+            discard_index_data(index_id, collection_name)
+            collection = chroma_client.create_collection(name=collection_name, metadata=COLLECTION_METADATA)
+            stats = IngestStats()
+            dedup_index = NearDuplicateIndex(DEDUP_THRESHOLD, DEDUP_NUM_PERM, DEDUP_BANDS) if DEDUP_ENABLED else None
+            alias_rows = []
             
             for root, dirs, files in os.walk(os.path.join(temp_dir, repo_name)):
                 dirs[:] = [d for d in dirs if d not in ignored_directories]
@@ -177,76 +406,72 @@ def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, auth_tok
                 for file in files:
                     file_path = os.path.join(root, file)
                     relative_path = os.path.relpath(file_path, os.path.join(temp_dir, repo_name))
+                    file_size = os.path.getsize(file_path)
+                    stats.files_seen += 1
+                    stats.bytes_seen += file_size
                     
-                    if not is_code_file(file_path) or is_binary_or_large_file(file_path):
+                    if not is_code_file(file_path):
+                        stats.skip('extension', file_size)
+                        continue
+                    if stats.bytes_indexed + file_size > REPO_BYTE_BUDGET:
+                        stats.skip('byte_budget', file_size)
+                        continue
+                    if file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
+                        # Large text files are streamed through mmap instead of being dropped
+                        if file_size > MAX_STREAMED_FILE_MB * 1024 * 1024 or is_binary_file(file_path):
+                            stats.skip('binary_or_large', file_size)
+                            continue
+                        index_large_file(collection, index_id, file_path, relative_path, chunk_size,
+                                         dedup_index, alias_rows, stats)
+                        continue
+                    if is_binary_or_large_file(file_path, MAX_FILE_SIZE_MB):
+                        stats.skip('binary_or_large', file_size)
                         continue
                         
                     try:
                         with open(file_path, "r", encoding="utf-8") as content_file:
                             content = content_file.read()
                             if not content.strip():
+                                stats.skip('empty', file_size)
                                 continue
-                                
-                            # Extract metadata
-                            metadata = extract_code_metadata(content)
-                            metadata['file_path'] = relative_path
-                            metadata['chat_id'] = chat_id
                             
-                            # Smart chunking based on code structure
-                            chunks = smart_code_chunking(content, chunk_size)
-                            
-                            if chunks:
-                                embeddings = encoder.encode(chunks)
+                            # Cheap classifier pass: lockfiles, generated, minified and vendored code
+                            keep, reason = classify_file(relative_path, content)
+                            if not keep:
+                                stats.skip(reason, file_size)
+                                continue
+                            content, stripped_lines = strip_license_header(content, relative_path)
+                            if stripped_lines:
+                                stats.license_headers_stripped += 1
                                 
-                                # Add chunks with metadata
-                                for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-                                    chunk_metadata = metadata.copy()
-                                    chunk_metadata['chunk_index'] = str(i)
-                                    
-                                    collection.add(
-                                        embeddings=[embedding.tolist()],
-                                        documents=[chunk],
-                                        metadatas=[chunk_metadata],
-                                        ids=[f"{chat_id}_{relative_path}_chunk_{i}"]
-                                    )
+                            # Structure-aware chunking, then windowing so every chunk fits the encoder
+                            chunks = fit_chunks_to_budget(chunk_file(content, relative_path, chunk_size), token_counter)
+                            file_id = make_file_id(index_id, relative_path)
+                            embedded = add_file_chunks(collection, index_id, file_id, chunks, 0,
+                                                       dedup_index, alias_rows, stats)
+                            
+                            # File-level metadata is stored once; chunks and aliases only reference it by ID.
+                            # A file whose chunks were all near-duplicates still gets its row
+                            metadata = extract_code_metadata(content, relative_path)
+                            file_store.upsert_file(index_id, relative_path, metadata, embedded)
+                            if embedded:
+                                stats.files_indexed += 1
+                                stats.bytes_indexed += file_size
                     except UnicodeDecodeError:
+                        stats.skip('binary_or_large', file_size)
                         continue
 
-            logger.info("Successfully processed repository and added to vector database")
+            file_store.add_aliases(index_id, alias_rows)
+            logger.info(f"Successfully processed repository and added to vector database: {stats.to_dict()}")
+            return stats.to_dict()
 
     except Exception as e:
-        logger.error(f"Error in parse_github_repo_and_add_to_vector_db: {str(e)}")
+        logger.error(f"Error in build_repository_index: {str(e)}")
         raise
 
 
-def smart_code_chunking(content: str, chunk_size: int) -> List[str]:
-    """Implement smart chunking based on code structure."""
-    chunks = []
-    current_chunk = []
-    current_size = 0
-    
-    # Split by potential logical boundaries
-    boundaries = ['\nclass ', '\ndef ', '\n\n# ', '\n\n## ']
-    
-    lines = content.split('\n')
-    
-    for line in lines:
-        current_chunk.append(line)
-        current_size += len(line)
-        
-        # Check if we should create a new chunk
-        if current_size >= chunk_size or any(boundary in line for boundary in boundaries):
-            if current_chunk:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = []
-                current_size = 0
-                
-    if current_chunk:
-        chunks.append('\n'.join(current_chunk))
-        
-    return chunks
-
-def refine_query(initial_query: str, relevant_chunks: List[str], chat_history: str = "") -> str:
+def refine_query(initial_query: str, relevant_chunks: List[str], chat_history: str = "", chat_id: str = None,
+                 cancel: Optional[CancelToken] = None, max_wait: Optional[float] = None) -> str:
     """Generate a refined query based on initial results and chat history."""
     try:
         # Create a prompt for query refinement
@@ -283,9 +508,9 @@ def refine_query(initial_query: str, relevant_chunks: List[str], chat_history: s
         ]
 
         # Get refined query from LLM
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            response = ollama_client.chat(model='llama3.2:3b', messages=messages)
+        route = model_routes.route(TASK_REFINE)
+        response = llm_client.chat(model=route.model, messages=messages, chat_id=chat_id, priority=PRIORITY_REFINE,
+                                   cancel=cancel, max_wait=max_wait, options=route.options())
             
         refined_query = response['message']['content']
         
@@ -296,92 +521,177 @@ def refine_query(initial_query: str, relevant_chunks: List[str], chat_history: s
         logger.info(f"Refined query: {refined_query}")
         return refined_query
 
+    except RequestCancelled:
+        raise
     except Exception as e:
         logger.error(f"Error in query refinement: {str(e)}")
         # Fallback to original query if refinement fails
         return initial_query
 
-def get_relevant_chunks(collection: chromadb.Collection, query: str, chat_id: str, n_results: int = 3) -> Tuple[List[str], float]:
-    """Get relevant chunks and their average similarity score."""
+def get_relevant_chunks(collection: chromadb.Collection, query: str, n_results: int = 3) -> Tuple[List[str], float, List[dict], List[float]]:
+    """Get relevant chunks, their average similarity score, the source spans they came from and per-chunk similarities."""
     query_embedding = encoder.encode(query)
     
     results = collection.query(
         query_embeddings=[query_embedding.tolist()],
-        where={"chat_id": chat_id},
-        n_results=n_results
+        n_results=n_results,
+        include=['documents', 'metadatas', 'distances']
     )
     
-    # Calculate average similarity score
-    if results['distances'] and results['distances'][0]:
-        avg_similarity = 1 - (sum(results['distances'][0]) / len(results['distances'][0]))
-    else:
-        avg_similarity = 0
+    # Calculate similarity scores, best first; indexes built before cosine space use squared L2
+    space = (collection.metadata or {}).get('hnsw:space', 'l2')
+    similarities = [distance_to_similarity(distance, space) for distance in results['distances'][0]] \
+        if results['distances'] else []
+    avg_similarity = sum(similarities) / len(similarities) if similarities else 0
+    
+    # Resolve file paths from the file table instead of per-chunk metadata
+    metadatas = results['metadatas'][0] if results['metadatas'] else []
+    files = file_store.get_files([m.get('file_id', '') for m in metadatas])
+    aliases = file_store.get_aliases(results['ids'][0])
+    documents = []
+    sources = []
+    for chunk_id, doc, metadata in zip(results['ids'][0], results['documents'][0], metadatas):
+        file_info = files.get(metadata.get('file_id', ''))
+        if file_info:
+            header = f"File: {file_info['file_path']} (lines {metadata.get('start_line')}-{metadata.get('end_line')})"
+            chunk_aliases = aliases.get(chunk_id, [])
+            if chunk_aliases:
+                places = ', '.join(f"{alias['file_path']}:{alias['start_line']}-{alias['end_line']}"
+                                   for alias in chunk_aliases[:MAX_LISTED_ALIASES])
+                if len(chunk_aliases) > MAX_LISTED_ALIASES:
+                    places += f" and {len(chunk_aliases) - MAX_LISTED_ALIASES} more"
+                header += f" [near-duplicates in {len(chunk_aliases)} other places: {places}]"
+            doc = f"{header}\n{doc}"
+            sources.append({
+                'file_path': file_info['file_path'],
+                'start_line': metadata.get('start_line'),
+                'end_line': metadata.get('end_line'),
+                'aliases': chunk_aliases
+            })
+        documents.append(doc)
         
-    return results['documents'][0], avg_similarity
+    return documents, avg_similarity, sources, similarities
 
-def generate_response(chat_id: str, conversation_history: str, query: str) -> str:
-    """Generate a response using two-stage RAG with query refinement."""
+# Identical for every turn and chat, so Ollama keeps it evaluated in its KV cache
+ANSWER_SYSTEM_PROMPT = """You are a helpful AI assistant specializing in code explanation. 
+            Base your response on the code context given with each question.
+            
+            Important guidelines:
+            1. Only reference information actually present in the context
+            2. If you're unsure about any details, acknowledge the uncertainty
+            3. Use technical terminology found in the code
+            4. Focus on practical implementation details
+            5. Don't mention that you're using any context"""
+
+def build_chat_messages(context: str, history: List[dict], query: str) -> List[dict]:
+    """Build the answer model's messages: fixed instructions, history, then this turn's context and query."""
+    return build_messages(ANSWER_SYSTEM_PROMPT, history, query, context)
+
+def plan_chat(chat_id: str, history: List[dict], query: str, deadline: Optional[Deadline] = None) -> dict:
+    """Run the initial retrieval and decide whether query refinement is worth an LLM round-trip."""
     try:
+        deadline = deadline or Deadline()
+        n_results = RETRIEVAL_RESULTS
+        if deadline.remaining() < FULL_RETRIEVAL_MIN_SECONDS:
+            # A smaller prompt is evaluated sooner
+            n_results = REDUCED_RETRIEVAL_RESULTS
+            deadline.degrade(DEGRADE_FEWER_RESULTS)
         collection = get_collection_for_chat(chat_id)
-        
-        # Stage 1: Initial retrieval
-        initial_chunks, initial_similarity = get_relevant_chunks(collection, query, chat_id)
-        
-        if not initial_chunks:
+        chunks, similarity, sources, similarities = get_relevant_chunks(collection, query, n_results)
+
+        if not chunks:
             raise ValueError("No relevant information found in the repository")
-            
-        # Stage 2: Query refinement and second retrieval
-        refined_query = refine_query(query, initial_chunks, conversation_history)
-        final_chunks, final_similarity = get_relevant_chunks(collection, refined_query, chat_id)
-        
-        # Use chunks with better similarity score
-        if final_similarity > initial_similarity:
-            context = "\n".join(final_chunks)
-            used_query = refined_query
-        else:
-            context = "\n".join(initial_chunks)
-            used_query = query
-            
-        # Generate final response
-        messages = [
-            {
-                "role": "system",
-                "content": f"""You are a helpful AI assistant specializing in code explanation. 
-                Base your response on this code context: {context}
-                
-                Important guidelines:
-                1. Only reference information actually present in the context
-                2. If you're unsure about any details, acknowledge the uncertainty
-                3. Use technical terminology found in the code
-                4. Focus on practical implementation details
-                5. Don't mention that you're using any context"""
-            }
-        ]
 
-        if conversation_history:
-            for line in conversation_history.split('\n'):
-                if line.startswith('User: '):
-                    messages.append({
-                        "role": "user",
-                        "content": line[6:]
-                    })
-                elif line.startswith('Assistant: '):
-                    messages.append({
-                        "role": "assistant",
-                        "content": line[11:]
-                    })
-
-        messages.append({
-            "role": "user",
-            "content": used_query
-        })
-
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            response = ollama_client.chat(model='llama3.2:3b', messages=messages)
-            
+        refine, reason = should_refine(query, chunks, similarities)
+        if refine and deadline.remaining() < REFINE_MIN_SECONDS:
+            refine, reason = False, 'deadline'
+            deadline.degrade(DEGRADE_SKIPPED_REFINEMENT)
+        logger.info(f"Refinement {'needed' if refine else 'skipped'} for chat {chat_id}: {reason}")
+        return {
+            'collection': collection,
+            'n_results': n_results,
+            'chunks': chunks,
+            'similarity': similarity,
+            'refine': refine,
+            'messages': build_chat_messages("\n".join(chunks), history, query),
+            'metadata': {'query': query, 'refined': False, 'similarity': similarity,
+                         'sources': sources, 'refinement': reason}
+        }
+
+    except Exception as e:
+        logger.error(f"Error in plan_chat: {str(e)}")
+        raise
+
+def refine_plan(plan: dict, chat_id: str, history: List[dict], query: str, cancel: Optional[CancelToken] = None,
+                deadline: Optional[Deadline] = None) -> Optional[Tuple[List[dict], dict]]:
+    """Refine the query and retrieve again; returns messages and metadata only if the new context is better."""
+    deadline = deadline or Deadline()
+    refined_query = refine_query(query, plan['chunks'], history_text(history), chat_id, cancel, deadline.queue_wait())
+    if refined_query.strip() == query.strip():
+        return None
+
+    chunks, similarity, sources, _ = get_relevant_chunks(plan['collection'], refined_query, plan['n_results'])
+    if not chunks or similarity <= plan['similarity'] + REFINE_MIN_GAIN:
+        return None
+    messages = build_chat_messages("\n".join(chunks), history, refined_query)
+    return messages, {'query': refined_query, 'refined': True, 'similarity': similarity,
+                      'sources': sources, 'refinement': 'refined'}
+
+def open_answer_stream(chat_id: str, history: List[dict], query: str, cancel: Optional[CancelToken] = None,
+                       deadline: Optional[Deadline] = None) -> Tuple[Iterator[dict], dict]:
+    """Retrieve context and start streaming the answer; returns the chunk stream and retrieval metadata.
+
+    When refinement is needed, the answer on the initial context is generated
+    speculatively while the refinement round runs, and it is kept unless the
+    refined retrieval turns out better. ``cancel`` is checked between stages
+    and takes queued LLM calls out of the scheduler; ``deadline`` shrinks
+    retrieval, skips refinement and caps the answer length as time runs short.
+    """
+    cancel = cancel or CancelToken()
+    deadline = deadline or Deadline()
+    plan = plan_chat(chat_id, history, query, deadline)
+    cancel.raise_if_cancelled()
+    if not plan['refine']:
+        record_refinement_outcome('deadline' if plan['metadata']['refinement'] == 'deadline' else 'skipped')
+        return answer_stream(chat_id, plan['messages'], cancel, deadline), plan['metadata']
+
+    speculative = PrefetchedStream(answer_stream(chat_id, plan['messages'], cancel, deadline))
+    try:
+        refined = refine_plan(plan, chat_id, history, query, cancel, deadline)
+        cancel.raise_if_cancelled()
+    except Exception:
+        speculative.close()
+        raise
+
+    if refined is None:
+        record_refinement_outcome('speculative_kept')
+        plan['metadata']['refinement'] = 'speculative_kept'
+        return speculative, plan['metadata']
+
+    speculative.close()
+    record_refinement_outcome('refined')
+    messages, metadata = refined
+    return answer_stream(chat_id, messages, cancel, deadline), metadata
+
+def answer_stream(chat_id: str, messages: List[dict], cancel: CancelToken, deadline: Deadline) -> Iterator[dict]:
+    """Start streaming the answer, waiting for a slot and generating only as long as the deadline allows."""
+    options = deadline.answer_options(model_routes.options(TASK_ANSWER))
+    return llm_client.chat_stream(CHAT_MODEL, messages, chat_id=chat_id, cancel=cancel,
+                                  max_wait=deadline.queue_wait(), options=options)
+
+def record_refinement_outcome(outcome: str):
+    with refinement_lock:
+        refinement_outcomes[outcome] += 1
+
+def generate_response(chat_id: str, history: List[dict], query: str, cancel: Optional[CancelToken] = None,
+                      deadline: Optional[Deadline] = None) -> Tuple[str, dict]:
+    """Generate a response using RAG, refining the query only when retrieval is unsure."""
+    try:
+        chunks, metadata = open_answer_stream(chat_id, history, query, cancel, deadline)
+        answer = join_stream(chunks, cancel, deadline)
+
         logger.info("Generated response from refined RAG pipeline")
-        return response['message']['content']
+        return answer, metadata
 
     except Exception as e:
         logger.error(f"Error in generate_response: {str(e)}")
@@ -409,8 +719,10 @@ def load_repo():
             auth_token = auth_header.split(' ')[1]
 
         logger.info(f"Loading repository: {repo_url} for chat: {chat_id}")
-        parse_github_repo_and_add_to_vector_db(repo_url, chat_id, auth_token)
-        return jsonify({'status': 'success'})
+        stats = parse_github_repo_and_add_to_vector_db(repo_url, chat_id, auth_token)
+        # A (re)loaded chat starts a fresh conversation
+        chat_sessions.clear(chat_id)
+        return jsonify({'status': 'success', 'stats': stats})
 
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}")
@@ -419,8 +731,73 @@ def load_repo():
         logger.error(f"Server error in load_repo: {str(e)}")
         return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
     
+@app.route('/delete-chat', methods=['POST'])
+def delete_chat():
+    """Release a chat's reference to its shared index."""
+    try:
+        data = request.json
+        if not data or not data.get('chat_id'):
+            return jsonify({'error': 'chat_id is required'}), 400
+
+        chat_cancellations.cancel(data['chat_id'], 'deleted')
+        index_registry.detach_chat(data['chat_id'])
+        chat_sessions.clear(data['chat_id'])
+        collect_unreferenced_indexes()
+        return jsonify({'status': 'success'})
+
+    except Exception as e:
+        logger.error(f"Server error in delete_chat: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
+
+def is_admin_request() -> bool:
+    if not ADMIN_TOKEN:
+        return request.remote_addr in LOCAL_ADDRESSES
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {ADMIN_TOKEN}")
+
+@app.route('/admin/stats', methods=['GET'])
+def admin_stats():
+    """Disk use, index/chat counts, janitor history and LLM client stats."""
+    if not is_admin_request():
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        return jsonify({**janitor.stats(), 'llm': llm_stats(), 'coalescing': chat_flights.stats(), 'answer_cache': answer_cache.stats(),
+                        'refinement': dict(refinement_outcomes), 'model_routes': model_routes.table(),
+                        'chat_sessions': chat_sessions.stats(),
+                        'cancellation': chat_cancellations.stats()})
+    except Exception as e:
+        logger.error(f"Server error in admin_stats: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
+
+@app.route('/admin/janitor', methods=['POST'])
+def admin_run_janitor():
+    """Run an expiry/eviction/compaction pass now and return its report."""
+    if not is_admin_request():
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        return jsonify(janitor.run_once())
+    except Exception as e:
+        logger.error(f"Server error in admin_run_janitor: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
+
+@app.route('/cancel', methods=['POST'])
+def cancel_chat():
+    """Stop a chat's in-flight request: its retrieval, queued LLM calls and generation."""
+    try:
+        data = request.json
+        if not data or not data.get('chat_id'):
+            return jsonify({'error': 'chat_id is required'}), 400
+
+        cancelled = chat_cancellations.cancel(data['chat_id'])
+        return jsonify({'status': 'success', 'cancelled': cancelled})
+
+    except Exception as e:
+        logger.error(f"Server error in cancel_chat: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
+
 @app.route('/chat', methods=['POST'])
 def chat_endpoint():
+    cancel = None
+    streaming = False
     try:
         data = request.json
         if not data:
@@ -428,7 +805,6 @@ def chat_endpoint():
 
         query = data.get('query')
         chat_id = data.get('chat_id')
-        conversation_history = data.get('conversation_history', '')
 
         if not query:
             return jsonify({'error': 'query is required'}), 400
@@ -436,8 +812,82 @@ def chat_endpoint():
             return jsonify({'error': 'chat_id is required'}), 400
 
         logger.info(f"Processing chat query for chat: {chat_id}")
-        response = generate_response(chat_id, conversation_history, query)
-        return jsonify({'response': response})
+        started_at = time.perf_counter()
+        # Stages shorten or skip work as the time budget runs out
+        deadline = Deadline.from_request(data)
+        # History lives on the server; a transcript is only adopted for chats without a session
+        history = chat_sessions.history(chat_id)
+        if not history and data.get('conversation_history'):
+            history = chat_sessions.seed(chat_id, parse_history(data['conversation_history']))
+        conversation_history = history_text(history)
+        index_version = index_version_for_chat(chat_id)
+        scope = answer_scope(index_version, CHAT_MODEL, conversation_history)
+        cached = None
+        if data.get('no_cache'):
+            answer_cache.record_bypass()
+        else:
+            cached = answer_cache.lookup(scope, query)
+
+        # Identical in-flight questions about the same index share one generation
+        key = flight_key(index_version, query, conversation_history)
+        # A different message for the chat, an explicit /cancel or a client disconnect stops this
+        # request; an identical resend (a double submit) joins it instead
+        cancel = chat_cancellations.begin(chat_id, request.environ, key)
+
+        def record(answer: str):
+            if chat_cancellations.claim_answer(chat_id, cancel):
+                chat_sessions.record_exchange(chat_id, query, answer)
+
+        def store(answer: str, metadata: dict):
+            # A degraded answer is not the one a relaxed request would get
+            if not deadline.degradations:
+                answer_cache.store(scope, query, answer, metadata)
+
+        def finish():
+            chat_cancellations.finish(chat_id, cancel)
+
+        if data.get('stream'):
+            if cached:
+                streaming = True
+                return sse_response(with_answer(cached_answer_events(cached, CHAT_MODEL, started_at), record), on_close=finish)
+
+            def open_stream(flight_cancel: CancelToken):
+                # Retrieval runs before the stream opens so its errors still map to status codes
+                chunks, metadata = open_answer_stream(chat_id, history, query, flight_cancel, deadline)
+                events = stream_chat_events(chunks, CHAT_MODEL, metadata, started_at,
+                                            on_complete=lambda answer: store(answer, metadata), deadline=deadline)
+                return events, chunks.close
+
+            subscription = chat_flights.stream(key, open_stream, cancel)
+            streaming = True
+
+            def close():
+                # A client gone before the body was iterated never closes the generators
+                subscription.close()
+                finish()
+
+            return sse_response(with_answer(subscription, record), on_close=close)
+
+        if cached:
+            record(cached['answer'])
+            return jsonify({'response': cached['answer'], 'cached': True})
+
+        def compute():
+            answer, metadata = generate_response(chat_id, history, query, cancel, deadline)
+            store(answer, metadata)
+            return answer
+
+        response = chat_flights.run(key, compute)
+        record(response)
+        return jsonify({'response': response, 'deadline': deadline.report()})
+
+    except RequestCancelled as e:
+        logger.info(f"Stopped chat_endpoint: {str(e)}")
+        return jsonify({'error': 'Request cancelled'}), 499
+
+    except SchedulerBusy as e:
+        logger.warning(f"LLM busy in chat_endpoint: {str(e)}")
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 503, {'Retry-After': str(e.retry_after)}
 
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}")
@@ -446,6 +896,10 @@ def chat_endpoint():
     except Exception as e:
         logger.error(f"Server error in chat_endpoint: {str(e)}")
         return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
+    finally:
+        # Streaming responses finish when the response closes
+        if cancel is not None and not streaming:
+            chat_cancellations.finish(chat_id, cancel)
 
 if __name__ == '__main__':
     # Initialize logging configuration at startup
@@ -474,21 +928,24 @@ if __name__ == '__main__':
         logger.info("ChromaDB connection verified")
         
         # Test Ollama connection
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            test_response = ollama_client.chat(
-                model='llama3.2:3b',
-                messages=[{"role": "user", "content": "test"}]
-            )
+        test_response = llm_client.chat(
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": "test"}]
+        )
         logger.info("Ollama connection verified")
         
     except Exception as e:
         logger.error(f"Startup verification failed: {str(e)}")
         raise
     
+    debug_mode = True
+    # The debug reloader runs this module twice; only the serving child runs the janitor
+    if not debug_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        janitor.start()
+
     # Start the Flask application
     app.run(
         host='0.0.0.0',  # Accept connections from all networks
         port=5000,       # Default Flask port
-        debug=True       # Enable debug mode for development
+        debug=debug_mode # Enable debug mode for development
     )
\ No newline at end of file
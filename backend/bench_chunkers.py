@@ -0,0 +1,75 @@
+"""Throughput benchmark for the code chunkers.
+
+Usage:
+    python bench_chunkers.py [path ...]
+
+Walks the given files/directories (defaults to the whole repository, whose
+frontend supplies the TypeScript sources),
+chunks every matching source file with each chunker and prints files/s and
+MB/s so the AST and brace chunkers can be compared against the regex baseline.
+"""
+import os
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+from chunkers import chunk_python, chunk_c_family, extract_functions_and_classes, C_FAMILY_EXTENSIONS
+
+
+def regex_chunk(content: str, file_path: str, chunk_size: int = 1500) -> List[Dict[str, any]]:
+    """Regex baseline: the structure split previously used by bolt_app.create_chunks."""
+    lines = content.split('\n')
+    return [
+        {**s, 'content': '\n'.join(lines[s['start_line'] - 1:s['end_line']])}
+        for s in extract_functions_and_classes(content)
+    ]
+
+
+def collect_sources(paths: List[str], extensions: Tuple[str, ...]) -> List[Tuple[str, str]]:
+    sources = []
+    for path in paths:
+        candidates = [path]
+        if os.path.isdir(path):
+            candidates = [
+                os.path.join(root, name)
+                for root, dirs, files in os.walk(path)
+                if '.git' not in root and 'node_modules' not in root
+                for name in files
+            ]
+        for candidate in candidates:
+            if candidate.endswith(extensions):
+                try:
+                    with open(candidate, 'r', encoding='utf-8') as f:
+                        sources.append((candidate, f.read()))
+                except (UnicodeDecodeError, IOError):
+                    continue
+    return sources
+
+
+def bench(name: str, chunker: Callable, sources: List[Tuple[str, str]], repeat: int = 5):
+    if not sources:
+        print(f"{name:<12} skipped: no matching files found")
+        return
+    total_bytes = sum(len(content) for _, content in sources)
+    chunk_count = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        chunk_count = 0
+        for file_path, content in sources:
+            chunk_count += len(chunker(content, file_path, 1500))
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:<12} {len(sources) / elapsed:>10.1f} files/s "
+          f"{total_bytes / elapsed / 1e6:>8.2f} MB/s {chunk_count:>7} chunks")
+
+
+if __name__ == '__main__':
+    targets = sys.argv[1:] or [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    python_sources = collect_sources(targets, ('.py',))
+    print(f"Python: {len(python_sources)} files")
+    bench('regex', regex_chunk, python_sources)
+    bench('ast', chunk_python, python_sources)
+
+    c_family_sources = collect_sources(targets, tuple(C_FAMILY_EXTENSIONS))
+    print(f"C-family: {len(c_family_sources)} files")
+    bench('regex', regex_chunk, c_family_sources)
+    bench('brace', chunk_c_family, c_family_sources)
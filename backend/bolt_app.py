@@ -3,17 +3,28 @@ from flask_cors import CORS
 import os
 import tempfile
 import shutil
+import time
 from urllib.parse import urlparse
 import git
 import chromadb
 from sentence_transformers import SentenceTransformer
-import ollama
 import PyPDF2
 import numpy as np
-from typing import List, Dict
-import httpx
+from typing import List, Dict, Optional, Tuple
 import logging
+from index_registry import IndexRegistry
 import re
+from chunkers import chunk_file, extract_functions_and_classes, C_FAMILY_EXTENSIONS
+from token_budget import TokenCounter, fit_chunks_to_budget
+from streaming import sse_response, stream_chat_events, cached_answer_events, with_answer, join_stream
+from answer_cache import AnswerCache, answer_scope
+from chat_sessions import ChatSessions, llm_summarizer, parse_history, history_text
+from cancellation import CancelToken, ChatCancellations, RequestCancelled
+from deadlines import Deadline, DEGRADE_FEWER_RESULTS
+from single_flight import SingleFlight, flight_key
+from llm_scheduler import get_llm_scheduler, llm_stats, SchedulerBusy
+from prompt_layout import build_messages
+from model_routes import load_model_routes, TASK_ANSWER
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,7 +36,10 @@ CORS(app)
 # Initialize global variables
 try:
     encoder = SentenceTransformer('all-MiniLM-L6-v2')
+    token_counter = TokenCounter.for_encoder(encoder)
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    # Registering each chat's collection lets the RAG app's janitor expire idle ones
+    collection_registry = IndexRegistry("./chroma_db/index_registry.db")
     logger.info("Successfully initialized encoder and ChromaDB client")
 except Exception as e:
     logger.error(f"Error initializing components: {str(e)}")
@@ -36,6 +50,19 @@ active_collections = {}
 
 
 OLLAMA_URL = 'https://8215-34-83-153-210.ngrok-free.app/'
+llm_client = get_llm_scheduler(OLLAMA_URL)
+chat_flights = SingleFlight()
+chat_cancellations = ChatCancellations()
+answer_cache = AnswerCache(lambda texts: encoder.encode(texts, show_progress_bar=False))
+model_routes = load_model_routes({
+    TASK_ANSWER: {'model': 'deepseek-coder-v2:latest'},
+}, serves=llm_client.pool.serves)
+CHAT_MODEL = model_routes.model(TASK_ANSWER)
+# Older turns are summarized in the background by the summarize route's model
+chat_sessions = ChatSessions(llm_summarizer(llm_client, model_routes))
+# A request with less time left than this retrieves at most the reduced number of chunks
+FULL_RETRIEVAL_MIN_SECONDS = 15
+REDUCED_RETRIEVAL_RESULTS = 3
 
 def is_code_file(file_path: str) -> bool:
     """Check if the file is a relevant code file."""
@@ -88,6 +115,7 @@ def get_collection_for_chat(chat_id: str) -> chromadb.Collection:
         
         try:
             collection = chroma_client.get_or_create_collection(name=collection_name)
+            collection_registry.touch_collection(collection_name)
             logger.info(f"Retrieved or created collection: {collection_name}")
             return collection
         except Exception as e:
@@ -144,7 +172,7 @@ def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, chunk_si
                                 continue
                             
                             # Process file content into chunks and add to vector DB
-                            chunks = create_chunks(content, relative_path, chunk_size)
+                            chunks = fit_chunks_to_budget(create_chunks(content, relative_path, chunk_size), token_counter)
                             if chunks:
                                 add_chunks_to_vector_db(collection, chunks, chat_id, relative_path)
                                 processed_files += 1
@@ -160,57 +188,6 @@ def parse_github_repo_and_add_to_vector_db(repo_url: str, chat_id: str, chunk_si
         logger.error(f"Error in parse_github_repo_and_add_to_vector_db: {str(e)}")
         raise
 
-def create_chunks(content: str, file_path: str, chunk_size: int = 1500) -> List[Dict[str, str]]:
-    """Create chunks from content with smart splitting and metadata."""
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    
-    # Split content into lines for better context preservation
-    lines = content.split('\n')
-    
-    for line in lines:
-        # Start new chunk if adding this line would exceed chunk size
-        if current_length + len(line) > chunk_size and current_chunk:
-            chunk_text = '\n'.join(current_chunk)
-            chunks.append({
-                'content': chunk_text,
-                'file_path': file_path,
-                'start_line': len(chunks) * len(current_chunk) + 1,
-                'end_line': (len(chunks) + 1) * len(current_chunk)
-            })
-            current_chunk = []
-            current_length = 0
-        
-        # Add line to current chunk
-        current_chunk.append(line)
-        current_length += len(line) + 1  # +1 for newline
-        
-        # Check if we should create a new chunk based on code structure
-        if any(marker in line for marker in ['class ', 'def ', 'function ', '@app.route', 'public class']):
-            if current_chunk:
-                chunk_text = '\n'.join(current_chunk)
-                chunks.append({
-                    'content': chunk_text,
-                    'file_path': file_path,
-                    'start_line': len(chunks) * len(current_chunk) + 1,
-                    'end_line': (len(chunks) + 1) * len(current_chunk)
-                })
-                current_chunk = []
-                current_length = 0
-    
-    # Add any remaining content as the last chunk
-    if current_chunk:
-        chunk_text = '\n'.join(current_chunk)
-        chunks.append({
-            'content': chunk_text,
-            'file_path': file_path,
-            'start_line': len(chunks) * len(current_chunk) + 1,
-            'end_line': (len(chunks) + 1) * len(current_chunk)
-        })
-    
-    return chunks
-
 def add_chunks_to_vector_db(collection: chromadb.Collection, chunks: List[Dict[str, str]], chat_id: str, file_path: str):
     """Add chunks to the vector database with metadata."""
     try:
@@ -229,7 +206,11 @@ def add_chunks_to_vector_db(collection: chromadb.Collection, chunks: List[Dict[s
                 "file_path": file_path,
                 "start_line": chunk['start_line'],
                 "end_line": chunk['end_line'],
-                "chunk_index": i
+                "chunk_index": i,
+                "type": chunk.get('type', 'code_block'),
+                "name": chunk.get('name') or '',
+                "parent": chunk.get('parent', ''),
+                "token_count": chunk['token_count']
             }
             metadatas.append(metadata)
 
@@ -267,44 +248,12 @@ def extract_function_name(query: str) -> str:
     
     return ""
 
-def extract_functions_and_classes(content: str) -> List[Dict[str, any]]:
-    """Extract functions and classes from code content."""
-    structures = []
-    lines = content.split('\n')
-    current_structure = None
-    
-    # Regex patterns for different programming languages
-    patterns = {
-        'python': r'^\s*(def|class)\s+(\w+)',
-        'javascript': r'^\s*(function|class)\s+(\w+)|^\s*(\w+)\s*=\s*(async\s*)?function',
-        'java': r'^\s*(public|private|protected)?\s*(static\s+)?(class|interface|enum)\s+(\w+)|^\s*(public|private|protected)?\s*(static\s+)?\w+\s+(\w+)\s*\(',
-    }
-    
-    for i, line in enumerate(lines):
-        for lang, pattern in patterns.items():
-            match = re.match(pattern, line)
-            if match:
-                if current_structure:
-                    current_structure['end_line'] = i
-                    structures.append(current_structure)
-                
-                current_structure = {
-                    'type': match.group(1) if match.group(1) else 'function',
-                    'name': match.group(2) if match.group(2) else match.group(0),
-                    'start_line': i + 1,
-                    'content': line,
-                    'language': lang
-                }
-                break
-    
-    if current_structure:
-        current_structure['end_line'] = len(lines)
-        structures.append(current_structure)
-    
-    return structures
-
 def create_chunks(content: str, file_path: str, chunk_size: int = 1500) -> List[Dict[str, str]]:
     """Create chunks from content with smart splitting based on code structure."""
+    _, ext = os.path.splitext(file_path)
+    if ext.lower() in {'.py', '.pyi'} or ext.lower() in C_FAMILY_EXTENSIONS:
+        return chunk_file(content, file_path, chunk_size)
+    
     chunks = []
     
     # Extract functions and classes
@@ -387,8 +336,23 @@ def create_chunks(content: str, file_path: str, chunk_size: int = 1500) -> List[
     return chunks
 
 
-def generate_response(chat_id: str, conversation_history: str, query: str) -> str:
-    """Generate a response using RAG with context-aware retrieval and general question handling."""
+# Identical for every turn and chat, so Ollama keeps it evaluated in its KV cache
+ANSWER_SYSTEM_PROMPT = """You are a code expert answering questions about a GitHub repository.
+Each question comes with instructions for the kind of answer wanted and the code it is about."""
+
+def retrieval_results(n_results: int, deadline: Optional[Deadline]) -> int:
+    """How many chunks to retrieve, fewer when the request is short on time."""
+    if deadline is None or deadline.remaining() >= FULL_RETRIEVAL_MIN_SECONDS or n_results <= REDUCED_RETRIEVAL_RESULTS:
+        return n_results
+    deadline.degrade(DEGRADE_FEWER_RESULTS)
+    return REDUCED_RETRIEVAL_RESULTS
+
+def prepare_chat(chat_id: str, history: List[dict], query: str,
+                 deadline: Optional[Deadline] = None) -> Tuple[List[dict], dict]:
+    """Retrieve context for the query and build the chat messages.
+
+    Returns the messages and retrieval metadata (source spans) for streaming clients.
+    """
     try:
         collection = get_collection_for_chat(chat_id)
         query_embedding = encoder.encode(query)
@@ -414,7 +378,7 @@ def generate_response(chat_id: str, conversation_history: str, query: str) -> st
             results = collection.query(
                 query_embeddings=[query_embedding.tolist()],
                 where={"chat_id": chat_id},
-                n_results=5
+                n_results=retrieval_results(5, deadline)
             )
             
             # Create a system message focused on overall codebase understanding
@@ -435,7 +399,7 @@ def generate_response(chat_id: str, conversation_history: str, query: str) -> st
                         {"chat_id": chat_id},
                         {"file_path": filename}
                     ]},
-                    n_results=10
+                    n_results=retrieval_results(10, deadline)
                 )
                 system_message = f"You are a code expert analyzing the file {file_match.group(1)}. Provide a comprehensive overview of the file's purpose, structure, and key components. Use the following code context:"
             else:
@@ -474,6 +438,7 @@ def generate_response(chat_id: str, conversation_history: str, query: str) -> st
                     )
                     system_message = "You are a helpful AI assistant specialized in code explanation. Use the following code context to answer the question:"
 
+        sources = []
         # Handle case when no results are found
         if not results['documents'][0]:
             if is_general_question:
@@ -494,39 +459,36 @@ def generate_response(chat_id: str, conversation_history: str, query: str) -> st
                     if 'name' in metadata:
                         file_info += f"\nName: {metadata['name']}"
                 context_chunks.append(f"{file_info}\n{doc}")
+                sources.append({
+                    'file_path': metadata['file_path'],
+                    'start_line': metadata['start_line'],
+                    'end_line': metadata['end_line']
+                })
             context = "\n---\n".join(context_chunks)
 
-        messages = [
-            {
-                "role": "system",
-                "content": f"{system_message} {context}"
-            }
-        ]
+        # The per-question instructions and context go last so the system prefix stays cached
+        messages = build_messages(ANSWER_SYSTEM_PROMPT, history, query, context, instructions=system_message)
+        return messages, {'sources': sources}
 
-        if conversation_history:
-            for line in conversation_history.split('\n'):
-                if line.startswith('User: '):
-                    messages.append({
-                        "role": "user",
-                        "content": line[6:]
-                    })
-                elif line.startswith('Assistant: '):
-                    messages.append({
-                        "role": "assistant",
-                        "content": line[11:]
-                    })
+    except Exception as e:
+        logger.error(f"Error in prepare_chat: {str(e)}")
+        raise
 
-        messages.append({
-            "role": "user",
-            "content": query
-        })
+def generate_response(chat_id: str, history: List[dict], query: str, cancel: Optional[CancelToken] = None,
+                      deadline: Optional[Deadline] = None) -> Tuple[str, dict]:
+    """Generate a response using RAG with context-aware retrieval and general question handling."""
+    try:
+        deadline = deadline or Deadline()
+        messages, metadata = prepare_chat(chat_id, history, query, deadline)
+
+        # Streamed and joined, so a cancelled request stops the model mid-answer
+        chunks = llm_client.chat_stream(CHAT_MODEL, messages, chat_id=chat_id, cancel=cancel,
+                                        max_wait=deadline.queue_wait(),
+                                        options=deadline.answer_options(model_routes.options(TASK_ANSWER)))
+        answer = join_stream(chunks, cancel, deadline)
 
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            response = ollama_client.chat(model='deepseek-coder-v2:latest', messages=messages)
-        
         logger.info("Generated response from RAG pipeline")
-        return response['message']['content']
+        return answer, metadata
 
     except Exception as e:
         logger.error(f"Error in generate_response: {str(e)}")
@@ -549,6 +511,10 @@ def load_repo():
 
         logger.info(f"Loading repository: {repo_url} for chat: {chat_id}")
         parse_github_repo_and_add_to_vector_db(repo_url, chat_id)
+        # The chat's collection was rebuilt in place, so its cached answers are stale
+        answer_cache.invalidate(f"chat_{chat_id}")
+        # A (re)loaded chat starts a fresh conversation
+        chat_sessions.clear(chat_id)
         return jsonify({'status': 'success'})
 
     except ValueError as e:
@@ -590,10 +556,39 @@ def get_files():
     except Exception as e:
         logger.error(f"Error getting files: {str(e)}")
         return jsonify({'error': str(e)}), 500
-    
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """LLM client and chat session statistics."""
+    try:
+        return jsonify({'llm': llm_stats(), 'coalescing': chat_flights.stats(), 'answer_cache': answer_cache.stats(),
+                        'model_routes': model_routes.table(),
+                        'chat_sessions': chat_sessions.stats(),
+                        'cancellation': chat_cancellations.stats()})
+    except Exception as e:
+        logger.error(f"Server error in stats: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+@app.route('/cancel', methods=['POST'])
+def cancel_chat():
+    """Stop a chat's in-flight request: its retrieval, queued LLM calls and generation."""
+    try:
+        data = request.json
+        if not data or not data.get('chat_id'):
+            return jsonify({'error': 'chat_id is required'}), 400
+
+        cancelled = chat_cancellations.cancel(data['chat_id'])
+        return jsonify({'status': 'success', 'cancelled': cancelled})
+
+    except Exception as e:
+        logger.error(f"Server error in cancel_chat: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
 
 @app.route('/chat', methods=['POST'])
 def chat_endpoint():
+    cancel = None
+    streaming = False
     try:
         data = request.json
         if not data:
@@ -601,7 +596,6 @@ def chat_endpoint():
 
         query = data.get('query')
         chat_id = data.get('chat_id')
-        conversation_history = data.get('conversation_history', '')
 
         if not query:
             return jsonify({'error': 'query is required'}), 400
@@ -609,15 +603,96 @@ def chat_endpoint():
             return jsonify({'error': 'chat_id is required'}), 400
 
         logger.info(f"Processing chat query for chat: {chat_id}")
-        response = generate_response(chat_id, conversation_history, query)
-        return jsonify({'response': response})
-
+        started_at = time.perf_counter()
+        # Stages shorten or skip work as the time budget runs out
+        deadline = Deadline.from_request(data)
+        # History lives on the server; a transcript is only adopted for chats without a session
+        history = chat_sessions.history(chat_id)
+        if not history and data.get('conversation_history'):
+            history = chat_sessions.seed(chat_id, parse_history(data['conversation_history']))
+        conversation_history = history_text(history)
+        index_version = f"chat_{chat_id}"
+        scope = answer_scope(index_version, CHAT_MODEL, conversation_history)
+        cached = None
+        if data.get('no_cache'):
+            answer_cache.record_bypass()
+        else:
+            cached = answer_cache.lookup(scope, query)
+
+        # Identical in-flight questions about the same index share one generation
+        key = flight_key(index_version, query, conversation_history)
+        # A different message for the chat, an explicit /cancel or a client disconnect stops this
+        # request; an identical resend (a double submit) joins it instead
+        cancel = chat_cancellations.begin(chat_id, request.environ, key)
+
+        def record(answer: str):
+            if chat_cancellations.claim_answer(chat_id, cancel):
+                chat_sessions.record_exchange(chat_id, query, answer)
+
+        def store(answer: str, metadata: dict):
+            # A degraded answer is not the one a relaxed request would get
+            if not deadline.degradations:
+                answer_cache.store(scope, query, answer, metadata)
+
+        def finish():
+            chat_cancellations.finish(chat_id, cancel)
+
+        if data.get('stream'):
+            if cached:
+                streaming = True
+                return sse_response(with_answer(cached_answer_events(cached, CHAT_MODEL, started_at), record), on_close=finish)
+
+            def open_stream(flight_cancel: CancelToken):
+                # Retrieval runs before the stream opens so its errors still map to status codes
+                messages, metadata = prepare_chat(chat_id, history, query, deadline)
+                flight_cancel.raise_if_cancelled()
+                chunks = llm_client.chat_stream(CHAT_MODEL, messages, chat_id=chat_id, cancel=flight_cancel,
+                                                max_wait=deadline.queue_wait(),
+                                                options=deadline.answer_options(model_routes.options(TASK_ANSWER)))
+                events = stream_chat_events(chunks, CHAT_MODEL, metadata, started_at,
+                                            on_complete=lambda answer: store(answer, metadata), deadline=deadline)
+                return events, chunks.close
+
+            subscription = chat_flights.stream(key, open_stream, cancel)
+            streaming = True
+
+            def close():
+                # A client gone before the body was iterated never closes the generators
+                subscription.close()
+                finish()
+
+            return sse_response(with_answer(subscription, record), on_close=close)
+
+        if cached:
+            record(cached['answer'])
+            return jsonify({'response': cached['answer'], 'cached': True})
+
+        def compute():
+            answer, metadata = generate_response(chat_id, history, query, cancel, deadline)
+            store(answer, metadata)
+            return answer
+
+        response = chat_flights.run(key, compute)
+        record(response)
+        return jsonify({'response': response, 'deadline': deadline.report()})
+
+    except RequestCancelled as e:
+        logger.info(f"Stopped chat_endpoint: {str(e)}")
+        return jsonify({'error': 'Request cancelled'}), 499
+
+    except SchedulerBusy as e:
+        logger.warning(f"LLM busy in chat_endpoint: {str(e)}")
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 503, {'Retry-After': str(e.retry_after)}
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}")
         return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Server error in chat_endpoint: {str(e)}")
         return jsonify({'error': 'An unexpected error occurred. Please try again.'}), 500
+    finally:
+        # Streaming responses finish when the response closes
+        if cancel is not None and not streaming:
+            chat_cancellations.finish(chat_id, cancel)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,194 @@
+import select
+import socket
+import threading
+import logging
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# How often a waiting request checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+class RequestCancelled(Exception):
+    """The request was cancelled: its client went away, asked to stop or sent a newer message."""
+
+
+class CancelToken:
+    """Cooperative cancellation flag for one request.
+
+    Pipeline stages call ``raise_if_cancelled()`` between steps; code that
+    blocks (a scheduler queue, a coalesced stream) registers a callback to be
+    woken up when the token is cancelled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self._callbacks = []
+        self.reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self, reason: str = 'cancelled') -> bool:
+        """Cancel once; returns False if already cancelled or finished."""
+        with self._lock:
+            if self._cancelled.is_set() or self._finished.is_set():
+                return False
+            self.reason = reason
+            self._cancelled.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in cancel callback: {str(e)}")
+        return True
+
+    def raise_if_cancelled(self):
+        if self._cancelled.is_set():
+            raise RequestCancelled(f"Request cancelled ({self.reason})")
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Run ``callback`` on cancellation (now, if already cancelled); returns a function removing it."""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+        callback()
+        return lambda: None
+
+    def _remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def finish(self):
+        self._finished.set()
+
+    def wait_finished(self, timeout: float) -> bool:
+        return self._finished.wait(timeout)
+
+
+def _client_socket(environ: Dict[str, any]) -> Optional[socket.socket]:
+    """The client connection of a request, where the WSGI server exposes it (the Werkzeug dev server does)."""
+    sock = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+    return sock if isinstance(sock, socket.socket) else None
+
+
+def client_disconnected(sock: socket.socket) -> bool:
+    """Whether the peer closed the connection; pipelined request bytes do not count."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # TLS sockets cannot peek; such clients are only caught when a write fails
+        return False
+    except OSError:
+        return True
+
+
+class _ChatRequest:
+    """The in-flight requests of one chat: the first one and any identical resends."""
+
+    __slots__ = ('key', 'tokens', 'answered')
+
+    def __init__(self, key: Optional[str], token: CancelToken):
+        self.key = key
+        self.tokens = [token]
+        self.answered = False
+
+
+class ChatCancellations:
+    """The in-flight request of every chat, so it can be cancelled.
+
+    ``begin`` registers a request; a newer request for the same chat cancels
+    the older one (the user asked something else) unless both carry the
+    same ``key``: an identical resend (a double submit) joins the request in
+    flight instead. ``cancel`` is the explicit stop, and when the WSGI
+    environ exposes the client socket a watcher cancels the request as soon
+    as the client disconnects.
+    """
+
+    def __init__(self, poll_seconds: float = DISCONNECT_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._active: Dict[str, _ChatRequest] = {}
+        self._stats = {'started': 0, 'superseded': 0, 'resent': 0, 'cancelled': 0, 'disconnected': 0}
+
+    def begin(self, chat_id: str, environ: Optional[Dict[str, any]] = None, key: Optional[str] = None) -> CancelToken:
+        token = CancelToken()
+        superseded: List[CancelToken] = []
+        with self._lock:
+            previous = self._active.get(chat_id)
+            if previous is not None and key is not None and previous.key == key:
+                previous.tokens.append(token)
+                self._stats['resent'] += 1
+            else:
+                self._active[chat_id] = _ChatRequest(key, token)
+                if previous is not None:
+                    superseded = previous.tokens
+            self._stats['started'] += 1
+        if any([previous.cancel('superseded') for previous in superseded]):
+            self._count('superseded')
+            logger.info(f"Cancelled the previous request of chat {chat_id}: superseded")
+        sock = _client_socket(environ) if environ else None
+        if sock is not None:
+            threading.Thread(target=self._watch, args=(chat_id, token, sock),
+                             name='disconnect-watch', daemon=True).start()
+        return token
+
+    def _watch(self, chat_id: str, token: CancelToken, sock: socket.socket):
+        while not token.wait_finished(self.poll_seconds):
+            if token.cancelled:
+                return
+            if client_disconnected(sock):
+                if token.cancel('disconnected'):
+                    self._count('disconnected')
+                    logger.info(f"Client of chat {chat_id} disconnected; cancelling its request")
+                return
+
+    def claim_answer(self, chat_id: str, token: CancelToken) -> bool:
+        """Whether this request records the answer; of a request and its resends only the first does."""
+        with self._lock:
+            active = self._active.get(chat_id)
+            if active is None or token not in active.tokens:
+                return True
+            if active.answered:
+                return False
+            active.answered = True
+            return True
+
+    def finish(self, chat_id: str, token: CancelToken):
+        token.finish()
+        with self._lock:
+            active = self._active.get(chat_id)
+            if active is None or token not in active.tokens:
+                return
+            active.tokens.remove(token)
+            if not active.tokens:
+                del self._active[chat_id]
+
+    def cancel(self, chat_id: str, reason: str = 'client') -> bool:
+        """Cancel the chat's in-flight request and its resends; returns whether there was one."""
+        with self._lock:
+            active = self._active.get(chat_id)
+            tokens = list(active.tokens) if active is not None else []
+        if not any([token.cancel(reason) for token in tokens]):
+            return False
+        self._count('cancelled')
+        logger.info(f"Cancelled the request of chat {chat_id}: {reason}")
+        return True
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'active': len(self._active)}
@@ -0,0 +1,228 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from llm_scheduler import PRIORITY_BACKGROUND
+from model_routes import TASK_SUMMARIZE
+
+logger = logging.getLogger(__name__)
+
+# Messages kept per chat; older ones are dropped once a chat grows past this (e.g. while summaries fail)
+CHAT_SESSION_MAX_MESSAGES = int(os.environ.get('CHAT_SESSION_MAX_MESSAGES', 200))
+# Sessions idle longer than this are forgotten, and the least recently used go first past the cap
+CHAT_SESSION_TTL_SECONDS = float(os.environ.get('CHAT_SESSION_TTL_SECONDS', 24 * 3600))
+CHAT_SESSION_MAX_CHATS = int(os.environ.get('CHAT_SESSION_MAX_CHATS', 1000))
+# The newest turns stay verbatim; older ones are folded into a running summary,
+# a batch of turns at a time so the summary is not rewritten after every answer
+HISTORY_RECENT_TURNS = int(os.environ.get('HISTORY_RECENT_TURNS', 3))
+HISTORY_COMPACT_BATCH_TURNS = int(os.environ.get('HISTORY_COMPACT_BATCH_TURNS', 2))
+
+SUMMARY_PREFIX = 'Summary of the earlier conversation: '
+
+_ROLE_PREFIXES = (('User: ', 'user'), ('Assistant: ', 'assistant'))
+_ROLE_LABELS = {'user': 'User', 'assistant': 'Assistant', 'system': 'Summary'}
+
+
+def parse_history(text: str) -> List[Dict[str, str]]:
+    """Turn a ``User: ...`` / ``Assistant: ...`` transcript into messages.
+
+    Lines without a role prefix continue the previous message, so multi-line
+    messages (code blocks, lists) survive intact.
+    """
+    messages: List[Dict[str, str]] = []
+    for line in (text or '').split('\n'):
+        for prefix, role in _ROLE_PREFIXES:
+            if line.startswith(prefix):
+                messages.append({'role': role, 'content': line[len(prefix):]})
+                break
+        else:
+            if messages:
+                messages[-1]['content'] += '\n' + line
+    for message in messages:
+        message['content'] = message['content'].rstrip('\n')
+    return messages
+
+
+def history_text(messages: List[Dict[str, str]]) -> str:
+    """Transcript form of a history, for prompts that take it as text and for cache keys."""
+    return '\n'.join(f"{_ROLE_LABELS.get(message['role'], 'Assistant')}: {message['content']}" for message in messages)
+
+
+def llm_summarizer(llm_client, model_routes) -> Callable[[str, str, List[Dict[str, str]]], str]:
+    """A ``ChatSessions`` summarizer running the summarize route as background LLM work."""
+
+    def summarize(chat_id: str, summary: str, messages: List[Dict[str, str]]) -> str:
+        route = model_routes.route(TASK_SUMMARIZE)
+        prompt = [
+            {
+                "role": "system",
+                "content": """You maintain the running summary of a conversation between a user and a code
+                assistant about a repository. Merge the new messages into the existing summary.
+                Keep file names, function and class names, decisions, answers given and open questions.
+                Drop pleasantries. Reply with the updated summary only, in at most 200 words."""
+            },
+            {
+                "role": "user",
+                "content": f"""Existing summary:
+                {summary or '(none)'}
+
+                New messages:
+                {history_text(messages)}"""
+            }
+        ]
+        response = llm_client.chat(model=route.model, messages=prompt, chat_id=chat_id,
+                                   priority=PRIORITY_BACKGROUND, options=route.options())
+        return response['message']['content'].strip()
+
+    return summarize
+
+
+class _Session:
+    __slots__ = ('messages', 'summary', 'folded', 'compacting', 'updated_at')
+
+    def __init__(self):
+        self.messages: List[Dict[str, str]] = []
+        self.summary = ''
+        # Messages ever removed from the front of ``messages`` (folded into the summary or dropped)
+        self.folded = 0
+        self.compacting = False
+        self.updated_at = time.time()
+
+
+class ChatSessions:
+    """Conversation history per chat, kept on the server.
+
+    Clients send only the new question; each completed exchange is appended
+    here and the prompt is assembled from the stored messages. With a
+    ``summarize`` function, turns older than the newest ``recent_turns`` are
+    folded into a per-chat running summary by a background thread, so the
+    prompt stays the same size however long the chat runs; the request path
+    only ever reads the cached summary. Sessions live in memory: they expire
+    after ``ttl_seconds`` idle, and the least recently used go first once
+    ``max_chats`` is reached.
+    """
+
+    def __init__(self, summarize: Optional[Callable[[str, str, List[Dict[str, str]]], str]] = None,
+                 recent_turns: int = HISTORY_RECENT_TURNS, compact_batch_turns: int = HISTORY_COMPACT_BATCH_TURNS,
+                 max_messages: int = CHAT_SESSION_MAX_MESSAGES, ttl_seconds: float = CHAT_SESSION_TTL_SECONDS,
+                 max_chats: int = CHAT_SESSION_MAX_CHATS):
+        self.summarize = summarize
+        self.recent_messages = 2 * recent_turns
+        self.compact_batch_messages = 2 * max(1, compact_batch_turns)
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+        self.max_chats = max_chats
+        self._lock = threading.Lock()
+        self._sessions: 'OrderedDict[str, _Session]' = OrderedDict()
+        self._stats = {'exchanges': 0, 'seeded': 0, 'expired': 0, 'evicted': 0,
+                       'compactions': 0, 'compaction_failures': 0, 'messages_summarized': 0}
+
+    def _get(self, chat_id: str, create: bool = False) -> Optional[_Session]:
+        """The live session of a chat; caller holds the lock."""
+        session = self._sessions.get(chat_id)
+        if session is not None and time.time() - session.updated_at > self.ttl_seconds:
+            del self._sessions[chat_id]
+            self._stats['expired'] += 1
+            session = None
+        if session is None and create:
+            session = _Session()
+            self._sessions[chat_id] = session
+            while len(self._sessions) > self.max_chats:
+                self._sessions.popitem(last=False)
+                self._stats['evicted'] += 1
+        if session is not None:
+            self._sessions.move_to_end(chat_id)
+        return session
+
+    @staticmethod
+    def _prompt_history(session: _Session) -> List[Dict[str, str]]:
+        history = [{'role': 'system', 'content': SUMMARY_PREFIX + session.summary}] if session.summary else []
+        return history + [dict(message) for message in session.messages]
+
+    def history(self, chat_id: str) -> List[Dict[str, str]]:
+        """The chat's history for a prompt: the running summary (if any) as a system message, then recent messages."""
+        with self._lock:
+            session = self._get(chat_id)
+            return self._prompt_history(session) if session else []
+
+    def seed(self, chat_id: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Adopt a client-supplied history for a chat the server has no session for.
+
+        Lets clients that still send their transcript (or chats that outlived a
+        server restart) carry on; an existing session always wins.
+        """
+        with self._lock:
+            session = self._get(chat_id, create=True)
+            if not session.messages and not session.summary and messages:
+                session.messages = [{'role': message['role'], 'content': message['content']}
+                                    for message in messages][-self.max_messages:]
+                session.updated_at = time.time()
+                self._stats['seeded'] += 1
+                self._maybe_compact(chat_id, session)
+            return self._prompt_history(session)
+
+    def record_exchange(self, chat_id: str, query: str, answer: str):
+        """Append a question and its answer once the answer is complete."""
+        with self._lock:
+            session = self._get(chat_id, create=True)
+            session.messages.append({'role': 'user', 'content': query})
+            session.messages.append({'role': 'assistant', 'content': answer})
+            overflow = len(session.messages) - self.max_messages
+            if overflow > 0:
+                del session.messages[:overflow]
+                session.folded += overflow
+            session.updated_at = time.time()
+            self._stats['exchanges'] += 1
+            self._maybe_compact(chat_id, session)
+
+    def _maybe_compact(self, chat_id: str, session: _Session):
+        """Start folding old messages into the summary once a batch has built up; caller holds the lock."""
+        if self.summarize is None or session.compacting:
+            return
+        excess = len(session.messages) - self.recent_messages
+        if excess < self.compact_batch_messages:
+            return
+        session.compacting = True
+        threading.Thread(target=self._compact, name='history-compaction', daemon=True,
+                         args=(chat_id, session, session.summary, session.messages[:excess], session.folded + excess)).start()
+
+    def _compact(self, chat_id: str, session: _Session, summary: str, messages: List[Dict[str, str]], folded_through: int):
+        try:
+            new_summary = self.summarize(chat_id, summary, messages)
+            if not new_summary:
+                raise ValueError("Empty summary")
+        except Exception as e:
+            logger.error(f"Error in history compaction for chat {chat_id}: {str(e)}")
+            with self._lock:
+                session.compacting = False
+                self._stats['compaction_failures'] += 1
+            return
+
+        with self._lock:
+            session.compacting = False
+            # The chat may have been cleared or reloaded meanwhile
+            if self._sessions.get(chat_id) is not session:
+                return
+            # Messages appended since are kept; any the size cap already dropped count as folded
+            remove = max(0, folded_through - session.folded)
+            del session.messages[:remove]
+            session.folded = max(session.folded, folded_through)
+            session.summary = new_summary
+            self._stats['compactions'] += 1
+            self._stats['messages_summarized'] += len(messages)
+            logger.info(f"Folded {len(messages)} messages into the summary of chat {chat_id}")
+            self._maybe_compact(chat_id, session)
+
+    def clear(self, chat_id: str):
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'chats': len(self._sessions),
+                    'messages': sum(len(session.messages) for session in self._sessions.values()),
+                    'summarized_chats': sum(1 for session in self._sessions.values() if session.summary),
+                    'compacting': sum(1 for session in self._sessions.values() if session.compacting)}
@@ -0,0 +1,546 @@
+import os
+import re
+import ast
+import mmap
+import logging
+from typing import List, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def make_chunk(lines: List[str], file_path: str, start_line: int, end_line: int,
+               chunk_type: str = 'code_block', name: str = '', parent: str = '') -> Dict[str, any]:
+    """Build a chunk dict for the 1-based, inclusive line span [start_line, end_line]."""
+    return {
+        'content': '\n'.join(lines[start_line - 1:end_line]),
+        'file_path': file_path,
+        'start_line': start_line,
+        'end_line': end_line,
+        'type': chunk_type,
+        'name': name,
+        'parent': parent
+    }
+
+
+def chunk_lines(content: str, file_path: str, chunk_size: int = 1500,
+                lines: Optional[List[str]] = None, first_line: int = 1,
+                last_line: Optional[int] = None, chunk_type: str = 'code_block',
+                name: str = '', parent: str = '') -> List[Dict[str, any]]:
+    """Size-based chunking on line boundaries with correct line spans."""
+    if lines is None:
+        lines = content.split('\n')
+    if last_line is None:
+        last_line = len(lines)
+
+    chunks = []
+    chunk_start = first_line
+    current_length = 0
+
+    for line_no in range(first_line, last_line + 1):
+        line_length = len(lines[line_no - 1]) + 1
+        if current_length + line_length > chunk_size and line_no > chunk_start:
+            chunks.append(make_chunk(lines, file_path, chunk_start, line_no - 1, chunk_type, name, parent))
+            chunk_start = line_no
+            current_length = 0
+        current_length += line_length
+
+    if chunk_start <= last_line:
+        chunks.append(make_chunk(lines, file_path, chunk_start, last_line, chunk_type, name, parent))
+
+    return [chunk for chunk in chunks if chunk['content'].strip()]
+
+
+def _node_start(node: ast.AST) -> int:
+    """First line of a statement, including any decorators."""
+    decorators = getattr(node, 'decorator_list', None)
+    if decorators:
+        return min(d.lineno for d in decorators)
+    return node.lineno
+
+
+class _PythonChunker:
+    """Walks a module's AST once and emits def/class units with exact spans."""
+
+    def __init__(self, lines: List[str], file_path: str, chunk_size: int):
+        self.lines = lines
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.chunks: List[Dict[str, any]] = []
+        # Prefix sums of line lengths so span sizes are O(1) lookups
+        self.offsets = [0]
+        for line in lines:
+            self.offsets.append(self.offsets[-1] + len(line) + 1)
+
+    def span_length(self, start_line: int, end_line: int) -> int:
+        return self.offsets[end_line] - self.offsets[start_line - 1]
+
+    def chunk_body(self, body: List[ast.stmt], parent: str, first_line: int, last_line: int):
+        """Chunk a statement list; code between definitions is grouped into code blocks."""
+        pending_start = first_line
+
+        for node in body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            start = _node_start(node)
+            if start > pending_start:
+                self.emit_block(pending_start, start - 1, parent)
+            self.emit_definition(node, parent)
+            pending_start = node.end_lineno + 1
+
+        if pending_start <= last_line:
+            self.emit_block(pending_start, last_line, parent)
+
+    def emit_block(self, start_line: int, end_line: int, parent: str):
+        self.chunks.extend(chunk_lines('', self.file_path, self.chunk_size, self.lines,
+                                       start_line, end_line, 'code_block', '', parent))
+
+    def emit_definition(self, node: ast.AST, parent: str):
+        start = _node_start(node)
+        end = node.end_lineno
+        chunk_type = 'class' if isinstance(node, ast.ClassDef) else 'function'
+        qualified_name = f"{parent}.{node.name}" if parent else node.name
+
+        if self.span_length(start, end) <= self.chunk_size:
+            self.chunks.append(make_chunk(self.lines, self.file_path, start, end, chunk_type, node.name, parent))
+            return
+
+        # Oversized definition: keep the header with the leading statements, then
+        # split the remaining body at statement boundaries.
+        if isinstance(node, ast.ClassDef):
+            body_start = _node_start(node.body[0])
+            header_end = body_start - 1
+            if header_end >= start:
+                self.chunks.append(make_chunk(self.lines, self.file_path, start, header_end, 'class', node.name, parent))
+            self.chunk_body(node.body, qualified_name, body_start, end)
+        else:
+            self.split_statements(node, start, end, node.name, parent)
+
+    def split_statements(self, node: ast.AST, start: int, end: int, name: str, parent: str):
+        """Group a function's top-level statements into chunks no larger than chunk_size."""
+        chunk_start = start
+        chunk_end = _node_start(node.body[0]) - 1
+        for statement in node.body:
+            statement_start = _node_start(statement)
+            statement_end = statement.end_lineno
+            if (chunk_end >= chunk_start and
+                    self.span_length(chunk_start, statement_end) > self.chunk_size):
+                self.emit_statements(chunk_start, chunk_end, name, parent)
+                chunk_start = statement_start
+            chunk_end = statement_end
+        self.emit_statements(chunk_start, end, name, parent)
+
+    def emit_statements(self, start_line: int, end_line: int, name: str, parent: str):
+        # A single statement can still exceed the budget; only then split it by lines
+        self.chunks.extend(chunk_lines('', self.file_path, self.chunk_size, self.lines,
+                                       start_line, end_line, 'function', name, parent))
+
+
+def chunk_python(content: str, file_path: str, chunk_size: int = 1500) -> List[Dict[str, any]]:
+    """Chunk Python source into def/class units using the ast module.
+
+    Each chunk records its exact 1-based line span, the definition name and
+    the dotted parent scope (e.g. ``Outer.Inner`` for a nested method). Falls
+    back to size-based chunking when the file does not parse.
+    """
+    lines = content.split('\n')
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError) as e:
+        logger.warning(f"Could not parse {file_path} as Python, using line chunking: {str(e)}")
+        return chunk_lines(content, file_path, chunk_size, lines)
+
+    chunker = _PythonChunker(lines, file_path, chunk_size)
+    chunker.chunk_body(tree.body, '', 1, len(lines))
+    return [chunk for chunk in chunker.chunks if chunk['content'].strip()]
+
+
+# Languages whose units are delimited by braces
+C_FAMILY_EXTENSIONS = {
+    '.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx', '.java', '.go',
+    '.c', '.h', '.cpp', '.cc', '.cxx', '.hpp', '.hh', '.cs',
+    '.kt', '.kts', '.scala', '.swift', '.rs', '.php', '.dart'
+}
+
+# Languages where a single quote starts a string rather than a char literal
+SINGLE_QUOTE_STRING_EXTENSIONS = {'.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx', '.php', '.dart'}
+# Languages with /regex/ literals, which may contain unbalanced braces
+REGEX_LITERAL_EXTENSIONS = {'.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx'}
+# Languages where a line break ends a statement (Go inserts the semicolons)
+NEWLINE_TERMINATED_EXTENSIONS = {'.go'}
+
+# A slash after one of these keywords starts a regex; after any other word it divides
+_REGEX_PREFIX_KEYWORDS = {
+    'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void',
+    'throw', 'yield', 'await', 'instanceof'
+}
+_REGEX_LITERAL = r'/(?![*/])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[A-Za-z]*'
+
+_CONTROL_KEYWORDS = {
+    'if', 'for', 'while', 'switch', 'catch', 'with', 'return', 'function', 'sizeof',
+    'do', 'else', 'try', 'finally', 'synchronized', 'foreach', 'using', 'lock', 'new', 'typeof'
+}
+_CLASS_RE = re.compile(
+    r'\b(?:class|interface|struct|enum|namespace|trait|impl|union|object|record|module)\s+([A-Za-z_$][\w$]*)'
+)
+_GO_TYPE_RE = re.compile(r'\btype\s+([A-Za-z_]\w*)\s+(?:struct|interface)\b')
+_GO_FUNC_RE = re.compile(r'\bfunc\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)')
+_RUST_FN_RE = re.compile(r'\bfn\s+([A-Za-z_]\w*)')
+_PROPERTY_FUNCTION_RE = re.compile(r'([A-Za-z_$][\w$]*)\s*[:=]\s*(?:async\s+)?function\b')
+_JS_FUNCTION_RE = re.compile(r'\bfunction\b\s*\*?\s*([A-Za-z_$][\w$]*)?')
+_ARROW_NAME_RE = re.compile(r'([A-Za-z_$][\w$]*)\s*(?::[^=]*)?=\s*(?:async\b)?')
+_CALL_SIGNATURE_RE = re.compile(
+    r'([A-Za-z_$~][\w$]*(?:::~?[A-Za-z_]\w*)*)\s*(?:<[^()]*>)?\s*\((?:[^()]|\([^()]*\))*\)'
+    r'(?:\s*(?:const|noexcept|override|final|async|->\s*[^{;]+|:\s*[^{;()]+|throws\s+[\w.,\s]+))*\s*$'
+)
+
+
+def _classify_header(header: str) -> Tuple[Optional[str], str]:
+    """Decide whether the code before an opening brace declares a class or a function."""
+    header = ' '.join(header.split())
+    if not header or header.count('(') > header.count(')'):
+        # Empty, or a brace inside an unfinished parameter/argument list
+        return None, ''
+    match = _CLASS_RE.search(header) or _GO_TYPE_RE.search(header)
+    if match and '(' not in header[:match.start()]:
+        return 'class', match.group(1)
+    for pattern in (_GO_FUNC_RE, _RUST_FN_RE, _PROPERTY_FUNCTION_RE):
+        match = pattern.search(header)
+        if match:
+            return 'function', match.group(1)
+    match = _JS_FUNCTION_RE.search(header)
+    if match:
+        return 'function', match.group(1) or 'anonymous'
+    if header.endswith('=>'):
+        match = _ARROW_NAME_RE.match(header.split('(')[0].replace('export ', '').replace('const ', '')
+                                     .replace('let ', '').replace('var ', '').strip())
+        return 'function', match.group(1) if match else 'anonymous'
+    match = _CALL_SIGNATURE_RE.search(header)
+    if match and match.group(1).split('::')[-1] not in _CONTROL_KEYWORDS:
+        return 'function', match.group(1)
+    return None, ''
+
+
+def _starts_regex(content: str, position: int) -> bool:
+    """Whether the slash at ``position`` opens a regex literal rather than dividing (or closing a JSX tag)."""
+    end = position - 1
+    while end >= 0 and content[end].isspace():
+        end -= 1
+    if end < 0:
+        return True
+    if content[end] in ')]}<':
+        return False
+    start = end
+    while start >= 0 and (content[start].isalnum() or content[start] in '_$'):
+        start -= 1
+    return start == end or content[start + 1:end + 1] in _REGEX_PREFIX_KEYWORDS
+
+
+def _scan_brace_units(content: str, ext: str) -> List[Dict[str, any]]:
+    """Single linear pass that matches braces while skipping strings, comments, regex and template literals.
+
+    Returns class/function units in source order, each with its span, the
+    line of its opening brace and the index of its enclosing unit.
+    """
+    if ext in SINGLE_QUOTE_STRING_EXTENSIONS:
+        quote = r"'(?:\\.|[^'\\\n])*'?"
+    else:
+        quote = r"'(?:\\.[^'\n]{0,8}|[^'\\\n])'"
+    backtick = '`'
+    regex_literal = '|' + _REGEX_LITERAL if ext in REGEX_LITERAL_EXTENSIONS else ''
+    newline_terminated = ext in NEWLINE_TERMINATED_EXTENSIONS
+    code_token = re.compile(
+        r'//[^\n]*|/\*[\s\S]*?(?:\*/|$)|"(?:\\.|[^"\\\n])*"?|' + quote + regex_literal
+        + r'|`|[{};]' + (r'|\n' if newline_terminated else '')
+    )
+    template_token = re.compile(r'\\[\s\S]|`|\$\{')
+    raw_string_end = re.compile(r'`')
+    template_interpolation = ext not in {'.go'}
+
+    units: List[Dict[str, any]] = []
+    blocks: List[Tuple[str, int, List[str], int]] = []  # (kind, unit index, saved header, header line)
+    in_template = []  # stack of template nesting depth markers
+
+    line = 1
+    line_pos = 0
+    header_parts: List[str] = []
+    header_line = 0
+    pos = 0
+    length = len(content)
+
+    def line_at(position: int) -> int:
+        nonlocal line, line_pos
+        line += content.count('\n', line_pos, position)
+        line_pos = position
+        return line
+
+    def add_code(text: str, start: int):
+        nonlocal header_line
+        if not header_line and text.strip():
+            header_line = line_at(start + len(text) - len(text.lstrip()))
+        header_parts.append(text)
+
+    def reset_header():
+        nonlocal header_line
+        header_parts.clear()
+        header_line = 0
+
+    while pos < length:
+        if in_template and in_template[-1] == 'template':
+            match = template_token.search(content, pos)
+            if not match:
+                break
+            token = match.group()
+            pos = match.end()
+            if token == backtick:
+                in_template.pop()
+            elif token == '${':
+                in_template.append('code')
+                blocks.append(('interpolation', -1, [], 0))
+            continue
+
+        match = code_token.search(content, pos)
+        if not match:
+            break
+        add_code(content[pos:match.start()], pos)
+        token = match.group()
+        pos = match.end()
+
+        if token.startswith('//') or token.startswith('/*'):
+            if not header_parts:
+                header_line = line_at(match.start())
+                header_parts.append(' ')
+            continue
+        if token.startswith('"') or token.startswith("'"):
+            add_code('""', match.start())
+            continue
+        if token.startswith('/'):
+            if _starts_regex(content, match.start()):
+                add_code('""', match.start())
+            else:
+                # A division: only the slash is consumed, the rest is scanned as code
+                pos = match.start() + 1
+                add_code('/', match.start())
+            continue
+        if token == '\n':
+            # Go ends a statement at a line break after a name, literal or closing bracket
+            header = ''.join(header_parts).rstrip()
+            if header and (header[-1].isalnum() or header[-1] in '_)]}"'):
+                reset_header()
+            elif header_parts:
+                header_parts.append(token)
+            continue
+        if token == backtick:
+            add_code('""', match.start())
+            if template_interpolation:
+                in_template.append('template')
+            else:
+                end = raw_string_end.search(content, pos)
+                pos = end.end() if end else length
+            continue
+        if token == ';':
+            reset_header()
+            continue
+        if token == '{':
+            kind, name = _classify_header(''.join(header_parts))
+            open_line = line_at(match.start())
+            unit_index = -1
+            if kind:
+                owner = next((i for _, i, _, _ in reversed(blocks) if i >= 0), -1)
+                units.append({
+                    'type': kind,
+                    'name': name,
+                    'start_line': header_line or open_line,
+                    'open_line': open_line,
+                    'end_line': 0,
+                    'owner': owner
+                })
+                unit_index = len(units) - 1
+            blocks.append((kind or 'block', unit_index, list(header_parts), header_line))
+            reset_header()
+            continue
+        # Closing brace
+        if blocks:
+            kind, unit_index, saved_header, saved_line = blocks.pop()
+            if kind == 'interpolation':
+                in_template.pop()
+                continue
+            if unit_index >= 0:
+                units[unit_index]['end_line'] = line_at(match.start())
+            saved_text = ''.join(saved_header)
+            if kind == 'block' and saved_text.count('(') > saved_text.count(')'):
+                # Braces inside a parameter list (destructuring, default objects):
+                # the declaration header continues after them
+                header_parts[:] = saved_header + ['{}']
+                header_line = saved_line
+                continue
+        reset_header()
+
+    last_line = content.count('\n') + 1
+    for unit in units:
+        if not unit['end_line']:
+            unit['end_line'] = last_line
+    return units
+
+
+def chunk_c_family(content: str, file_path: str, chunk_size: int = 1500) -> List[Dict[str, any]]:
+    """Chunk brace-delimited source (JS/TS/Java/Go/C-family) into function/class units.
+
+    Units that exceed chunk_size are split into a header chunk plus their
+    nested units (methods, inner functions); code between units is grouped
+    into size-bounded code blocks.
+    """
+    lines = content.split('\n')
+    ext = os.path.splitext(file_path)[1].lower()
+    units = _scan_brace_units(content, ext)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line) + 1)
+
+    children: Dict[int, List[int]] = {}
+    for index, unit in enumerate(units):
+        children.setdefault(unit['owner'], []).append(index)
+
+    chunks: List[Dict[str, any]] = []
+
+    def assemble(unit_ids: List[int], first: int, last: int, parent: str):
+        pos = first
+        for unit_id in unit_ids:
+            unit = units[unit_id]
+            start = max(unit['start_line'], pos)
+            end = min(unit['end_line'], last)
+            if start > end:
+                continue
+            if start > pos:
+                chunks.extend(chunk_lines('', file_path, chunk_size, lines, pos, start - 1, 'code_block', '', parent))
+            if offsets[end] - offsets[start - 1] <= chunk_size:
+                chunks.append(make_chunk(lines, file_path, start, end, unit['type'], unit['name'], parent))
+            elif unit_id in children:
+                header_end = max(start, min(unit['open_line'], end))
+                chunks.extend(chunk_lines('', file_path, chunk_size, lines, start, header_end,
+                                          unit['type'], unit['name'], parent))
+                qualified_name = f"{parent}.{unit['name']}" if parent else unit['name']
+                assemble(children[unit_id], header_end + 1, end, qualified_name)
+            else:
+                chunks.extend(chunk_lines('', file_path, chunk_size, lines, start, end,
+                                          unit['type'], unit['name'], parent))
+            pos = end + 1
+        if pos <= last:
+            chunks.extend(chunk_lines('', file_path, chunk_size, lines, pos, last, 'code_block', '', parent))
+
+    assemble(children.get(-1, []), 1, len(lines), '')
+    return [chunk for chunk in chunks if chunk['content'].strip()]
+
+
+def brace_declarations(content: str, file_path: str) -> List[Dict[str, any]]:
+    """Class/function declarations of a brace-delimited source file, in source order.
+
+    Each carries its type, name, span, the line of its opening brace and its
+    nesting ``depth`` (0 for top-level declarations).
+    """
+    units = _scan_brace_units(content, os.path.splitext(file_path)[1].lower())
+    for unit in units:
+        unit['depth'] = units[unit['owner']]['depth'] + 1 if unit['owner'] >= 0 else 0
+    return units
+
+
+def chunk_file(content: str, file_path: str, chunk_size: int = 1500) -> List[Dict[str, any]]:
+    """Pick the structure-aware chunker for a file, falling back to line chunking."""
+    _, ext = os.path.splitext(file_path)
+    ext = ext.lower()
+    if ext in {'.py', '.pyi'}:
+        return chunk_python(content, file_path, chunk_size)
+    if ext in C_FAMILY_EXTENSIONS:
+        return chunk_c_family(content, file_path, chunk_size)
+    return chunk_lines(content, file_path, chunk_size)
+
+
+def read_text_sample(file_path: str, size: int = 8192) -> str:
+    """Read the first ``size`` bytes of a file as text without loading the rest."""
+    with open(file_path, 'rb') as f:
+        return f.read(size).decode('utf-8', errors='ignore')
+
+
+def iter_large_file_chunks(file_path: str, relative_path: str, chunk_size: int = 1500,
+                           max_chunks: int = 2000, max_line_bytes: int = 16384):
+    """Stream line-aligned chunks from a large text file through mmap.
+
+    Only one chunk is decoded at a time, so memory stays flat regardless of
+    file size. Chunks end on a newline when one falls within the window
+    (or within ``max_line_bytes`` after it for very long lines) and carry
+    exact line spans. At most ``max_chunks`` chunks are produced per file.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            pos = 0
+            line = 1
+            emitted = 0
+            while pos < size and emitted < max_chunks:
+                end = min(pos + chunk_size, size)
+                if end < size:
+                    newline = mapped.rfind(b'\n', pos, end)
+                    if newline != -1:
+                        end = newline + 1
+                    else:
+                        newline = mapped.find(b'\n', end, min(end + max_line_bytes, size))
+                        end = newline + 1 if newline != -1 else min(end + max_line_bytes, size)
+                raw = mapped[pos:end]
+                newlines = raw.count(b'\n')
+                text = raw.decode('utf-8', errors='replace')
+                if text.strip():
+                    end_line = line + newlines - (1 if raw.endswith(b'\n') else 0)
+                    yield {
+                        'content': text[:-1] if text.endswith('\n') else text,
+                        'file_path': relative_path,
+                        'start_line': line,
+                        'end_line': max(line, end_line),
+                        'type': 'code_block',
+                        'name': '',
+                        'parent': ''
+                    }
+                    emitted += 1
+                line += newlines
+                pos = end
+
+
+def extract_functions_and_classes(content: str) -> List[Dict[str, any]]:
+    """Extract functions and classes from code content using line regexes.
+
+    Kept for non-Python files in bolt_app.py and as the baseline in
+    bench_chunkers.py.
+    """
+    structures = []
+    lines = content.split('\n')
+    current_structure = None
+
+    # Regex patterns for different programming languages
+    patterns = {
+        'python': r'^\s*(def|class)\s+(\w+)',
+        'javascript': r'^\s*(function|class)\s+(\w+)|^\s*(\w+)\s*=\s*(async\s*)?function',
+        'java': r'^\s*(public|private|protected)?\s*(static\s+)?(class|interface|enum)\s+(\w+)|^\s*(public|private|protected)?\s*(static\s+)?\w+\s+(\w+)\s*\(',
+    }
+
+    for i, line in enumerate(lines):
+        for lang, pattern in patterns.items():
+            match = re.match(pattern, line)
+            if match:
+                if current_structure:
+                    current_structure['end_line'] = i
+                    structures.append(current_structure)
+
+                current_structure = {
+                    'type': match.group(1) if match.group(1) else 'function',
+                    'name': match.group(2) if match.group(2) else match.group(0),
+                    'start_line': i + 1,
+                    'content': line,
+                    'language': lang
+                }
+                break
+
+    if current_structure:
+        current_structure['end_line'] = len(lines)
+        structures.append(current_structure)
+
+    return structures
@@ -1,13 +1,25 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
+import time
 import tempfile
 from urllib.parse import urlparse
 import git
 import logging
-import httpx
-import ollama
-from datetime import datetime
+from typing import List, Optional, Tuple
+from repo_store import RepoContentStore
+from context_packer import ContextPacker, estimate_tokens, fit_history, truncate_text
+from prompt_layout import build_messages, prefix_digest
+from repo_outline import build_outline
+from index_registry import normalize_repo_url, resolve_commit_sha
+from streaming import sse_response, stream_chat_events, cached_answer_events, with_answer, join_stream
+from answer_cache import AnswerCache, answer_scope
+from chat_sessions import ChatSessions, llm_summarizer, parse_history, history_text
+from cancellation import CancelToken, ChatCancellations, RequestCancelled
+from deadlines import Deadline, DEGRADE_SMALLER_CONTEXT
+from single_flight import SingleFlight, flight_key
+from llm_scheduler import get_llm_scheduler, llm_stats, SchedulerBusy
+from model_routes import load_model_routes, TASK_ANSWER
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -16,39 +28,65 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-# Store repository contents
-repo_contents = {}
-
 OLLAMA_URL = 'https://5055-35-247-164-214.ngrok-free.app/'
-
-# Create directory for storing repository text files
-REPO_FILES_DIR = 'typescript_repos'
-if not os.path.exists(REPO_FILES_DIR):
-    os.makedirs(REPO_FILES_DIR)
-
-def save_repo_to_file(chat_id: str, content: str) -> str:
-    """
-    Save repository contents to a text file.
-    Returns the path to the created file.
-    """
+llm_client = get_llm_scheduler(OLLAMA_URL)
+chat_flights = SingleFlight()
+chat_cancellations = ChatCancellations()
+
+# Repository snapshots live on disk, bounded by a quota and an idle-chat TTL;
+# only the hottest rendered repos stay in memory
+REPO_STORE_DIR = 'typescript_repo_store'
+HOT_REPO_CACHE_MB = 256
+repo_store = RepoContentStore(
+    REPO_STORE_DIR, hot_cache_bytes=HOT_REPO_CACHE_MB * 1024 * 1024,
+    disk_quota_bytes=int(os.environ.get('REPO_STORE_QUOTA_MB', 2048)) * 1024 * 1024,
+    chat_ttl_seconds=int(os.environ.get('CHAT_TTL_DAYS', 14)) * 24 * 3600
+)
+
+# Answers use the code2 model (num_ctx in the Modelfile); deployments can re-route each task
+model_routes = load_model_routes({
+    TASK_ANSWER: {'model': 'code2', 'max_tokens': 1500, 'context_tokens': 8000},
+}, serves=llm_client.pool.serves)
+CHAT_MODEL = model_routes.model(TASK_ANSWER)
+# Older turns are summarized in the background by the summarize route's model
+chat_sessions = ChatSessions(llm_summarizer(llm_client, model_routes))
+
+# Prompt budget for the answer model; the answer's own tokens are reserved out of it
+MODEL_CONTEXT_TOKENS = model_routes.route(TASK_ANSWER).context_tokens or 8000
+ANSWER_RESERVE_TOKENS = model_routes.route(TASK_ANSWER).max_tokens or 1500
+HISTORY_MAX_TOKENS = 1500
+# Per-message chat template overhead
+MESSAGE_OVERHEAD_TOKENS = 4
+# Room left for each turn's question and most relevant files once the pinned prefix and history are in
+TURN_RESERVE_TOKENS = 1500
+# The stable prompt prefix (instructions plus the whole repository, or its outline) gets the rest
+PINNED_CONTEXT_TOKENS = MODEL_CONTEXT_TOKENS - ANSWER_RESERVE_TOKENS - HISTORY_MAX_TOKENS - TURN_RESERVE_TOKENS
+# Share of the pinned budget the repository outline may take when the files do not all fit
+OUTLINE_BUDGET_SHARE = 0.4
+# A request with less time left than this packs only a share of the per-turn files
+FULL_CONTEXT_MIN_SECONDS = 20
+REDUCED_CONTEXT_SHARE = 0.5
+
+# Files are also ranked by embedding similarity when the encoder loads; None disables it
+PACKER_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+def load_packer_embedder():
+    """Return an embedding function for the context packer, or None if unavailable."""
+    if not PACKER_EMBEDDING_MODEL:
+        return None
     try:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"ts_repo_{chat_id}_{timestamp}.txt"
-        file_path = os.path.join(REPO_FILES_DIR, filename)
-        
-        with open(file_path, 'w', encoding='utf-8') as f:
-            # Add a header with metadata
-            f.write(f"TypeScript Repository Contents\n")
-            f.write(f"Chat ID: {chat_id}\n")
-            f.write(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("=" * 80 + "\n\n")
-            f.write(content)
-            
-        logger.info(f"Saved TypeScript repository contents to {file_path}")
-        return file_path
+        from sentence_transformers import SentenceTransformer
+        encoder = SentenceTransformer(PACKER_EMBEDDING_MODEL)
+        return lambda texts: encoder.encode(texts, batch_size=64, show_progress_bar=False)
     except Exception as e:
-        logger.error(f"Error saving repository to file: {str(e)}")
-        raise
+        logger.warning(f"Context packer will rank without embeddings: {str(e)}")
+        return None
+
+packer_embedder = load_packer_embedder()
+# Per-snapshot ranking profiles kept in memory
+PACKER_CACHE_MB = 64
+context_packer = ContextPacker(estimate_tokens, packer_embedder, cache_bytes=PACKER_CACHE_MB * 1024 * 1024)
+answer_cache = AnswerCache(packer_embedder)
 
 def is_typescript_or_package_file(file_path: str) -> bool:
     """Check if the file is a TypeScript file or package.json."""
@@ -70,6 +108,10 @@ def is_binary_or_large_file(file_path: str, max_size_mb: int = 1) -> bool:
     except (UnicodeDecodeError, IOError):
         return True
 
+def warm_packer(chat_id: str, repo_key: str):
+    """Profile and embed a stored snapshot in the background, so the first question does not pay for it."""
+    context_packer.warm(repo_key, lambda: repo_store.iter_files(chat_id))
+
 def process_repository(repo_url: str, chat_id: str):
     """Process repository and store its TypeScript and package.json contents."""
     try:
@@ -77,6 +119,13 @@ def process_repository(repo_url: str, chat_id: str):
         if not parsed_url.scheme or not parsed_url.netloc or not parsed_url.path:
             raise ValueError("Invalid GitHub repository URL")
 
+        # A snapshot of this repo@commit (with its outline) may already be stored
+        normalized_url = normalize_repo_url(repo_url)
+        repo_key = repo_store.attach_commit(chat_id, normalized_url, resolve_commit_sha(repo_url))
+        if repo_key:
+            warm_packer(chat_id, repo_key)
+            return
+
         repo_name = os.path.splitext(parsed_url.path.split('/')[-1])[0]
         logger.info(f"Processing TypeScript repository: {repo_name}")
 
@@ -91,6 +140,7 @@ def process_repository(repo_url: str, chat_id: str):
             try:
                 repo = git.Repo.clone_from(repo_url, os.path.join(temp_dir, repo_name))
                 logger.info(f"Cloned repository: {repo_name}")
+                commit_sha = repo.head.commit.hexsha
             except git.exc.GitCommandError as e:
                 logger.error(f"Git clone failed: {str(e)}")
                 raise ValueError("Failed to clone repository. Please check the URL and try again.")
@@ -99,10 +149,8 @@ def process_repository(repo_url: str, chat_id: str):
             files_content = []
             processed_files = 0
             
-            # Add repository information
-            files_content.append(f"Repository: {repo_url}")
-            files_content.append(f"Repository Name: {repo_name}")
-            files_content.append("=" * 80 + "\n")
+            # Repository information rendered before the files
+            header = "\n".join([f"Repository: {repo_url}", f"Repository Name: {repo_name}", "=" * 80 + "\n"])
             
             # First, look for package.json
             package_json_path = os.path.join(temp_dir, repo_name, 'package.json')
@@ -110,10 +158,7 @@ def process_repository(repo_url: str, chat_id: str):
                 try:
                     with open(package_json_path, "r", encoding="utf-8") as content_file:
                         content = content_file.read()
-                        files_content.append(f"\nFile: package.json")
-                        files_content.append("-" * 80)
-                        files_content.append(content)
-                        files_content.append("=" * 80 + "\n")
+                        files_content.append(('package.json', content))
                         processed_files += 1
                 except UnicodeDecodeError:
                     logger.warning("Could not read package.json")
@@ -135,11 +180,7 @@ def process_repository(repo_url: str, chat_id: str):
                             if not content.strip():
                                 continue
                             
-                            # Add file metadata and content
-                            files_content.append(f"\nFile: {relative_path}")
-                            files_content.append("-" * 80)
-                            files_content.append(content)
-                            files_content.append("=" * 80 + "\n")
+                            files_content.append((relative_path, content))
                             processed_files += 1
                                 
                     except UnicodeDecodeError:
@@ -149,52 +190,99 @@ def process_repository(repo_url: str, chat_id: str):
             if processed_files == 0:
                 raise ValueError("No valid TypeScript files found in the repository")
 
-            # Join all content with proper formatting
-            full_content = "\n".join(files_content)
-            
-            # Store in memory
-            repo_contents[chat_id] = full_content
-            
-            # Save to file (can be commented out if not needed)
-            save_repo_to_file(chat_id, full_content)
+            # Compressed on disk with its outline; rendered back to the same text on demand
+            repo_key = repo_store.put(chat_id, normalized_url, header, files_content,
+                                      commit_sha=commit_sha, outline=build_outline(files_content))
+            warm_packer(chat_id, repo_key)
 
     except Exception as e:
         logger.error(f"Error in process_repository: {str(e)}")
         raise
 
-def generate_response(chat_id: str, conversation_history: str, query: str) -> str:
-    """Generate a response using the entire TypeScript codebase context."""
-    try:
-        if chat_id not in repo_contents:
-            raise ValueError("Repository not loaded. Please load a repository first.")
+def prepare_chat(chat_id: str, history: List[dict], query: str,
+                 deadline: Optional[Deadline] = None) -> Tuple[List[dict], dict]:
+    """Build the chat messages: a pinned per-snapshot prefix, the history, then this turn's files.
 
+    Returns the messages and packing metadata for streaming clients.
+    """
+    try:
         system_message = """You are a TypeScript expert analyzing a GitHub repository. 
-        Provide a comprehensive answer based on the TypeScript codebase content.
+        Provide a comprehensive answer based on the TypeScript codebase content below. Small
+        repositories are shown in full; larger ones are summarized by an outline, and the files most
+        relevant to each question are shown in full alongside it.
         Consider TypeScript-specific features, types, and patterns in your analysis.
         When referring to specific files or code sections, mention the file names for clarity."""
 
-        context = f"Repository contents:\n{repo_contents[chat_id]}"
+        # The running summary always stays; the newest turns fill the rest of the history budget
+        summary = [message for message in history if message['role'] == 'system']
+        turns = [message for message in history if message['role'] != 'system']
+        summary_tokens = sum(estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS for message in summary)
+        history = summary + fit_history(turns, max(0, HISTORY_MAX_TOKENS - summary_tokens))
+
+        # The pinned prefix depends only on the snapshot, never on the question or history, so
+        # Ollama reuses its KV cache across turns: the whole repository when it fits, else the outline
+        profile = context_packer.profile(repo_store.snapshot_key(chat_id), lambda: repo_store.iter_files(chat_id))
+        header = repo_store.get_header(chat_id)
+        outline = repo_store.get_outline(chat_id)
+        pinned_budget = max(0, PINNED_CONTEXT_TOKENS - estimate_tokens(system_message))
+        pin_everything = estimate_tokens(header) + sum(profile.token_counts) <= pinned_budget
+        if pin_everything:
+            # Rendered once and kept in the store's hot cache
+            pinned = repo_store.get_content(chat_id)
+        elif outline:
+            pinned = header + f"\nRepository outline:\n{truncate_text(outline, int(pinned_budget * OUTLINE_BUDGET_SHARE), estimate_tokens)}\n"
+        else:
+            pinned = header
+        prefix = f"{system_message}\nRepository contents:\n{pinned}"
+
+        # Whatever the answer, prefix, history and question leave is filled with the files most relevant to this turn
+        fixed_tokens = sum(estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS for message in history)
+        fixed_tokens += estimate_tokens(prefix) + estimate_tokens(query) + 3 * MESSAGE_OVERHEAD_TOKENS
+        budget = max(0, MODEL_CONTEXT_TOKENS - ANSWER_RESERVE_TOKENS - fixed_tokens)
+        if pin_everything:
+            packed = {'text': '', 'included': list(profile.paths), 'truncated': None, 'omitted': [], 'tokens': 0}
+        else:
+            if deadline is not None and deadline.remaining() < FULL_CONTEXT_MIN_SECONDS:
+                # The pinned prefix is already evaluated; a shorter turn is what saves time
+                budget = int(budget * REDUCED_CONTEXT_SHARE)
+                deadline.degrade(DEGRADE_SMALLER_CONTEXT)
+            packed = context_packer.pack(profile, query, budget, lambda path: repo_store.read_file(chat_id, path),
+                                         list_omitted=not outline)
+        logger.info(f"Pinned ~{estimate_tokens(prefix)} prefix tokens, packed {len(packed['included'])} files "
+                    f"(~{packed['tokens']} tokens), truncated {packed['truncated'] or 'none'}, omitted {len(packed['omitted'])}")
+
+        messages = build_messages(prefix, history, query, packed['text'])
+
+        metadata = {
+            'included': packed['included'],
+            'truncated': packed['truncated'],
+            'omitted': len(packed['omitted']),
+            'context_tokens': packed['tokens'],
+            'pinned_tokens': estimate_tokens(prefix),
+            'prefix': prefix_digest(messages),
+            'outline': bool(outline) and not pin_everything
+        }
+        return messages, metadata
 
-        messages = [
-            {"role": "system", "content": f"{system_message}\n{context}"}
-        ]
+    except Exception as e:
+        logger.error(f"Error in prepare_chat: {str(e)}")
+        raise
 
-        # Add conversation history
-        if conversation_history:
-            for line in conversation_history.split('\n'):
-                if line.startswith('User: '):
-                    messages.append({"role": "user", "content": line[6:]})
-                elif line.startswith('Assistant: '):
-                    messages.append({"role": "assistant", "content": line[11:]})
+def generate_response(chat_id: str, history: List[dict], query: str, cancel: Optional[CancelToken] = None,
+                      deadline: Optional[Deadline] = None) -> Tuple[str, dict]:
+    """Generate a response from the TypeScript files most relevant to the query."""
+    try:
+        deadline = deadline or Deadline()
+        messages, metadata = prepare_chat(chat_id, history, query, deadline)
 
-        messages.append({"role": "user", "content": query})
+        # Streamed and joined, so a cancelled request stops the model mid-answer
+        chunks = llm_client.chat_stream(CHAT_MODEL, messages, chat_id=chat_id, cancel=cancel,
+                                        max_wait=deadline.queue_wait(),
+                                        options=deadline.answer_options(model_routes.options(TASK_ANSWER)))
+        answer = join_stream(chunks, cancel, deadline)
 
-        with httpx.Client(verify=False) as client:
-            ollama_client = ollama.Client(host=OLLAMA_URL)
-            response = ollama_client.chat(model='code2', messages=messages)
-        
         logger.info("Generated response using full TypeScript repository context")
-        return response['message']['content']
+        return answer, metadata
 
     except Exception as e:
         logger.error(f"Error in generate_response: {str(e)}")
@@ -216,6 +304,8 @@ def load_repo():
 
         logger.info(f"Loading TypeScript repository: {repo_url} for chat: {chat_id}")
         process_repository(repo_url, chat_id)
+        # A (re)loaded chat starts a fresh conversation
+        chat_sessions.clear(chat_id)
         return jsonify({'status': 'success'})
 
     except ValueError as e:
@@ -235,14 +325,11 @@ def get_files():
 
         chat_id = data['chat_id']
         
-        if chat_id not in repo_contents:
+        if not repo_store.has(chat_id):
             return jsonify({'files': []})
         
-        # Extract file names from the stored content
-        files = []
-        for line in repo_contents[chat_id].split('\n'):
-            if line.startswith('File: '):
-                files.append(line[6:].strip())
+        # File names come from the store's index; nothing is decompressed
+        files = [entry['path'] for entry in repo_store.list_files(chat_id)]
         
         return jsonify({'files': sorted(set(files))})
 
@@ -250,9 +337,55 @@ def get_files():
         logger.error(f"Error getting files: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/delete-chat', methods=['POST'])
+def delete_chat():
+    """Drop a chat's repository snapshot reference."""
+    try:
+        data = request.json
+        if not data or not data.get('chat_id'):
+            return jsonify({'error': 'chat_id is required'}), 400
+
+        chat_cancellations.cancel(data['chat_id'], 'deleted')
+        repo_store.delete_chat(data['chat_id'])
+        chat_sessions.clear(data['chat_id'])
+        return jsonify({'status': 'success'})
+
+    except Exception as e:
+        logger.error(f"Server error in delete_chat: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Repository store and LLM client statistics."""
+    try:
+        return jsonify({'repo_store': repo_store.stats(), 'context_packer': context_packer.cache_stats(), 'llm': llm_stats(), 'coalescing': chat_flights.stats(), 'answer_cache': answer_cache.stats(),
+                        'model_routes': model_routes.table(),
+                        'chat_sessions': chat_sessions.stats(),
+                        'cancellation': chat_cancellations.stats()})
+    except Exception as e:
+        logger.error(f"Server error in stats: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+@app.route('/cancel', methods=['POST'])
+def cancel_chat():
+    """Stop a chat's in-flight request: its retrieval, queued LLM calls and generation."""
+    try:
+        data = request.json
+        if not data or not data.get('chat_id'):
+            return jsonify({'error': 'chat_id is required'}), 400
+
+        cancelled = chat_cancellations.cancel(data['chat_id'])
+        return jsonify({'status': 'success', 'cancelled': cancelled})
+
+    except Exception as e:
+        logger.error(f"Server error in cancel_chat: {str(e)}")
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
 @app.route('/chat', methods=['POST'])
 def chat_endpoint():
     """Handle chat requests about TypeScript code."""
+    cancel = None
+    streaming = False
     try:
         data = request.json
         if not data:
@@ -260,21 +393,101 @@ def chat_endpoint():
 
         query = data.get('query')
         chat_id = data.get('chat_id')
-        conversation_history = data.get('conversation_history', '')
 
         if not query or not chat_id:
             return jsonify({'error': 'query and chat_id are required'}), 400
 
         logger.info(f"Processing TypeScript chat query for chat: {chat_id}")
-        response = generate_response(chat_id, conversation_history, query)
-        return jsonify({'response': response})
-
+        started_at = time.perf_counter()
+        # Stages shorten or skip work as the time budget runs out
+        deadline = Deadline.from_request(data)
+        # History lives on the server; a transcript is only adopted for chats without a session
+        history = chat_sessions.history(chat_id)
+        if not history and data.get('conversation_history'):
+            history = chat_sessions.seed(chat_id, parse_history(data['conversation_history']))
+        conversation_history = history_text(history)
+        index_version = repo_store.snapshot_key(chat_id)
+        scope = answer_scope(index_version, CHAT_MODEL, conversation_history)
+        cached = None
+        if data.get('no_cache'):
+            answer_cache.record_bypass()
+        else:
+            cached = answer_cache.lookup(scope, query)
+
+        # Identical in-flight questions about the same snapshot share one generation
+        key = flight_key(index_version, query, conversation_history)
+        # A different message for the chat, an explicit /cancel or a client disconnect stops this
+        # request; an identical resend (a double submit) joins it instead
+        cancel = chat_cancellations.begin(chat_id, request.environ, key)
+
+        def record(answer: str):
+            if chat_cancellations.claim_answer(chat_id, cancel):
+                chat_sessions.record_exchange(chat_id, query, answer)
+
+        def store(answer: str, metadata: dict):
+            # A degraded answer is not the one a relaxed request would get
+            if not deadline.degradations:
+                answer_cache.store(scope, query, answer, metadata)
+
+        def finish():
+            chat_cancellations.finish(chat_id, cancel)
+
+        if data.get('stream'):
+            if cached:
+                streaming = True
+                return sse_response(with_answer(cached_answer_events(cached, CHAT_MODEL, started_at), record), on_close=finish)
+
+            def open_stream(flight_cancel: CancelToken):
+                # Packing runs before the stream opens so its errors still map to status codes
+                messages, metadata = prepare_chat(chat_id, history, query, deadline)
+                flight_cancel.raise_if_cancelled()
+                chunks = llm_client.chat_stream(CHAT_MODEL, messages, chat_id=chat_id, cancel=flight_cancel,
+                                                max_wait=deadline.queue_wait(),
+                                                options=deadline.answer_options(model_routes.options(TASK_ANSWER)))
+                events = stream_chat_events(chunks, CHAT_MODEL, metadata, started_at,
+                                            on_complete=lambda answer: store(answer, metadata), deadline=deadline)
+                return events, chunks.close
+
+            subscription = chat_flights.stream(key, open_stream, cancel)
+            streaming = True
+
+            def close():
+                # A client gone before the body was iterated never closes the generators
+                subscription.close()
+                finish()
+
+            return sse_response(with_answer(subscription, record), on_close=close)
+
+        if cached:
+            record(cached['answer'])
+            return jsonify({'response': cached['answer'], 'cached': True})
+
+        def compute():
+            answer, metadata = generate_response(chat_id, history, query, cancel, deadline)
+            store(answer, metadata)
+            return answer
+
+        response = chat_flights.run(key, compute)
+        record(response)
+        return jsonify({'response': response, 'deadline': deadline.report()})
+
+    except RequestCancelled as e:
+        logger.info(f"Stopped chat_endpoint: {str(e)}")
+        return jsonify({'error': 'Request cancelled'}), 499
+
+    except SchedulerBusy as e:
+        logger.warning(f"LLM busy in chat_endpoint: {str(e)}")
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), 503, {'Retry-After': str(e.retry_after)}
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}")
         return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Server error in chat_endpoint: {str(e)}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
+    finally:
+        # Streaming responses finish when the response closes
+        if cancel is not None and not streaming:
+            chat_cancellations.finish(chat_id, cancel)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,372 @@
+import re
+import math
+import threading
+import logging
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FILE_SEPARATOR = "=" * 80
+HEADER_SEPARATOR = "-" * 80
+
+# Relative weights of the ranking signals; embedding weight is redistributed when no encoder is given
+PATH_WEIGHT = 0.3
+LEXICAL_WEIGHT = 0.4
+EMBEDDING_WEIGHT = 0.3
+# Small prior so overview questions still start from READMEs and top-level files
+README_PRIOR = 0.1
+DEPTH_PRIOR = 0.05
+
+# How much of a file's head is embedded to represent it
+EMBED_CHARS = 1000
+# Rough memory of one term-count entry (key string plus dict slot), for the profile cache bound
+TERM_ENTRY_BYTES = 100
+# Files truncated to fit are only worth including with at least this many tokens
+MIN_PARTIAL_TOKENS = 200
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_WORD_RE = re.compile(r'\w+')
+_TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+_CAMEL_RE = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+_STOPWORDS = {
+    'the', 'and', 'for', 'how', 'what', 'does', 'this', 'that', 'with', 'from', 'are', 'is',
+    'where', 'which', 'when', 'why', 'can', 'you', 'explain', 'code', 'file', 'files', 'repo',
+    'repository', 'use', 'used', 'work', 'works', 'into', 'there', 'about', 'show', 'tell'
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Conservative token estimate for code when the model's tokenizer is not available.
+
+    Words count one token per four characters and every punctuation mark
+    counts as one, which slightly overestimates BPE tokenizers on source code.
+    """
+    total = 0
+    for token in _TOKEN_RE.findall(text):
+        total += (len(token) + 3) // 4 if token[0].isalnum() or token[0] == '_' else 1
+    return total + text.count('\n') // 4
+
+
+def split_terms(text: str) -> List[str]:
+    """Lowercased search terms, with snake_case and camelCase identifiers split apart."""
+    terms = []
+    for word in _WORD_RE.findall(text):
+        parts = [part for piece in word.split('_') for part in _CAMEL_RE.findall(piece)] or [word]
+        for term in {word.lower(), *(part.lower() for part in parts)}:
+            if len(term) >= 3 and term not in _STOPWORDS:
+                terms.append(term)
+    return terms
+
+
+def render_file(path: str, content: str) -> str:
+    """Render one file the way full-context prompts show it."""
+    return "\n".join([f"\nFile: {path}", HEADER_SEPARATOR, content, FILE_SEPARATOR + "\n"])
+
+
+class RepoProfile:
+    """Per-snapshot statistics the packer reuses across queries.
+
+    Term frequencies, rendered token counts and file embeddings are computed
+    once per repository snapshot instead of once per question. File texts
+    are not kept: the packer reads the files it includes back from the
+    store. ``embeddings`` stays None until the background embedding pass
+    finishes.
+    """
+
+    def __init__(self, files: Iterable[Tuple[str, str]], count_tokens: Callable[[str], int]):
+        self.paths: List[str] = []
+        self.term_counts: List[Counter] = []
+        self.token_counts: List[int] = []
+        # File heads waiting to be embedded; dropped once the embeddings exist
+        self.heads: Optional[List[str]] = []
+        for path, content in files:
+            self.paths.append(path)
+            self.term_counts.append(Counter(split_terms(content)))
+            self.token_counts.append(count_tokens(render_file(path, content)))
+            self.heads.append(f"{path}\n{content[:EMBED_CHARS]}")
+        self.path_terms = [set(split_terms(path)) for path in self.paths]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        self.document_frequency = Counter(term for counts in self.term_counts for term in counts)
+        self.embeddings: Optional[np.ndarray] = None
+        self._base_bytes = TERM_ENTRY_BYTES * (sum(len(counts) for counts in self.term_counts)
+                                               + len(self.document_frequency)) + sum(len(path) for path in self.paths)
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the profile."""
+        size = self._base_bytes
+        if self.heads:
+            size += sum(len(head) for head in self.heads)
+        if self.embeddings is not None:
+            size += self.embeddings.nbytes
+        return size
+
+
+class ContextPacker:
+    """Selects and orders repository files to fill a prompt's token budget exactly.
+
+    Files are ranked by a blend of path matches, BM25 over file contents and,
+    when an ``embed`` function is given, cosine similarity between the query
+    and each file's head. The best files are included whole while they fit;
+    the first one that does not is cut on a line boundary to use the rest of
+    the budget, and the paths of everything left out are listed if room
+    remains.
+
+    Profiles are cached up to ``cache_bytes`` (the most recently used one
+    is always kept). ``warm`` builds a snapshot's profile in the background
+    when the repository is loaded, and file embeddings are always computed
+    on a background thread; until they exist, ranking uses the path and
+    lexical signals only.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int] = estimate_tokens,
+                 embed: Optional[Callable[[List[str]], np.ndarray]] = None, cache_bytes: int = 64 * 1024 * 1024):
+        self.count_tokens = count_tokens
+        self.embed = embed
+        self.cache_bytes = cache_bytes
+        self._profiles: 'OrderedDict[str, RepoProfile]' = OrderedDict()
+        self._building: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def profile(self, key: str, load_files: Callable[[], Iterable[Tuple[str, str]]]) -> RepoProfile:
+        """The cached profile for a snapshot, built from ``load_files()`` on a miss.
+
+        A request arriving while the profile is being built (e.g. by ``warm``) waits for that build.
+        """
+        while True:
+            with self._lock:
+                if key in self._profiles:
+                    self._profiles.move_to_end(key)
+                    return self._profiles[key]
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = threading.Event()
+                    break
+            building.wait()
+
+        try:
+            profile = RepoProfile(load_files(), self.count_tokens)
+            with self._lock:
+                self._profiles[key] = profile
+                self._evict()
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+            building.set()
+        if self.embed is not None and profile.heads:
+            threading.Thread(target=self._embed_files, args=(profile,), name='packer-embed', daemon=True).start()
+        else:
+            profile.heads = None
+        return profile
+
+    def warm(self, key: str, load_files: Callable[[], Iterable[Tuple[str, str]]]):
+        """Build a snapshot's profile (and start its embeddings) on a background thread."""
+
+        def build():
+            try:
+                self.profile(key, load_files)
+            except Exception as e:
+                logger.error(f"Error in ContextPacker.warm: {str(e)}")
+
+        threading.Thread(target=build, name='packer-warm', daemon=True).start()
+
+    def _embed_files(self, profile: RepoProfile):
+        try:
+            profile.embeddings = _normalize(np.asarray(self.embed(profile.heads), dtype=np.float32))
+        except Exception as e:
+            # Ranking still works on path and lexical signals
+            logger.warning(f"File embeddings unavailable: {str(e)}")
+        finally:
+            profile.heads = None
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used profiles over the byte bound; caller holds the lock."""
+        total = sum(profile.nbytes() for profile in self._profiles.values())
+        while total > self.cache_bytes and len(self._profiles) > 1:
+            _, evicted = self._profiles.popitem(last=False)
+            total -= evicted.nbytes()
+
+    def cache_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'profiles': len(self._profiles),
+                    'bytes': sum(profile.nbytes() for profile in self._profiles.values()),
+                    'building': len(self._building)}
+
+    def _embedding_scores(self, profile: RepoProfile, query: str) -> Optional[np.ndarray]:
+        embeddings = profile.embeddings
+        if self.embed is None or embeddings is None or not profile.paths:
+            return None
+        try:
+            query_vector = _normalize(np.asarray(self.embed([query]), dtype=np.float32))[0]
+            return embeddings @ query_vector
+        except Exception as e:
+            # Ranking still works on path and lexical signals
+            logger.warning(f"Embedding ranking unavailable: {str(e)}")
+            return None
+
+    def rank(self, profile: RepoProfile, query: str) -> List[Tuple[float, int]]:
+        """``(score, file_index)`` pairs, best first."""
+        terms = set(split_terms(query))
+        count = len(profile.paths)
+        path_scores = np.zeros(count)
+        lexical_scores = np.zeros(count)
+        for index in range(count):
+            if terms:
+                path_scores[index] = len(terms & profile.path_terms[index]) / len(terms)
+            counts = profile.term_counts[index]
+            length_norm = 1 - BM25_B + BM25_B * profile.lengths[index] / (profile.average_length or 1)
+            for term in terms:
+                frequency = counts.get(term)
+                if not frequency:
+                    continue
+                df = profile.document_frequency[term]
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                lexical_scores[index] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+
+        embedding_scores = self._embedding_scores(profile, query)
+        if embedding_scores is None:
+            weights = (PATH_WEIGHT, LEXICAL_WEIGHT, 0.0)
+            embedding_scores = np.zeros(count)
+        else:
+            weights = (PATH_WEIGHT, LEXICAL_WEIGHT, EMBEDDING_WEIGHT)
+        total = sum(weights)
+
+        scores = (
+            weights[0] * _scale(path_scores)
+            + weights[1] * _scale(lexical_scores)
+            + weights[2] * _scale(embedding_scores)
+        ) / total
+        for index, path in enumerate(profile.paths):
+            name = path.replace('\\', '/').rsplit('/', 1)[-1].lower()
+            if name.startswith('readme'):
+                scores[index] += README_PRIOR
+            scores[index] += DEPTH_PRIOR / (1 + path.count('/') + path.count('\\'))
+        # Smaller files first among equals so more of them fit
+        order = sorted(range(count), key=lambda index: (-scores[index], profile.token_counts[index]))
+        return [(float(scores[index]), index) for index in order]
+
+    def pack(self, profile: RepoProfile, query: str, budget_tokens: int, read_file: Callable[[str], Optional[str]],
+             header: str = '', list_omitted: bool = True) -> Dict[str, any]:
+        """Render the best files for ``query`` into at most ``budget_tokens`` tokens.
+
+        ``read_file`` returns a file's text by path. ``list_omitted=False``
+        skips the path listing of left-out files, e.g. when the header
+        already carries an outline of the repository. Returns the rendered
+        ``text`` plus which files were included whole, truncated or omitted
+        and the estimated ``tokens`` used.
+        """
+        parts = [header] if header else []
+        used = self.count_tokens(header) if header else 0
+        included, omitted = [], []
+        truncated = None
+
+        for _, index in self.rank(profile, query):
+            path = profile.paths[index]
+            cost = profile.token_counts[index]
+            remaining = budget_tokens - used
+            if cost > remaining and (truncated is not None or remaining < MIN_PARTIAL_TOKENS):
+                omitted.append(path)
+                continue
+            content = read_file(path)
+            if content is None:
+                continue
+            if cost <= remaining:
+                parts.append(render_file(path, content))
+                used += cost
+                included.append(path)
+                continue
+            partial = self._truncate(path, content, remaining)
+            if partial:
+                parts.append(partial)
+                used += self.count_tokens(partial)
+                truncated = path
+                continue
+            omitted.append(path)
+
+        if omitted and list_omitted:
+            listing = "\nOther files in the repository (not shown):\n"
+            for path in omitted:
+                line = f"- {path}\n"
+                line_tokens = self.count_tokens(line)
+                if used + self.count_tokens(listing) + line_tokens > budget_tokens:
+                    break
+                listing += line
+            if listing.count('\n- '):
+                parts.append(listing)
+                used += self.count_tokens(listing)
+
+        text = "\n".join(parts)
+        return {
+            'text': text,
+            'tokens': self.count_tokens(text),
+            'included': included,
+            'truncated': truncated,
+            'omitted': omitted
+        }
+
+    def _truncate(self, path: str, content: str, budget_tokens: int) -> Optional[str]:
+        """The longest line-aligned head of a file whose rendering fits the budget."""
+        lines = content.split('\n')
+        low, high = 0, len(lines)
+        while low < high:
+            middle = (low + high + 1) // 2
+            candidate = self._render_head(path, lines, middle)
+            if self.count_tokens(candidate) <= budget_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return self._render_head(path, lines, low) if low else None
+
+    @staticmethod
+    def _render_head(path: str, lines: List[str], keep: int) -> str:
+        head = "\n".join(lines[:keep])
+        if keep < len(lines):
+            head += f"\n... ({len(lines) - keep} more lines not shown)"
+        return render_file(path, head)
+
+
+def fit_history(messages: List[Dict[str, str]], budget_tokens: int,
+                count_tokens: Callable[[str], int] = estimate_tokens) -> List[Dict[str, str]]:
+    """Keep the most recent history messages that fit the budget, in order."""
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        cost = count_tokens(message['content']) + 4
+        if used + cost > budget_tokens:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept
+
+
+def truncate_text(text: str, budget_tokens: int, count_tokens: Callable[[str], int] = estimate_tokens) -> str:
+    """The longest line-aligned head of ``text`` that fits the budget, marked when cut."""
+    if count_tokens(text) <= budget_tokens:
+        return text
+    lines = text.split('\n')
+    low, high = 0, len(lines)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens('\n'.join(lines[:middle])) + 8 <= budget_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return '\n'.join(lines[:low]) + f"\n... ({len(lines) - low} more lines not shown)"
+
+
+def _scale(values: np.ndarray) -> np.ndarray:
+    peak = values.max() if values.size else 0
+    return values / peak if peak > 0 else np.zeros_like(values, dtype=float)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
@@ -0,0 +1,105 @@
+import os
+import time
+import threading
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Time a /chat request may take unless it asks for another budget with ``deadline_ms``
+CHAT_DEADLINE_SECONDS = float(os.environ.get('CHAT_DEADLINE_SECONDS', 90))
+CHAT_MIN_DEADLINE_SECONDS = 2
+CHAT_MAX_DEADLINE_SECONDS = float(os.environ.get('CHAT_MAX_DEADLINE_SECONDS', 600))
+# Rough model speed used to turn the time left into an answer-length cap
+LLM_DECODE_TOKENS_PER_SECOND = float(os.environ.get('LLM_DECODE_TOKENS_PER_SECOND', 15))
+# Time kept back for the prompt to be evaluated before the first answer token
+LLM_PREFILL_RESERVE_SECONDS = float(os.environ.get('LLM_PREFILL_RESERVE_SECONDS', 3))
+# Answers are never capped below this many tokens; a request with its own deadline_ms is capped
+# at this many when the route sets no limit
+MIN_ANSWER_TOKENS = 64
+UNCAPPED_ANSWER_TOKENS = 2048
+
+# Degradations a request can report
+DEGRADE_FEWER_RESULTS = 'fewer_results'
+DEGRADE_SMALLER_CONTEXT = 'smaller_context'
+DEGRADE_SKIPPED_REFINEMENT = 'skipped_refinement'
+DEGRADE_CAPPED_TOKENS = 'capped_tokens'
+DEGRADE_TRUNCATED = 'truncated'
+
+
+class Deadline:
+    """Time budget of one request, shared by every stage of its pipeline.
+
+    Stages ask ``remaining()`` before optional work and call ``degrade()``
+    when they cut something short; the degradations are reported with the
+    answer. ``Deadline()`` without seconds never runs out. ``explicit`` is
+    set when the client chose the budget rather than getting the default.
+    """
+
+    def __init__(self, seconds: Optional[float] = None, explicit: bool = False):
+        self.seconds = seconds
+        self.explicit = explicit
+        self.started = time.monotonic()
+        self.expires_at = self.started + seconds if seconds is not None else None
+        self._lock = threading.Lock()
+        self.degradations: List[str] = []
+
+    @classmethod
+    def from_request(cls, data: Dict[str, any]) -> 'Deadline':
+        """The budget a request asked for in ``deadline_ms``, clamped, or the server default."""
+        deadline_ms = data.get('deadline_ms')
+        if deadline_ms is None:
+            return cls(CHAT_DEADLINE_SECONDS)
+        try:
+            seconds = float(deadline_ms) / 1000
+        except (TypeError, ValueError):
+            raise ValueError("deadline_ms must be a number of milliseconds")
+        return cls(min(max(seconds, CHAT_MIN_DEADLINE_SECONDS), CHAT_MAX_DEADLINE_SECONDS), explicit=True)
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float('inf')
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def degrade(self, degradation: str):
+        with self._lock:
+            if degradation in self.degradations:
+                return
+            self.degradations.append(degradation)
+        logger.info(f"Deadline degradation: {degradation} ({round(self.remaining(), 1)}s left)")
+
+    def queue_wait(self) -> Optional[float]:
+        """Longest an LLM call may wait for a scheduler slot, or None for the scheduler's default."""
+        return None if self.expires_at is None else self.remaining()
+
+    def answer_options(self, options: Dict[str, int]) -> Dict[str, int]:
+        """The answer route's options with ``num_predict`` capped to what the time left can generate.
+
+        Under the server's default budget only a route limit the time left
+        cannot reach is lowered, so an ordinary request is never degraded.
+        """
+        if self.expires_at is None:
+            return options
+        limit = options.get('num_predict')
+        if not limit:
+            if not self.explicit:
+                return options
+            limit = UNCAPPED_ANSWER_TOKENS
+        generation_seconds = self.remaining() - LLM_PREFILL_RESERVE_SECONDS
+        affordable = max(MIN_ANSWER_TOKENS, int(generation_seconds * LLM_DECODE_TOKENS_PER_SECOND))
+        if affordable >= limit:
+            return options
+        self.degrade(DEGRADE_CAPPED_TOKENS)
+        return {**options, 'num_predict': affordable}
+
+    def report(self) -> Dict[str, any]:
+        with self._lock:
+            degradations = list(self.degradations)
+        return {
+            'deadline_ms': round(self.seconds * 1000) if self.seconds is not None else None,
+            'elapsed_ms': round((time.monotonic() - self.started) * 1000, 1),
+            'degradations': degradations
+        }
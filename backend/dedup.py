@@ -0,0 +1,93 @@
+import re
+import hashlib
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+
+class NearDuplicateIndex:
+    """MinHash/LSH index that keeps one representative per near-duplicate cluster.
+
+    Chunks are shingled into overlapping token k-grams, signed with
+    ``num_perm`` MinHash permutations and bucketed into ``bands`` LSH bands.
+    A chunk whose estimated Jaccard similarity to an already-seen chunk is at
+    least ``threshold`` is reported as an alias of that chunk's representative.
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 8,
+                 shingle_size: int = 5, min_shingles: int = 8, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_shingles = min_shingles
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self._buckets: Dict[tuple, List[str]] = defaultdict(list)
+        self._signatures: Dict[str, np.ndarray] = {}
+        self._exact: Dict[str, str] = {}
+        self.aliases: Dict[str, List[str]] = defaultdict(list)
+
+    def _shingles(self, text: str) -> List[int]:
+        tokens = _TOKEN_RE.findall(text)
+        if len(tokens) < self.shingle_size:
+            return []
+        size = self.shingle_size
+        return list({
+            int.from_bytes(hashlib.blake2b(' '.join(tokens[i:i + size]).encode('utf-8'), digest_size=4).digest(), 'little')
+            for i in range(len(tokens) - size + 1)
+        })
+
+    def _signature(self, shingles: List[int]) -> np.ndarray:
+        hashes = np.array(shingles, dtype=np.uint64)
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return permuted.min(axis=1)
+
+    def find_or_add(self, key: str, text: str) -> Optional[str]:
+        """Return the representative key if ``text`` is a near-duplicate, else register it.
+
+        Chunks too short to shingle meaningfully are only deduplicated when
+        they are exact (whitespace-normalized) copies.
+        """
+        normalized = ' '.join(text.split())
+        digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        if digest in self._exact:
+            representative = self._exact[digest]
+            self.aliases[representative].append(key)
+            return representative
+
+        shingles = self._shingles(normalized)
+        if len(shingles) < self.min_shingles:
+            self._exact[digest] = key
+            return None
+
+        signature = self._signature(shingles)
+        band_keys = [
+            (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+        candidates = dict.fromkeys(
+            candidate for band_key in band_keys for candidate in self._buckets.get(band_key, [])
+        )
+        for candidate in candidates:
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= self.threshold:
+                self.aliases[candidate].append(key)
+                return candidate
+
+        self._exact[digest] = key
+        self._signatures[key] = signature
+        for band_key in band_keys:
+            self._buckets[band_key].append(key)
+        return None
@@ -0,0 +1,191 @@
+import os
+import re
+import math
+import logging
+from collections import Counter
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+LOCKFILE_NAMES = {
+    'package-lock.json', 'npm-shrinkwrap.json', 'yarn.lock', 'pnpm-lock.yaml',
+    'bun.lockb', 'poetry.lock', 'Pipfile.lock', 'composer.lock', 'Cargo.lock',
+    'Gemfile.lock', 'go.sum', 'mix.lock', 'pubspec.lock', 'packages.lock.json'
+}
+
+GENERATED_NAME_PATTERNS = [
+    re.compile(pattern) for pattern in (
+        r'_pb2(_grpc)?\.pyi?$', r'\.pb\.(go|cc|h)$', r'\.pb\.gw\.go$', r'_grpc\.pb\.go$',
+        r'\.min\.(js|css|mjs)$', r'\.bundle\.js$', r'\.map$', r'\.generated\.\w+$',
+        r'\.g\.dart$', r'\.freezed\.dart$', r'\.designer\.cs$', r'_generated\.\w+$'
+    )
+]
+
+# Directory names that only ever hold vendored copies; ``external/`` is left out since it often holds first-party code
+VENDORED_DIRECTORIES = {'vendor', 'third_party', 'thirdparty', 'bower_components', 'vendors'}
+
+# Banners code generators write into a file's leading comment; matched case-sensitively and
+# only there, so hand-written files that merely mention generated code are kept
+GENERATED_MARKERS = re.compile(
+    r'Code generated .* DO NOT EDIT\.|@generated\b|Generated by the protocol buffer compiler\.\s+DO NOT EDIT!|'
+    r'<auto-generated\b|Autogenerated by Thrift Compiler'
+)
+
+LICENSE_MARKERS = re.compile(r'copyright|license|spdx-license-identifier|all rights reserved', re.IGNORECASE)
+
+# Prose has long unwrapped paragraphs and no license header to strip, so only code gets the
+# minified/entropy checks and license stripping
+PROSE_EXTENSIONS = {'.md', '.rst', '.txt'}
+
+# Heuristic thresholds
+SAMPLE_BYTES = 8192
+HEADER_SCAN_LINES = 40
+MINIFIED_AVG_LINE_LENGTH = 300
+MINIFIED_MAX_LINE_LENGTH = 2000
+HIGH_ENTROPY_BITS = 5.2
+LOW_WHITESPACE_RATIO = 0.05
+
+
+def _shannon_entropy(text: str) -> float:
+    if not text:
+        return 0.0
+    counts = Counter(text)
+    total = len(text)
+    return -sum((count / total) * math.log2(count / total) for count in counts.values())
+
+
+def _leading_comment_end(lines: List[str], start: int) -> int:
+    """Index of the first line after the comment block (and blank lines) starting at ``start``."""
+    index = start
+    in_block = False
+    while index < len(lines):
+        stripped = lines[index].strip()
+        if in_block:
+            index += 1
+            if '*/' in stripped or stripped.endswith('"""') or stripped.endswith("'''"):
+                in_block = False
+            continue
+        if stripped.startswith('/*') or stripped.startswith('"""') or stripped.startswith("'''"):
+            closes_here = ('*/' in stripped[2:]) or (len(stripped) > 3 and stripped[3:].endswith(stripped[:3]))
+            in_block = not closes_here
+            index += 1
+            continue
+        if stripped.startswith(('//', '#', '--', '*')) or not stripped:
+            index += 1
+            continue
+        break
+    return index
+
+
+def _skip_preamble(lines: List[str]) -> int:
+    """Index of the first line after shebang and encoding lines."""
+    index = 0
+    while index < len(lines) and (lines[index].startswith('#!') or 'coding' in lines[index][:30]):
+        index += 1
+    return index
+
+
+def has_generated_banner(sample: str) -> bool:
+    """Whether the file's leading comment carries a code generator's banner."""
+    lines = sample.split('\n', HEADER_SCAN_LINES)[:HEADER_SCAN_LINES]
+    start = _skip_preamble(lines)
+    header = '\n'.join(lines[start:_leading_comment_end(lines, start)])
+    return bool(GENERATED_MARKERS.search(header))
+
+
+def classify_file(relative_path: str, content: str) -> Tuple[bool, str]:
+    """Decide whether a file is worth embedding.
+
+    Returns ``(keep, reason)``; ``reason`` names the rule that rejected the
+    file (``lockfile``, ``generated_name``, ``vendored``, ``generated_marker``,
+    ``minified`` or ``high_entropy``) or is ``'ok'``. Only a bounded sample of
+    the content is inspected so this stays cheap on large files.
+    """
+    keep, reason = _classify(relative_path, content)
+    if not keep:
+        logger.info(f"Skipping {relative_path}: {reason}")
+    return keep, reason
+
+
+def _classify(relative_path: str, content: str) -> Tuple[bool, str]:
+    file_name = os.path.basename(relative_path)
+    if file_name in LOCKFILE_NAMES:
+        return False, 'lockfile'
+    if any(pattern.search(file_name) for pattern in GENERATED_NAME_PATTERNS):
+        return False, 'generated_name'
+    parts = relative_path.replace('\\', '/').split('/')[:-1]
+    if any(part.lower() in VENDORED_DIRECTORIES for part in parts):
+        return False, 'vendored'
+
+    sample = content[:SAMPLE_BYTES]
+    if has_generated_banner(sample):
+        return False, 'generated_marker'
+    if os.path.splitext(file_name)[1].lower() in PROSE_EXTENSIONS:
+        return True, 'ok'
+
+    lines = sample.split('\n')
+    longest = max(len(line) for line in lines)
+    if longest > MINIFIED_MAX_LINE_LENGTH or len(sample) / len(lines) > MINIFIED_AVG_LINE_LENGTH:
+        return False, 'minified'
+
+    whitespace = sum(1 for char in sample if char.isspace())
+    if (len(sample) >= 1024 and whitespace / len(sample) < LOW_WHITESPACE_RATIO
+            and _shannon_entropy(sample) > HIGH_ENTROPY_BITS):
+        return False, 'high_entropy'
+
+    return True, 'ok'
+
+
+def strip_license_header(content: str, relative_path: str = '') -> Tuple[str, int]:
+    """Blank out a leading comment block that is a license/copyright notice.
+
+    The header lines are replaced by empty lines rather than removed so chunk
+    line numbers still match the original file. Returns the new content and
+    the number of lines blanked.
+    """
+    if os.path.splitext(relative_path)[1].lower() in PROSE_EXTENSIONS:
+        return content, 0
+    lines = content.split('\n')
+    # Keep shebangs and encoding lines out of the header block
+    start = _skip_preamble(lines)
+    index = _leading_comment_end(lines, start)
+
+    header = '\n'.join(lines[start:index])
+    if index == start or not LICENSE_MARKERS.search(header):
+        return content, 0
+    removed = index - start
+    return '\n'.join(lines[:start] + [''] * removed + lines[index:]), removed
+
+
+class IngestStats:
+    """Counters describing what an ingest run embedded and what it skipped."""
+
+    def __init__(self):
+        self.files_seen = 0
+        self.files_indexed = 0
+        self.bytes_seen = 0
+        self.bytes_indexed = 0
+        self.chunks_indexed = 0
+        self.chunks_deduplicated = 0
+        self.large_files_streamed = 0
+        self.license_headers_stripped = 0
+        self.skipped: Dict[str, int] = Counter()
+        self.skipped_bytes: Dict[str, int] = Counter()
+
+    def skip(self, reason: str, size: int = 0):
+        self.skipped[reason] += 1
+        self.skipped_bytes[reason] += size
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            'files_seen': self.files_seen,
+            'files_indexed': self.files_indexed,
+            'bytes_seen': self.bytes_seen,
+            'bytes_indexed': self.bytes_indexed,
+            'chunks_indexed': self.chunks_indexed,
+            'chunks_deduplicated': self.chunks_deduplicated,
+            'large_files_streamed': self.large_files_streamed,
+            'license_headers_stripped': self.license_headers_stripped,
+            'skipped': dict(self.skipped),
+            'skipped_bytes': dict(self.skipped_bytes)
+        }
@@ -0,0 +1,155 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def make_file_id(index_id: str, relative_path: str) -> str:
+    """Return a compact, fixed-size identifier for a file in an index."""
+    return hashlib.sha1(f"{index_id}:{relative_path}".encode('utf-8')).hexdigest()[:16]
+
+
+class FileMetadataStore:
+    """Keeps file-level metadata once per file instead of on every chunk.
+
+    Chunks stored in Chroma only carry the compact ``file_id``; the file path,
+    functions, classes and imports live in a small SQLite table next to the
+    Chroma persistence directory.
+    """
+
+    def __init__(self, db_path: str = "./chroma_db/file_metadata.db"):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                file_id TEXT PRIMARY KEY,
+                index_id TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                file_type TEXT,
+                functions TEXT,
+                classes TEXT,
+                imports TEXT,
+                chunk_count INTEGER DEFAULT 0
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_index ON files(index_id)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_aliases (
+                index_id TEXT NOT NULL,
+                representative_id TEXT NOT NULL,
+                alias_file_id TEXT NOT NULL,
+                start_line INTEGER,
+                end_line INTEGER
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_aliases_rep ON chunk_aliases(representative_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_aliases_index ON chunk_aliases(index_id)")
+        self._conn.commit()
+
+    def upsert_file(self, index_id: str, relative_path: str, metadata: dict, chunk_count: int = 0) -> str:
+        """Store file-level metadata and return the file ID chunks should reference."""
+        file_id = make_file_id(index_id, relative_path)
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO files
+                   (file_id, index_id, file_path, file_type, functions, classes, imports, chunk_count)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    file_id,
+                    index_id,
+                    relative_path,
+                    metadata.get('file_type', ''),
+                    metadata.get('functions', ''),
+                    metadata.get('classes', ''),
+                    metadata.get('imports', ''),
+                    chunk_count,
+                )
+            )
+            self._conn.commit()
+        return file_id
+
+    def get_file(self, file_id: str) -> Optional[Dict[str, str]]:
+        """Return the metadata row for a file ID, or None if unknown."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id, index_id, file_path, file_type, functions, classes, imports, chunk_count "
+                "FROM files WHERE file_id = ?",
+                (file_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ['file_id', 'index_id', 'file_path', 'file_type', 'functions', 'classes', 'imports', 'chunk_count']
+        return dict(zip(keys, row))
+
+    def get_files(self, file_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        """Resolve several file IDs at once (used to decorate query results)."""
+        unique_ids = list(dict.fromkeys(file_ids))
+        if not unique_ids:
+            return {}
+        placeholders = ','.join('?' for _ in unique_ids)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT file_id, file_path, file_type, functions, classes, imports "
+                f"FROM files WHERE file_id IN ({placeholders})",
+                unique_ids
+            ).fetchall()
+        keys = ['file_id', 'file_path', 'file_type', 'functions', 'classes', 'imports']
+        return {row[0]: dict(zip(keys, row)) for row in rows}
+
+    def add_aliases(self, index_id: str, aliases: List[Tuple[str, str, int, int]]):
+        """Record near-duplicate chunks that were not embedded.
+
+        Each alias is ``(representative_id, alias_file_id, start_line, end_line)``.
+        """
+        if not aliases:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO chunk_aliases (index_id, representative_id, alias_file_id, start_line, end_line) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(index_id, *alias) for alias in aliases]
+            )
+            self._conn.commit()
+
+    def get_aliases(self, representative_ids: List[str]) -> Dict[str, List[Dict[str, any]]]:
+        """Return where else each representative chunk's near-duplicates appear, as file paths and line ranges."""
+        unique_ids = list(dict.fromkeys(representative_ids))
+        if not unique_ids:
+            return {}
+        placeholders = ','.join('?' for _ in unique_ids)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT chunk_aliases.representative_id, files.file_path, chunk_aliases.start_line, "
+                f"chunk_aliases.end_line FROM chunk_aliases "
+                f"JOIN files ON files.file_id = chunk_aliases.alias_file_id "
+                f"WHERE chunk_aliases.representative_id IN ({placeholders}) "
+                f"ORDER BY files.file_path, chunk_aliases.start_line",
+                unique_ids
+            ).fetchall()
+        aliases: Dict[str, List[Dict[str, any]]] = {}
+        for representative_id, file_path, start_line, end_line in rows:
+            aliases.setdefault(representative_id, []).append(
+                {'file_path': file_path, 'start_line': start_line, 'end_line': end_line}
+            )
+        return aliases
+
+    def delete_index(self, index_id: str):
+        """Remove every file and alias row belonging to an index."""
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE index_id = ?", (index_id,))
+            self._conn.execute("DELETE FROM chunk_aliases WHERE index_id = ?", (index_id,))
+            self._conn.commit()
+
+    def vacuum(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
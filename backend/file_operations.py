@@ -5,8 +5,8 @@ from flask import jsonify, request
 import logging
 import re
 from typing import Optional, Dict, List
-import ollama
-import httpx
+from llm_scheduler import get_llm_scheduler, PRIORITY_BACKGROUND
+from model_routes import load_model_routes, TASK_ANSWER, TASK_CODEGEN
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +14,11 @@ class FileOperationManager:
     def __init__(self):
         self.file_operations = {}
         self.OLLAMA_URL = "https://867d-35-185-179-50.ngrok-free.app/"
+        self.llm_client = get_llm_scheduler(self.OLLAMA_URL)
+        self.model_routes = load_model_routes({
+            TASK_ANSWER: {'model': 'deepseek-coder-v2:latest'},
+            TASK_CODEGEN: {'model': 'deepseek-coder-v2:latest'},
+        }, serves=self.llm_client.pool.serves)
 
     def is_code_file(self, file_path: str) -> bool:
         """Check if the file is a relevant code file."""
@@ -185,8 +190,9 @@ class FileOperationManager:
                 }
             ]
 
-            ollama_client = ollama.Client(host=self.OLLAMA_URL)
-            response = ollama_client.chat(model='deepseek-coder-v2:latest', messages=messages)
+            route = self.model_routes.route(TASK_CODEGEN)
+            response = self.llm_client.chat(model=route.model, messages=messages, chat_id=chat_id,
+                                            priority=PRIORITY_BACKGROUND, options=route.options())
             
             # Extract code from response
             code_content = self.extract_code_from_response(response['message']['content'])
@@ -221,8 +227,9 @@ class FileOperationManager:
                 }
             ]
 
-            ollama_client = ollama.Client(host=self.OLLAMA_URL)
-            response = ollama_client.chat(model='deepseek-coder-v2:latest', messages=messages)
+            route = self.model_routes.route(TASK_CODEGEN)
+            response = self.llm_client.chat(model=route.model, messages=messages, chat_id=chat_id,
+                                            priority=PRIORITY_BACKGROUND, options=route.options())
             
             # Extract and save modified code
             modified_code = self.extract_code_from_response(response['message']['content'])
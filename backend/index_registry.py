@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+import git
+from collections import defaultdict
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_repo_url(repo_url: str) -> str:
+    """Normalize a repository URL so equivalent spellings share one index.
+
+    Credentials, scheme differences, letter case of the host, a trailing
+    slash and a ``.git`` suffix are all ignored.
+    """
+    parsed = urlparse(repo_url.strip())
+    host = (parsed.hostname or '').lower()
+    path = parsed.path.rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-4]
+    if host in {'github.com', 'www.github.com'}:
+        host = 'github.com'
+        path = path.lower()
+    return f"https://{host}{path}"
+
+
+def make_index_id(normalized_url: str, commit_sha: str, version: str) -> str:
+    """Return the shared index key for a repo@commit built by a chunker/model version."""
+    return hashlib.sha1(f"{normalized_url}@{commit_sha}#{version}".encode('utf-8')).hexdigest()[:16]
+
+
+def resolve_commit_sha(clone_url: str) -> str:
+    """Resolve the remote HEAD commit without cloning.
+
+    This runs with the requester's credentials, so a chat can only attach to
+    a shared index of a repository it is able to read.
+    """
+    try:
+        output = git.cmd.Git().ls_remote(clone_url, 'HEAD')
+    except git.exc.GitCommandError as e:
+        if "Authentication failed" in str(e):
+            raise ValueError("Authentication failed. Please check your GitHub token.")
+        logger.error(f"git ls-remote failed: {str(e)}")
+        raise ValueError("Failed to clone repository. Please check the URL and permissions.")
+    if not output.strip():
+        raise ValueError("Repository has no commits")
+    return output.split()[0]
+
+
+class IndexRegistry:
+    """Tracks shared, read-only repository indexes and which chats reference them.
+
+    An index is identified by (normalized repo URL, commit SHA, chunker/model
+    version). Chats hold a reference to one index each; indexes whose
+    reference count drops to zero are returned by ``unreferenced_indexes`` so
+    the caller can drop their collections. The apps that keep one
+    ``chat_{id}`` collection per chat register those with
+    ``touch_collection`` so that idle ones can be expired too.
+    """
+
+    def __init__(self, db_path: str = "./chroma_db/index_registry.db"):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._build_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS indexes (
+                index_id TEXT PRIMARY KEY,
+                repo_url TEXT NOT NULL,
+                commit_sha TEXT NOT NULL,
+                version TEXT NOT NULL,
+                collection_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stats TEXT,
+                created_at REAL,
+                last_accessed REAL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_refs (
+                chat_id TEXT PRIMARY KEY,
+                index_id TEXT NOT NULL,
+                last_accessed REAL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_collections (
+                collection_name TEXT PRIMARY KEY,
+                last_accessed REAL
+            )
+        """)
+        # Registries created before access tracking lack the last_accessed columns
+        for table in ('indexes', 'chat_refs'):
+            columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            if 'last_accessed' not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN last_accessed REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_refs_index ON chat_refs(index_id)")
+        self._conn.commit()
+
+    def build_lock(self, index_id: str) -> threading.Lock:
+        """Lock held while an index is built so concurrent loads of one repo wait for it."""
+        with self._lock:
+            return self._build_locks[index_id]
+
+    def get_index(self, index_id: str) -> Optional[Dict[str, any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT index_id, repo_url, commit_sha, version, collection_name, status, stats, "
+                "created_at, last_accessed FROM indexes WHERE index_id = ?",
+                (index_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ['index_id', 'repo_url', 'commit_sha', 'version', 'collection_name', 'status', 'stats',
+                'created_at', 'last_accessed']
+        entry = dict(zip(keys, row))
+        entry['stats'] = json.loads(entry['stats']) if entry['stats'] else {}
+        return entry
+
+    def register_index(self, index_id: str, repo_url: str, commit_sha: str, version: str,
+                       collection_name: str, status: str = 'building', stats: Optional[dict] = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO indexes "
+                "(index_id, repo_url, commit_sha, version, collection_name, status, stats, created_at, last_accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (index_id, repo_url, commit_sha, version, collection_name, status,
+                 json.dumps(stats or {}), time.time(), time.time())
+            )
+            self._conn.commit()
+
+    def mark_ready(self, index_id: str, stats: dict):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE indexes SET status = 'ready', stats = ? WHERE index_id = ?",
+                (json.dumps(stats), index_id)
+            )
+            self._conn.commit()
+
+    def attach_chat(self, chat_id: str, index_id: str) -> Optional[str]:
+        """Point a chat at an index; returns the index it referenced before, if any."""
+        with self._lock:
+            row = self._conn.execute("SELECT index_id FROM chat_refs WHERE chat_id = ?", (chat_id,)).fetchone()
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_refs (chat_id, index_id, last_accessed) VALUES (?, ?, ?)",
+                (chat_id, index_id, now)
+            )
+            self._conn.execute("UPDATE indexes SET last_accessed = ? WHERE index_id = ?", (now, index_id))
+            self._conn.commit()
+        previous = row[0] if row else None
+        return previous if previous != index_id else None
+
+    def detach_chat(self, chat_id: str) -> Optional[str]:
+        """Drop a chat's reference; returns the index it pointed at."""
+        with self._lock:
+            row = self._conn.execute("SELECT index_id FROM chat_refs WHERE chat_id = ?", (chat_id,)).fetchone()
+            self._conn.execute("DELETE FROM chat_refs WHERE chat_id = ?", (chat_id,))
+            self._conn.commit()
+        return row[0] if row else None
+
+    def touch_chat(self, chat_id: str):
+        """Record that a chat (and so its index) was just used."""
+        with self._lock:
+            now = time.time()
+            self._conn.execute("UPDATE chat_refs SET last_accessed = ? WHERE chat_id = ?", (now, chat_id))
+            self._conn.execute(
+                "UPDATE indexes SET last_accessed = ? "
+                "WHERE index_id = (SELECT index_id FROM chat_refs WHERE chat_id = ?)",
+                (now, chat_id)
+            )
+            self._conn.commit()
+
+    def stale_chats(self, cutoff: float) -> List[str]:
+        """Chats not used since ``cutoff`` (epoch seconds)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id FROM chat_refs WHERE COALESCE(last_accessed, 0) < ?", (cutoff,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def detach_index(self, index_id: str) -> int:
+        """Drop every chat reference to an index; returns how many were dropped."""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM chat_refs WHERE index_id = ?", (index_id,))
+            self._conn.commit()
+        return cursor.rowcount
+
+    def indexes_by_last_access(self) -> List[Dict[str, any]]:
+        """Ready or failed indexes, least recently used first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT index_id FROM indexes WHERE status != 'building' "
+                "ORDER BY COALESCE(last_accessed, created_at, 0)"
+            ).fetchall()
+        return [self.get_index(row[0]) for row in rows]
+
+    def collection_names(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT collection_name FROM indexes")]
+
+    def summary(self) -> Dict[str, any]:
+        """Counts for the admin stats endpoint."""
+        with self._lock:
+            statuses = dict(self._conn.execute("SELECT status, COUNT(*) FROM indexes GROUP BY status").fetchall())
+            chats = self._conn.execute("SELECT COUNT(*) FROM chat_refs").fetchone()[0]
+            oldest = self._conn.execute("SELECT MIN(last_accessed) FROM chat_refs").fetchone()[0]
+            collections = self._conn.execute("SELECT COUNT(*) FROM chat_collections").fetchone()[0]
+        return {'indexes': statuses, 'chats': chats, 'oldest_chat_access': oldest, 'chat_collections': collections}
+
+    def vacuum(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def index_for_chat(self, chat_id: str) -> Optional[Dict[str, any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT index_id FROM chat_refs WHERE chat_id = ?", (chat_id,)).fetchone()
+        return self.get_index(row[0]) if row else None
+
+    def refcount(self, index_id: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM chat_refs WHERE index_id = ?", (index_id,)
+            ).fetchone()[0]
+
+    def unreferenced_indexes(self, cutoff: float) -> List[Dict[str, any]]:
+        """Ready or failed indexes that no chat references and that were last used before ``cutoff``."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT index_id FROM indexes WHERE status != 'building' "
+                "AND index_id NOT IN (SELECT index_id FROM chat_refs) "
+                "AND COALESCE(last_accessed, created_at, 0) < ?",
+                (cutoff,)
+            ).fetchall()
+        return [self.get_index(row[0]) for row in rows]
+
+    def touch_collection(self, collection_name: str):
+        """Record that a per-chat collection of one of the other apps was just used."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_collections (collection_name, last_accessed) VALUES (?, ?)",
+                (collection_name, time.time())
+            )
+            self._conn.commit()
+
+    def stale_collections(self, cutoff: float) -> List[str]:
+        """Registered per-chat collections not used since ``cutoff`` (epoch seconds)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT collection_name FROM chat_collections WHERE COALESCE(last_accessed, 0) < ?", (cutoff,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def forget_collection(self, collection_name: str, cutoff: float) -> bool:
+        """Unregister a per-chat collection unless it was used since ``cutoff``; returns whether it was."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM chat_collections WHERE collection_name = ? AND COALESCE(last_accessed, 0) < ?",
+                (collection_name, cutoff)
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def delete_index(self, index_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM indexes WHERE index_id = ?", (index_id,))
+            self._conn.commit()
@@ -0,0 +1,374 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import threading
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Chroma keeps each vector segment (HNSW files) in a directory named by its UUID
+_SEGMENT_DIR_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+# Unreferenced indexes are kept this long after their last use, so a chat reloading the same repo reattaches
+INDEX_GRACE_SECONDS = 3600
+
+
+def directory_size(path: str) -> int:
+    """Bytes actually allocated on disk under ``path`` (sparse HNSW files count as used)."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            blocks = getattr(stat, 'st_blocks', None)
+            total += blocks * 512 if blocks is not None else stat.st_size
+    return total
+
+
+class Janitor:
+    """Keeps the Chroma persistence directory bounded.
+
+    Each pass expires chats idle for longer than ``chat_ttl_seconds`` (and
+    the other apps' registered per-chat collections idle as long), drops
+    indexes no chat has referenced for ``index_grace_seconds``, evicts least
+    recently used indexes while the registry's own data is over
+    ``disk_quota_bytes`` (down to ``low_water_ratio`` of the quota), removes segment directories
+    missing from Chroma's catalog, and vacuums SQLite files whose free pages
+    exceed ``compact_freelist_ratio``. Only collections registered in the
+    registry are ever deleted: a collection it does not know may belong to
+    an app that shares the directory without registering. Passes run on a daemon thread every ``interval_seconds`` and
+    can also be triggered directly with ``run_once``.
+    """
+
+    def __init__(self, registry, chroma_client, file_store, persist_dir: str = './chroma_db',
+                 disk_quota_bytes: int = 2 * 1024 ** 3, chat_ttl_seconds: float = 14 * 24 * 3600,
+                 interval_seconds: float = 600, low_water_ratio: float = 0.9,
+                 compact_freelist_ratio: float = 0.2, index_grace_seconds: float = INDEX_GRACE_SECONDS):
+        self.registry = registry
+        self.chroma_client = chroma_client
+        self.file_store = file_store
+        self.persist_dir = persist_dir
+        self.disk_quota_bytes = disk_quota_bytes
+        self.chat_ttl_seconds = chat_ttl_seconds
+        self.interval_seconds = interval_seconds
+        self.low_water_ratio = low_water_ratio
+        self.compact_freelist_ratio = compact_freelist_ratio
+        self.index_grace_seconds = index_grace_seconds
+        self._pass_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.totals = {
+            'passes': 0, 'chats_expired': 0, 'collections_expired': 0, 'indexes_collected': 0, 'indexes_evicted': 0,
+            'orphans_removed': 0, 'bytes_reclaimed': 0, 'databases_vacuumed': 0
+        }
+        self.last_report: Dict[str, any] = {}
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='chroma-janitor', daemon=True)
+        self._thread.start()
+        logger.info(f"Janitor started (every {self.interval_seconds}s, quota {self.disk_quota_bytes} bytes)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Error in janitor pass: {str(e)}")
+
+    def _drop_index(self, entry: Dict[str, any]) -> bool:
+        """Delete an index's collection, file rows and registry entry.
+
+        Skipped when the index's build lock is held, i.e. a load is building
+        it or about to attach a chat to it.
+        """
+        lock = self.registry.build_lock(entry['index_id'])
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            try:
+                self.chroma_client.delete_collection(name=entry['collection_name'])
+            except ValueError:
+                # Collection was never created (failed build)
+                pass
+            self.file_store.delete_index(entry['index_id'])
+            self.registry.delete_index(entry['index_id'])
+        finally:
+            lock.release()
+        return True
+
+    def collect_unreferenced(self) -> int:
+        """Drop shared indexes that no chat has referenced for the grace period."""
+        collected = 0
+        for entry in self.registry.unreferenced_indexes(time.time() - self.index_grace_seconds):
+            if entry and self.registry.refcount(entry['index_id']) == 0 and self._drop_index(entry):
+                collected += 1
+                logger.info(f"Garbage-collected index {entry['index_id']} "
+                            f"({entry['repo_url']}@{entry['commit_sha'][:12]})")
+        self.totals['indexes_collected'] += collected
+        return collected
+
+    def expire_chats(self) -> int:
+        """Release the references of chats idle for longer than the TTL."""
+        if not self.chat_ttl_seconds:
+            return 0
+        stale = self.registry.stale_chats(time.time() - self.chat_ttl_seconds)
+        for chat_id in stale:
+            self.registry.detach_chat(chat_id)
+        if stale:
+            logger.info(f"Expired {len(stale)} idle chats")
+        self.totals['chats_expired'] += len(stale)
+        return len(stale)
+
+    def expire_collections(self) -> int:
+        """Delete the other apps' per-chat collections idle for longer than the TTL."""
+        if not self.chat_ttl_seconds:
+            return 0
+        cutoff = time.time() - self.chat_ttl_seconds
+        expired = 0
+        for name in self.registry.stale_collections(cutoff):
+            # Unregister first: a chat used meanwhile keeps its collection
+            if not self.registry.forget_collection(name, cutoff):
+                continue
+            try:
+                self.chroma_client.delete_collection(name=name)
+            except ValueError:
+                # Already deleted by its app
+                pass
+            expired += 1
+        if expired:
+            logger.info(f"Expired {expired} idle chat collections")
+        self.totals['collections_expired'] += expired
+        return expired
+
+    def evict_to_quota(self) -> int:
+        """Evict least recently used indexes until the registry's data is under the low-water mark.
+
+        Only registry-owned collections count against the quota; the other
+        apps' collections in the same directory are neither measured nor
+        evicted. Indexes no chat references go before ones chats still use.
+        """
+        if not self.disk_quota_bytes:
+            return 0
+        used = self._owned_bytes()
+        if used is None or used <= self.disk_quota_bytes:
+            return 0
+
+        target = self.disk_quota_bytes * self.low_water_ratio
+        evicted = 0
+        entries = [entry for entry in self.registry.indexes_by_last_access() if entry]
+        entries.sort(key=lambda entry: self.registry.refcount(entry['index_id']) > 0)
+        for entry in entries:
+            if used <= target:
+                break
+            if not self._drop_index(entry):
+                continue
+            self.registry.detach_index(entry['index_id'])
+            evicted += 1
+            logger.info(f"Evicted index {entry['index_id']} ({entry['repo_url']}) to stay under disk quota")
+            used = self._owned_bytes() or 0
+        if used > self.disk_quota_bytes:
+            logger.warning(f"Shared indexes still over quota after eviction: {used} bytes")
+        self.totals['indexes_evicted'] += evicted
+        return evicted
+
+    def _owned_bytes(self) -> Optional[int]:
+        """Disk use of the registry's collections and stores, or None when Chroma's catalog cannot be read.
+
+        Vector segment directories are attributed to their collection; the
+        live part of Chroma's SQLite file is split by embedding rows. SQLite
+        free pages are not counted: deleting a collection frees its rows but
+        not the file space, so counting them would evict far more than needed.
+        """
+        owned = self._sqlite_live_bytes(self.registry.db_path) + self._sqlite_live_bytes(self.file_store.db_path)
+        path = os.path.join(self.persist_dir, 'chroma.sqlite3')
+        if not os.path.exists(path):
+            return owned
+        names = set(self.registry.collection_names())
+        try:
+            conn = sqlite3.connect(path, timeout=5)
+            try:
+                segments = conn.execute(
+                    "SELECT segments.id, collections.name FROM segments "
+                    "JOIN collections ON segments.collection = collections.id"
+                ).fetchall()
+                rows = dict(conn.execute("SELECT segment_id, COUNT(*) FROM embeddings GROUP BY segment_id").fetchall())
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read Chroma catalog, skipping quota eviction: {str(e)}")
+            return None
+        owned_segments = {segment_id for segment_id, name in segments if name in names}
+        for segment_id in owned_segments:
+            segment_dir = os.path.join(self.persist_dir, segment_id)
+            if os.path.isdir(segment_dir):
+                owned += directory_size(segment_dir)
+        total_rows = sum(rows.values())
+        if total_rows:
+            owned_rows = sum(count for segment_id, count in rows.items() if segment_id in owned_segments)
+            owned += int(self._sqlite_live_bytes(path) * owned_rows / total_rows)
+        return owned
+
+    def _sqlite_live_bytes(self, path: str) -> int:
+        """Size of a SQLite file (with its WAL) minus its free pages."""
+        if not os.path.exists(path):
+            return 0
+        size = sum(os.path.getsize(name) for name in (path, path + '-wal') if os.path.exists(name))
+        try:
+            conn = sqlite3.connect(path, timeout=5)
+            try:
+                page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return size
+        return max(0, size - free)
+
+    def _sqlite_files(self) -> List[str]:
+        return [
+            name for name in ('file_metadata.db', 'index_registry.db', 'chroma.sqlite3')
+            if os.path.exists(os.path.join(self.persist_dir, name))
+        ]
+
+    def remove_orphans(self) -> int:
+        """Remove segment directories Chroma left behind for collections it no longer has.
+
+        Collections themselves are never removed here: one the registry does
+        not own may belong to another app sharing the directory.
+        """
+        removed = 0
+        # List directories before reading the catalog: a segment's row is written before its directory
+        directories = [
+            name for name in os.listdir(self.persist_dir)
+            if _SEGMENT_DIR_RE.match(name) and os.path.isdir(os.path.join(self.persist_dir, name))
+        ]
+        segments = self._live_segment_ids()
+        if segments is not None:
+            for name in directories:
+                path = os.path.join(self.persist_dir, name)
+                if name not in segments:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+                    logger.info(f"Removed orphaned segment directory {name}")
+        self.totals['orphans_removed'] += removed
+        return removed
+
+    def _live_segment_ids(self) -> Optional[set]:
+        """Segment ids in Chroma's SQLite catalog, or None when it cannot be read safely."""
+        path = os.path.join(self.persist_dir, 'chroma.sqlite3')
+        if not os.path.exists(path):
+            return None
+        try:
+            conn = sqlite3.connect(path, timeout=5)
+            try:
+                return {row[0] for row in conn.execute("SELECT id FROM segments")}
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read Chroma segments, skipping directory cleanup: {str(e)}")
+            return None
+
+    def _needs_vacuum(self, path: str) -> bool:
+        conn = sqlite3.connect(path, timeout=5)
+        try:
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        finally:
+            conn.close()
+        return page_count > 0 and freelist / page_count >= self.compact_freelist_ratio
+
+    def compact(self) -> int:
+        """VACUUM the SQLite files that have accumulated enough free pages."""
+        vacuumed = 0
+        for name in self._sqlite_files():
+            path = os.path.join(self.persist_dir, name)
+            try:
+                if not self._needs_vacuum(path):
+                    continue
+                # Our own stores vacuum through their connection; Chroma's catalog gets a short-lived one
+                if os.path.abspath(path) == os.path.abspath(self.file_store.db_path):
+                    self.file_store.vacuum()
+                elif os.path.abspath(path) == os.path.abspath(self.registry.db_path):
+                    self.registry.vacuum()
+                else:
+                    conn = sqlite3.connect(path, timeout=5)
+                    try:
+                        conn.execute("VACUUM")
+                    finally:
+                        conn.close()
+                vacuumed += 1
+                logger.info(f"Vacuumed {path}")
+            except sqlite3.Error as e:
+                # Usually "database is locked"; the next pass retries
+                logger.warning(f"Could not vacuum {path}: {str(e)}")
+        self.totals['databases_vacuumed'] += vacuumed
+        return vacuumed
+
+    def run_once(self) -> Dict[str, any]:
+        """Run one full pass and return what it did."""
+        with self._pass_lock:
+            started = time.time()
+            before = directory_size(self.persist_dir)
+            report = {
+                'chats_expired': self.expire_chats(),
+                'collections_expired': self.expire_collections(),
+                'indexes_collected': self.collect_unreferenced(),
+                'indexes_evicted': self.evict_to_quota(),
+                'orphans_removed': self.remove_orphans(),
+                'databases_vacuumed': self.compact()
+            }
+            after = directory_size(self.persist_dir)
+            report.update({
+                'bytes_before': before,
+                'bytes_after': after,
+                'duration_seconds': round(time.time() - started, 3),
+                'finished_at': time.time()
+            })
+            self.totals['passes'] += 1
+            self.totals['bytes_reclaimed'] += max(0, before - after)
+            self.last_report = report
+            return report
+
+    def stats(self) -> Dict[str, any]:
+        """Current disk use, registry counts and janitor history for the admin endpoint."""
+        used = directory_size(self.persist_dir)
+        owned = self._owned_bytes()
+        files = {}
+        for name in os.listdir(self.persist_dir) if os.path.isdir(self.persist_dir) else []:
+            path = os.path.join(self.persist_dir, name)
+            try:
+                files[name] = directory_size(path) if os.path.isdir(path) else os.path.getsize(path)
+            except OSError:
+                continue
+        return {
+            'disk': {
+                'used_bytes': used,
+                'owned_bytes': owned,
+                'quota_bytes': self.disk_quota_bytes,
+                'quota_used_ratio': round(owned / self.disk_quota_bytes, 4)
+                if self.disk_quota_bytes and owned is not None else None,
+                'entries': files
+            },
+            'registry': self.registry.summary(),
+            'config': {
+                'chat_ttl_seconds': self.chat_ttl_seconds,
+                'interval_seconds': self.interval_seconds,
+                'low_water_ratio': self.low_water_ratio,
+                'compact_freelist_ratio': self.compact_freelist_ratio,
+                'index_grace_seconds': self.index_grace_seconds
+            },
+            'totals': dict(self.totals),
+            'last_run': self.last_report,
+            'running': bool(self._thread and self._thread.is_alive())
+        }
@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+import logging
+from typing import Dict, Iterator, List
+
+import httpx
+import ollama
+
+logger = logging.getLogger(__name__)
+
+# Defaults; each can be overridden per process through the environment
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', 10))
+LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', 180))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BACKOFF = float(os.environ.get('LLM_RETRY_BACKOFF', 0.5))
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', 16))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_KEEPALIVE_EXPIRY', 120))
+LLM_VERIFY_TLS = os.environ.get('LLM_VERIFY_TLS', '1') != '0'
+# How long Ollama keeps a model (and its prompt cache) loaded after a call; '-1' keeps it resident
+LLM_KEEP_ALIVE = os.environ.get('LLM_KEEP_ALIVE', '30m')
+
+# Gateway errors from ngrok or a restarting Ollama are worth another attempt
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+
+def parse_keep_alive(value: str):
+    """Ollama accepts a duration string ('30m') or a number of seconds (-1 for forever)."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value or None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a failed call produced nothing and may be sent again."""
+    if isinstance(error, (httpx.TimeoutException, httpx.ConnectError, httpx.RemoteProtocolError)):
+        return True
+    return isinstance(error, ollama.ResponseError) and error.status_code in RETRYABLE_STATUS_CODES
+
+
+class LLMClient:
+    """One long-lived, pooled Ollama client per backend host.
+
+    The underlying HTTP connections are kept alive and reused across turns,
+    so only the first call pays the TCP and TLS handshake. Calls have
+    connect and read timeouts. Failures before any output (connect errors,
+    timeouts and gateway errors) are retried with exponential backoff. Call
+    counts, retries, failures and latencies are kept for ``stats()``.
+    """
+
+    def __init__(self, host: str, connect_timeout: float = LLM_CONNECT_TIMEOUT,
+                 read_timeout: float = LLM_READ_TIMEOUT, max_retries: int = LLM_MAX_RETRIES,
+                 retry_backoff: float = LLM_RETRY_BACKOFF, max_connections: int = LLM_MAX_CONNECTIONS,
+                 keepalive_expiry: float = LLM_KEEPALIVE_EXPIRY, verify: bool = LLM_VERIFY_TLS,
+                 keep_alive: str = LLM_KEEP_ALIVE):
+        self.host = host
+        self.keep_alive = parse_keep_alive(keep_alive)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                              keepalive_expiry=keepalive_expiry)
+        self._transport = httpx.HTTPTransport(verify=verify, limits=limits, retries=1)
+        self._client = ollama.Client(
+            host=host,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            transport=self._transport
+        )
+        self._probe = httpx.Client(base_url=host, transport=self._transport)
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0, 'streams': 0, 'retries': 0, 'failures': 0, 'timeouts': 0,
+            'in_flight': 0, 'total_latency_ms': 0.0, 'max_latency_ms': 0.0
+        }
+
+    def _count(self, key: str, amount: float = 1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _record_latency(self, started: float):
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._stats['total_latency_ms'] += elapsed
+            self._stats['max_latency_ms'] = max(self._stats['max_latency_ms'], elapsed)
+
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        if isinstance(error, httpx.TimeoutException):
+            self._count('timeouts')
+        return attempt < self.max_retries and is_retryable(error)
+
+    def _backoff(self, attempt: int):
+        self._count('retries')
+        time.sleep(self.retry_backoff * (2 ** attempt))
+
+    def chat(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Dict[str, any]:
+        """Non-streaming chat call with retries."""
+        if self.keep_alive is not None:
+            kwargs.setdefault('keep_alive', self.keep_alive)
+        self._count('requests')
+        self._count('in_flight')
+        started = time.perf_counter()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return self._client.chat(model=model, messages=messages, **kwargs)
+                except Exception as e:
+                    if not self._should_retry(e, attempt):
+                        self._count('failures')
+                        logger.error(f"LLM call to {self.host} failed: {str(e)}")
+                        raise
+                    logger.warning(f"Retrying LLM call to {self.host} after: {str(e)}")
+                    self._backoff(attempt)
+                    attempt += 1
+        finally:
+            self._count('in_flight', -1)
+            self._record_latency(started)
+
+    def chat_stream(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, any]]:
+        """Streaming chat call; retried only until the first chunk arrives."""
+        if self.keep_alive is not None:
+            kwargs.setdefault('keep_alive', self.keep_alive)
+        self._count('requests')
+        self._count('streams')
+        self._count('in_flight')
+        started = time.perf_counter()
+        try:
+            attempt = 0
+            while True:
+                received = False
+                try:
+                    for chunk in self._client.chat(model=model, messages=messages, stream=True, **kwargs):
+                        received = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if received or not self._should_retry(e, attempt):
+                        self._count('failures')
+                        logger.error(f"LLM stream from {self.host} failed: {str(e)}")
+                        raise
+                    logger.warning(f"Retrying LLM stream from {self.host} after: {str(e)}")
+                    self._backoff(attempt)
+                    attempt += 1
+        finally:
+            self._count('in_flight', -1)
+            self._record_latency(started)
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._stats['in_flight']
+
+    def list_models(self, timeout: float) -> List[str]:
+        """Names of the models the host serves; raises if it does not answer in time."""
+        response = self._probe.get('/api/tags', timeout=timeout)
+        response.raise_for_status()
+        return [model['name'] for model in response.json().get('models', [])]
+
+    def list_running_models(self, timeout: float) -> List[str]:
+        """Names of the models currently loaded in the host's memory; raises if it does not answer in time."""
+        response = self._probe.get('/api/ps', timeout=timeout)
+        response.raise_for_status()
+        return [model['name'] for model in response.json().get('models', [])]
+
+    def pool_stats(self) -> Dict[str, int]:
+        """Open and idle connections of the keep-alive pool."""
+        pool = getattr(self._transport, '_pool', None)
+        connections = list(getattr(pool, 'connections', []) or [])
+        idle = sum(1 for connection in connections if getattr(connection, 'is_idle', lambda: False)())
+        return {'open_connections': len(connections), 'idle_connections': idle}
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            stats = dict(self._stats)
+        completed = stats['requests'] - stats['in_flight']
+        stats['avg_latency_ms'] = round(stats['total_latency_ms'] / completed, 1) if completed else None
+        stats['total_latency_ms'] = round(stats['total_latency_ms'], 1)
+        stats['max_latency_ms'] = round(stats['max_latency_ms'], 1)
+        return {'host': self.host, **stats, **self.pool_stats()}
@@ -0,0 +1,348 @@
+import os
+import time
+import threading
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Set
+
+import httpx
+
+from llm_client import LLMClient, LLM_MAX_RETRIES, LLM_RETRY_BACKOFF, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated Ollama endpoints; when unset each app uses its own OLLAMA_URL
+LLM_BACKENDS_ENV = 'OLLAMA_URLS'
+LLM_HEALTH_INTERVAL = float(os.environ.get('LLM_HEALTH_INTERVAL', 15))
+LLM_HEALTH_TIMEOUT = float(os.environ.get('LLM_HEALTH_TIMEOUT', 5))
+# Seconds without an answer before a second backend is asked too; 0 disables hedging
+LLM_HEDGE_AFTER = float(os.environ.get('LLM_HEDGE_AFTER', 0))
+# Consecutive failed calls after which a backend is skipped until its next good health check
+LLM_FAILURE_THRESHOLD = 3
+# Weight of the newest call in a backend's moving-average latency
+LATENCY_EWMA_ALPHA = 0.2
+# A chat sticks to the backend that served it last (whose prompt cache holds its prefix)
+# unless that backend has more than this many calls over the least loaded one
+LLM_AFFINITY_SLACK = int(os.environ.get('LLM_AFFINITY_SLACK', 1))
+MAX_AFFINITY_KEYS = 1000
+
+
+def backend_hosts(default_host: str) -> List[str]:
+    """Configured backend endpoints, falling back to ``default_host``."""
+    configured = os.environ.get(LLM_BACKENDS_ENV, '')
+    hosts = [host.strip() for host in configured.split(',') if host.strip()]
+    return hosts or [default_host]
+
+
+def _serves(models: Optional[Set[str]], model: str) -> bool:
+    if models is None:
+        return True
+    return model in models or (':' not in model and f"{model}:latest" in models)
+
+
+def _resident(backend: 'Backend', model: str) -> bool:
+    """Whether ``model`` is known to be loaded in the backend's memory."""
+    return backend.resident is not None and _serves(backend.resident, model)
+
+
+class Backend:
+    """One Ollama endpoint and what the pool knows about it."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.client = LLMClient(host, max_retries=0)
+        self.healthy = True
+        # Installed models (/api/tags) decide what a backend can serve;
+        # loaded ones (/api/ps) which backend answers without a cold load
+        self.models: Optional[Set[str]] = None
+        self.resident: Optional[Set[str]] = None
+        self.consecutive_failures = 0
+        self.latency_ms: Optional[float] = None
+        self.last_checked: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def record_success(self, elapsed_ms: float, model: Optional[str] = None):
+        self.consecutive_failures = 0
+        self.healthy = True
+        if model and self.resident is not None:
+            # It answered, so the model is loaded now (and kept so for keep_alive)
+            self.resident.add(model)
+        if self.latency_ms is None:
+            self.latency_ms = elapsed_ms
+        else:
+            self.latency_ms += LATENCY_EWMA_ALPHA * (elapsed_ms - self.latency_ms)
+
+    def record_failure(self, error: Exception):
+        self.consecutive_failures += 1
+        self.last_error = str(error)
+        # An unreachable host is out at once; a slow or erroring one after repeated failures
+        if isinstance(error, httpx.ConnectError) or self.consecutive_failures >= LLM_FAILURE_THRESHOLD:
+            if self.healthy:
+                logger.warning(f"Marking LLM backend {self.host} unhealthy: {str(error)}")
+            self.healthy = False
+
+    def stats(self) -> Dict[str, any]:
+        return {
+            **self.client.stats(),
+            'healthy': self.healthy,
+            'models': sorted(self.models) if self.models is not None else None,
+            'resident': sorted(self.resident) if self.resident is not None else None,
+            'consecutive_failures': self.consecutive_failures,
+            'ewma_latency_ms': round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            'last_checked': self.last_checked,
+            'last_error': self.last_error
+        }
+
+
+class LLMPool:
+    """Routes chat calls across several Ollama backends.
+
+    A background thread polls each backend's installed and loaded models to
+    track which hosts are up, which models they serve and which they hold in
+    memory. Each call goes to the healthy backend serving the model with the
+    fewest calls in flight, ties broken by recent latency; a backend that
+    already has the model loaded is preferred while it is not much busier. Calls that fail before producing output move on to another
+    backend. With ``hedge_after`` set, a non-streaming call that has not
+    answered in that many seconds is also sent to a second backend and the
+    first answer wins.
+
+    The pool has the same ``chat``/``chat_stream`` interface as ``LLMClient``.
+    """
+
+    def __init__(self, hosts: List[str], health_interval: float = LLM_HEALTH_INTERVAL,
+                 health_timeout: float = LLM_HEALTH_TIMEOUT, hedge_after: float = LLM_HEDGE_AFTER,
+                 max_retries: int = LLM_MAX_RETRIES, retry_backoff: float = LLM_RETRY_BACKOFF):
+        if not hosts:
+            raise ValueError("LLMPool needs at least one backend")
+        self.backends = [Backend(host) for host in dict.fromkeys(hosts)]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.hedge_after = hedge_after
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(self.backends), thread_name_prefix='llm-hedge')
+        self._affinity: 'OrderedDict[str, Backend]' = OrderedDict()
+        self._stats = {'failovers': 0, 'hedged': 0, 'hedge_wins': 0, 'affinity_hits': 0, 'affinity_moves': 0}
+
+    def start(self):
+        """Start the background health checks."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._health_loop, name='llm-health', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _health_loop(self):
+        while not self._stop.is_set():
+            self.check_health()
+            self._stop.wait(self.health_interval)
+
+    def check_health(self):
+        """Probe every backend once for reachability, its installed models and its loaded models."""
+        for backend in self.backends:
+            try:
+                models = set(backend.client.list_models(self.health_timeout))
+                try:
+                    resident = set(backend.client.list_running_models(self.health_timeout))
+                except Exception as e:
+                    # Older Ollama releases have no /api/ps; routing then ignores residency
+                    logger.debug(f"LLM backend {backend.host} did not list loaded models: {str(e)}")
+                    resident = None
+                with self._lock:
+                    if not backend.healthy:
+                        logger.info(f"LLM backend {backend.host} is healthy again")
+                    backend.models = models
+                    backend.resident = resident
+                    backend.healthy = True
+                    backend.consecutive_failures = 0
+                    backend.last_error = None
+            except Exception as e:
+                with self._lock:
+                    if backend.healthy:
+                        logger.warning(f"LLM backend {backend.host} failed its health check: {str(e)}")
+                    backend.healthy = False
+                    backend.last_error = str(e)
+            backend.last_checked = time.time()
+
+    def healthy_count(self) -> int:
+        """Number of backends currently considered up (at least one, as routing never refuses)."""
+        with self._lock:
+            return max(1, sum(1 for backend in self.backends if backend.healthy))
+
+    def serves(self, model: str) -> Optional[bool]:
+        """Whether any backend serves ``model``; None until a health check has listed models."""
+        with self._lock:
+            known = [backend.models for backend in self.backends if backend.models is not None]
+        if not known:
+            return None
+        return any(_serves(models, model) for models in known)
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _choose(self, model: str, exclude: Set[Backend] = frozenset(), affinity: Optional[str] = None) -> Optional[Backend]:
+        """Least-loaded healthy backend serving ``model``, relaxing each condition when none qualifies.
+
+        A backend holding the model in memory wins over a slightly less
+        loaded one that would have to load it first. With an ``affinity`` key (a chat id) the backend that served the key
+        last is kept while it is not much busier than the rest, so follow-up
+        turns land where their prompt prefix is already cached.
+        """
+        with self._lock:
+            untried = [backend for backend in self.backends if backend not in exclude]
+            healthy = [backend for backend in untried if backend.healthy]
+            serving = [backend for backend in healthy if _serves(backend.models, model)]
+            # Health state can be stale, so a request is never refused only because every backend looks down
+            candidates = serving or healthy or untried
+            if not candidates:
+                return None
+
+            def load(backend: Backend):
+                return backend.client.in_flight, backend.latency_ms if backend.latency_ms is not None else 0.0
+
+            chosen = min(candidates, key=load)
+            warm = [backend for backend in candidates if _resident(backend, model)]
+            if warm and not _resident(chosen, model):
+                # Loading a model costs seconds; a warm backend is worth a slightly longer queue
+                warmest = min(warm, key=load)
+                if warmest.client.in_flight <= chosen.client.in_flight + LLM_AFFINITY_SLACK:
+                    chosen = warmest
+            if affinity is None or len(self.backends) == 1:
+                return chosen
+            preferred = self._affinity.get(affinity)
+            if (preferred in candidates and (_resident(preferred, model) or not _resident(chosen, model))
+                    and preferred.client.in_flight <= chosen.client.in_flight + LLM_AFFINITY_SLACK):
+                chosen = preferred
+                self._stats['affinity_hits'] += 1
+            elif preferred is not None:
+                self._stats['affinity_moves'] += 1
+            self._affinity[affinity] = chosen
+            self._affinity.move_to_end(affinity)
+            if len(self._affinity) > MAX_AFFINITY_KEYS:
+                self._affinity.popitem(last=False)
+            return chosen
+
+    def _call(self, backend: Backend, model: str, messages: List[Dict[str, str]], **kwargs) -> Dict[str, any]:
+        started = time.perf_counter()
+        try:
+            response = backend.client.chat(model, messages, **kwargs)
+        except Exception as e:
+            if is_retryable(e):
+                with self._lock:
+                    backend.record_failure(e)
+            raise
+        with self._lock:
+            backend.record_success((time.perf_counter() - started) * 1000, model)
+        return response
+
+    def _hedged_call(self, primary: Backend, model: str, messages: List[Dict[str, str]],
+                     tried: Set[Backend], **kwargs) -> Dict[str, any]:
+        first = self._executor.submit(self._call, primary, model, messages, **kwargs)
+        try:
+            return first.result(timeout=self.hedge_after)
+        except FutureTimeout:
+            pass
+
+        secondary = self._choose(model, tried | {primary})
+        if secondary is None:
+            return first.result()
+        self._count('hedged')
+        logger.info(f"Hedging slow LLM call on {primary.host} to {secondary.host}")
+        second = self._executor.submit(self._call, secondary, model, messages, **kwargs)
+
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count('hedge_wins')
+                    # The slower call cannot be aborted mid-generation; its answer is discarded
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def chat(self, model: str, messages: List[Dict[str, str]], affinity: Optional[str] = None,
+             **kwargs) -> Dict[str, any]:
+        """Non-streaming chat on the best backend, failing over (and hedging) as configured."""
+        tried: Set[Backend] = set()
+        attempt = 0
+        while True:
+            backend = self._choose(model, tried, affinity) or self._choose(model)
+            try:
+                if self.hedge_after > 0 and len(self.backends) > 1:
+                    return self._hedged_call(backend, model, messages, tried, **kwargs)
+                return self._call(backend, model, messages, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                attempt += 1
+                tried.add(backend)
+                self._count('failovers')
+                logger.warning(f"LLM call on {backend.host} failed, trying again: {str(e)}")
+                if len(tried) >= len(self.backends):
+                    time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+
+    def chat_stream(self, model: str, messages: List[Dict[str, str]], affinity: Optional[str] = None,
+                    **kwargs) -> Iterator[Dict[str, any]]:
+        """Streaming chat on the best backend; fails over only until the first chunk arrives."""
+        tried: Set[Backend] = set()
+        attempt = 0
+        while True:
+            backend = self._choose(model, tried, affinity) or self._choose(model)
+            started = time.perf_counter()
+            received = False
+            try:
+                for chunk in backend.client.chat_stream(model, messages, **kwargs):
+                    received = True
+                    yield chunk
+                with self._lock:
+                    backend.record_success((time.perf_counter() - started) * 1000, model)
+                return
+            except Exception as e:
+                if is_retryable(e):
+                    with self._lock:
+                        backend.record_failure(e)
+                if received or attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                attempt += 1
+                tried.add(backend)
+                self._count('failovers')
+                logger.warning(f"LLM stream on {backend.host} failed, trying again: {str(e)}")
+                if len(tried) >= len(self.backends):
+                    time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            **stats,
+            'hedge_after_seconds': self.hedge_after or None,
+            'backends': [backend.stats() for backend in self.backends]
+        }
+
+
+
+_pools: Dict[tuple, LLMPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_llm_pool(default_host: str) -> LLMPool:
+    """The shared pool for the configured backends (or ``default_host``), started on first use."""
+    hosts = tuple(backend_hosts(default_host))
+    with _pools_lock:
+        if hosts not in _pools:
+            pool = LLMPool(list(hosts))
+            pool.start()
+            _pools[hosts] = pool
+            logger.info(f"Created LLM pool over {len(hosts)} backend(s): {', '.join(hosts)}")
+        return _pools[hosts]
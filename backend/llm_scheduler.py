@@ -0,0 +1,328 @@
+import os
+import math
+import time
+import itertools
+import threading
+import logging
+from collections import OrderedDict, deque
+from typing import Dict, Iterator, List, Optional
+
+from llm_pool import LLMPool, get_llm_pool
+from cancellation import CancelToken, RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first: answers the user is waiting on, then query refinement, then code generation
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REFINE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_REFINE: 'refine', PRIORITY_BACKGROUND: 'background'}
+
+# Concurrent LLM calls admitted per healthy backend; more only queue up inside Ollama
+LLM_CONCURRENCY_PER_BACKEND = int(os.environ.get('LLM_CONCURRENCY_PER_BACKEND', 2))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', 32))
+# Extra slots only query refinement may use: a refinement must not queue behind the speculative
+# answer it is racing (it is small, with a capped num_predict)
+LLM_REFINE_SLOTS = int(os.environ.get('LLM_REFINE_SLOTS', 1))
+# Longest a call may wait for a slot before it is rejected
+LLM_MAX_QUEUE_WAIT = float(os.environ.get('LLM_MAX_QUEUE_WAIT', 60))
+# Share of the queue each priority may fill, so background work cannot crowd out answers
+QUEUE_SHARE = {PRIORITY_INTERACTIVE: 1.0, PRIORITY_REFINE: 0.75, PRIORITY_BACKGROUND: 0.5}
+# A waiting call is promoted one priority level per this many seconds, so nothing starves
+PRIORITY_AGING_SECONDS = 20
+# Chats whose last slot grant is remembered for round-robin ordering
+MAX_TRACKED_CHATS = 1000
+# Service times kept for the Retry-After estimate and wait percentiles
+RECENT_SAMPLES = 200
+
+
+class SchedulerBusy(Exception):
+    """The LLM queue is full or a call waited too long; retry after ``retry_after`` seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ('seq', 'chat_id', 'priority', 'enqueued_at', 'granted', 'reserved')
+
+    def __init__(self, seq: int, chat_id: Optional[str], priority: int):
+        self.seq = seq
+        self.chat_id = chat_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        # Granted one of the refinement-only slots
+        self.reserved = False
+
+
+class Slot:
+    """Permission to run one LLM call; release exactly once (extra releases are ignored)."""
+
+    def __init__(self, scheduler: 'LLMScheduler', ticket: _Ticket):
+        self._scheduler = scheduler
+        self._ticket = ticket
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self._ticket, time.monotonic() - self._started)
+
+    def __enter__(self) -> 'Slot':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class _ScheduledStream:
+    """Chunk iterator that holds a slot until it is exhausted, fails or is closed."""
+
+    def __init__(self, slot: Slot, chunks: Iterator[Dict[str, any]]):
+        self._slot = slot
+        self._chunks = chunks
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict[str, any]:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self._slot.release()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self._chunks, 'close', None)
+            if close:
+                close()
+        finally:
+            self._slot.release()
+
+
+class LLMScheduler:
+    """Admits LLM calls to a backend pool through bounded concurrency.
+
+    At most ``concurrency_per_backend`` calls per healthy backend run at once;
+    the rest wait. When a slot frees up it goes to the waiting call with the
+    best priority, aged by time waited. Among equals it goes to the chat with
+    the fewest calls already running, then to the chat served longest ago,
+    so one busy chat cannot monopolise the model. Calls are rejected with
+    ``SchedulerBusy`` (carrying a retry hint) when their priority's share of
+    the queue is full or they wait longer than ``max_wait``. Query
+    refinement also has ``refine_slots`` slots of its own on top, so it
+    never waits behind the answers it is meant to improve.
+
+    ``chat`` and ``chat_stream`` mirror ``LLMPool`` with added ``chat_id``
+    and ``priority`` arguments; the chat id doubles as the pool's backend
+    affinity key.
+    """
+
+    def __init__(self, pool: LLMPool, concurrency_per_backend: int = LLM_CONCURRENCY_PER_BACKEND,
+                 max_queue: int = LLM_MAX_QUEUE, max_wait: float = LLM_MAX_QUEUE_WAIT,
+                 refine_slots: int = LLM_REFINE_SLOTS):
+        self.pool = pool
+        self.concurrency_per_backend = concurrency_per_backend
+        self.refine_slots = refine_slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._condition = threading.Condition()
+        self._waiting: List[_Ticket] = []
+        self._running = 0
+        self._running_reserved = 0
+        self._running_by_chat: Dict[Optional[str], int] = {}
+        self._last_grant: 'OrderedDict[str, int]' = OrderedDict()
+        self._seq = itertools.count()
+        self._grants = itertools.count()
+        self._waits = deque(maxlen=RECENT_SAMPLES)
+        self._service_times = deque(maxlen=RECENT_SAMPLES)
+        self._stats = {'admitted': 0, 'rejected_full': 0, 'rejected_timeout': 0, 'cancelled': 0, 'max_queue_depth': 0}
+        self._admitted_by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+
+    def capacity(self) -> int:
+        return self.concurrency_per_backend * self.pool.healthy_count()
+
+    def _retry_after(self) -> int:
+        """Rough seconds until a new call would get a slot, from recent service times."""
+        average = (sum(self._service_times) / len(self._service_times)) if self._service_times else 5.0
+        return max(1, min(60, math.ceil((len(self._waiting) + 1) * average / max(1, self.capacity()))))
+
+    def _rank(self, ticket: _Ticket, now: float):
+        aged = ticket.priority - int((now - ticket.enqueued_at) / PRIORITY_AGING_SECONDS)
+        if ticket.chat_id is None:
+            return (aged, 0, -1, ticket.seq)
+        # Round robin: chats with fewer running calls, then the one served longest ago
+        return (aged, self._running_by_chat.get(ticket.chat_id, 0), self._last_grant.get(ticket.chat_id, -1), ticket.seq)
+
+    def _grant(self):
+        """Hand free slots to the best waiting tickets; caller holds the condition."""
+        granted = False
+        while self._waiting:
+            if self._running < self.capacity():
+                eligible = self._waiting
+                reserved = False
+            elif self._running_reserved < self.refine_slots:
+                eligible = [waiting for waiting in self._waiting if waiting.priority == PRIORITY_REFINE]
+                reserved = True
+                if not eligible:
+                    break
+            else:
+                break
+            now = time.monotonic()
+            ticket = min(eligible, key=lambda waiting: self._rank(waiting, now))
+            self._waiting.remove(ticket)
+            ticket.granted = True
+            ticket.reserved = reserved
+            if reserved:
+                self._running_reserved += 1
+            else:
+                self._running += 1
+            self._running_by_chat[ticket.chat_id] = self._running_by_chat.get(ticket.chat_id, 0) + 1
+            if ticket.chat_id is not None:
+                self._last_grant[ticket.chat_id] = next(self._grants)
+                self._last_grant.move_to_end(ticket.chat_id)
+                if len(self._last_grant) > MAX_TRACKED_CHATS:
+                    self._last_grant.popitem(last=False)
+            granted = True
+        if granted:
+            self._condition.notify_all()
+
+    def _wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def acquire(self, chat_id: Optional[str] = None, priority: int = PRIORITY_INTERACTIVE,
+                cancel: Optional[CancelToken] = None, max_wait: Optional[float] = None) -> Slot:
+        """Wait for a slot; raises ``SchedulerBusy`` when the call should be retried later.
+
+        A cancelled ``cancel`` token takes the call out of the queue with
+        ``RequestCancelled``. ``max_wait`` shortens the wait limit, e.g. to a
+        request's remaining deadline.
+        """
+        wait_limit = self.max_wait if max_wait is None else min(self.max_wait, max_wait)
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+            remove_callback = cancel.add_callback(self._wake)
+            try:
+                return self._acquire(chat_id, priority, cancel, wait_limit)
+            finally:
+                remove_callback()
+        return self._acquire(chat_id, priority, None, wait_limit)
+
+    def _acquire(self, chat_id: Optional[str], priority: int, cancel: Optional[CancelToken], wait_limit: float) -> Slot:
+        with self._condition:
+            if len(self._waiting) >= self.max_queue * QUEUE_SHARE.get(priority, 1.0):
+                self._stats['rejected_full'] += 1
+                retry_after = self._retry_after()
+                logger.warning(f"LLM queue full ({len(self._waiting)} waiting), rejecting {PRIORITY_NAMES.get(priority)} call")
+                raise SchedulerBusy("The model is busy. Please try again shortly.", retry_after)
+
+            ticket = _Ticket(next(self._seq), chat_id, priority)
+            self._waiting.append(ticket)
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._waiting))
+            self._grant()
+            deadline = ticket.enqueued_at + wait_limit
+            while not ticket.granted:
+                if cancel is not None and cancel.cancelled:
+                    self._waiting.remove(ticket)
+                    self._stats['cancelled'] += 1
+                    raise RequestCancelled(f"LLM call for chat {chat_id} cancelled while queued")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    self._stats['rejected_timeout'] += 1
+                    logger.warning(f"LLM call for chat {chat_id} waited {round(wait_limit, 1)}s without a slot")
+                    raise SchedulerBusy("The model is busy. Please try again shortly.", self._retry_after())
+                # Re-check periodically: a backend coming back raises capacity without a release
+                self._condition.wait(min(remaining, 1.0))
+                self._grant()
+
+            self._waits.append(time.monotonic() - ticket.enqueued_at)
+            self._stats['admitted'] += 1
+            self._admitted_by_priority[PRIORITY_NAMES.get(priority, str(priority))] += 1
+        return Slot(self, ticket)
+
+    def _release(self, ticket: _Ticket, service_time: float):
+        with self._condition:
+            if ticket.reserved:
+                self._running_reserved -= 1
+            else:
+                self._running -= 1
+            remaining = self._running_by_chat.get(ticket.chat_id, 1) - 1
+            if remaining:
+                self._running_by_chat[ticket.chat_id] = remaining
+            else:
+                self._running_by_chat.pop(ticket.chat_id, None)
+            self._service_times.append(service_time)
+            self._grant()
+
+    def chat(self, model: str, messages: List[Dict[str, str]], chat_id: Optional[str] = None,
+             priority: int = PRIORITY_INTERACTIVE, cancel: Optional[CancelToken] = None,
+             max_wait: Optional[float] = None, **kwargs) -> Dict[str, any]:
+        with self.acquire(chat_id, priority, cancel, max_wait):
+            return self.pool.chat(model, messages, affinity=chat_id, **kwargs)
+
+    def chat_stream(self, model: str, messages: List[Dict[str, str]], chat_id: Optional[str] = None,
+                    priority: int = PRIORITY_INTERACTIVE, cancel: Optional[CancelToken] = None,
+                    max_wait: Optional[float] = None, **kwargs) -> Iterator[Dict[str, any]]:
+        """Acquire a slot now (so rejection happens before a response starts) and stream under it.
+
+        The returned iterator releases the slot when exhausted or closed;
+        closing it also aborts the model request.
+        """
+        slot = self.acquire(chat_id, priority, cancel, max_wait)
+        return _ScheduledStream(slot, self.pool.chat_stream(model, messages, affinity=chat_id, **kwargs))
+
+    def stats(self) -> Dict[str, any]:
+        with self._condition:
+            waits = sorted(self._waits)
+            now = time.monotonic()
+            stats = {
+                **self._stats,
+                'capacity': self.capacity(),
+                'running': self._running,
+                'refine_slots': self.refine_slots,
+                'running_refine_slots': self._running_reserved,
+                'queue_depth': len(self._waiting),
+                'queue_depth_by_priority': {
+                    name: sum(1 for ticket in self._waiting if ticket.priority == priority)
+                    for priority, name in PRIORITY_NAMES.items()
+                },
+                'oldest_wait_ms': round(max((now - ticket.enqueued_at for ticket in self._waiting), default=0) * 1000, 1),
+                'admitted_by_priority': dict(self._admitted_by_priority)
+            }
+        stats['wait_ms_p50'] = _percentile_ms(waits, 0.5)
+        stats['wait_ms_p95'] = _percentile_ms(waits, 0.95)
+        stats['wait_ms_max'] = _percentile_ms(waits, 1.0)
+        return stats
+
+
+def _percentile_ms(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return round(sorted_values[index] * 1000, 1)
+
+
+_schedulers: Dict[int, LLMScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_llm_scheduler(default_host: str) -> LLMScheduler:
+    """The shared scheduler in front of the pool for ``default_host`` (or the configured backends)."""
+    pool = get_llm_pool(default_host)
+    with _schedulers_lock:
+        if id(pool) not in _schedulers:
+            _schedulers[id(pool)] = LLMScheduler(pool)
+        return _schedulers[id(pool)]
+
+
+def llm_stats() -> List[Dict[str, any]]:
+    """Scheduler and backend stats of every LLM pool in this process."""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return [{'scheduler': scheduler.stats(), **scheduler.pool.stats()} for scheduler in schedulers]
@@ -0,0 +1,123 @@
+import os
+import json
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Task types an LLM call can be made for
+TASK_ANSWER = 'answer'
+TASK_REFINE = 'refine'
+TASK_CLASSIFY = 'classify'
+TASK_SUMMARIZE = 'summarize'
+TASK_CODEGEN = 'codegen'
+TASKS = (TASK_ANSWER, TASK_REFINE, TASK_CLASSIFY, TASK_SUMMARIZE, TASK_CODEGEN)
+
+# Cheap model auxiliary tasks default to; deployments without it fall back to the answer model
+SMALL_MODEL = 'llama3.2:3b'
+
+# Deployment overrides: a JSON file of {task: {model, max_tokens, context_tokens}} and
+# MODEL_ROUTE_<TASK>=<model> variables, applied in that order over each app's defaults
+MODEL_ROUTES_FILE_ENV = 'MODEL_ROUTES_FILE'
+MODEL_ROUTE_ENV_PREFIX = 'MODEL_ROUTE_'
+
+AUXILIARY_DEFAULTS = {
+    TASK_REFINE: {'model': SMALL_MODEL, 'max_tokens': 64},
+    TASK_CLASSIFY: {'model': SMALL_MODEL, 'max_tokens': 16},
+    TASK_SUMMARIZE: {'model': SMALL_MODEL, 'max_tokens': 300},
+}
+
+
+class Route:
+    """Model and token limits for one task type."""
+
+    def __init__(self, task: str, model: str, max_tokens: Optional[int] = None,
+                 context_tokens: Optional[int] = None):
+        self.task = task
+        self.model = model
+        self.max_tokens = max_tokens
+        self.context_tokens = context_tokens
+
+    def options(self) -> Dict[str, int]:
+        """Ollama request options enforcing the route's limits."""
+        options = {}
+        if self.max_tokens:
+            options['num_predict'] = self.max_tokens
+        if self.context_tokens:
+            options['num_ctx'] = self.context_tokens
+        return options
+
+    def to_dict(self) -> Dict[str, any]:
+        return {'model': self.model, 'max_tokens': self.max_tokens, 'context_tokens': self.context_tokens}
+
+
+class ModelRouter:
+    """Maps task types to models, so auxiliary steps can run on a cheaper model than answers.
+
+    ``serves`` (typically ``LLMPool.serves``) reports whether any backend has
+    a model; a task routed to a model no backend serves falls back to the
+    answer route instead of failing.
+    """
+
+    def __init__(self, routes: Dict[str, Route], serves=None):
+        if TASK_ANSWER not in routes:
+            raise ValueError("A model routing table needs an 'answer' route")
+        self.routes = routes
+        self.serves = serves
+        self._fallbacks_logged = set()
+
+    def route(self, task: str) -> Route:
+        route = self.routes.get(task) or self.routes[TASK_ANSWER]
+        if route.task != TASK_ANSWER and self.serves is not None and self.serves(route.model) is False:
+            answer = self.routes[TASK_ANSWER]
+            if task not in self._fallbacks_logged:
+                self._fallbacks_logged.add(task)
+                logger.warning(f"No backend serves {route.model} for {task}; using {answer.model}")
+            return Route(task, answer.model, route.max_tokens, route.context_tokens)
+        return route
+
+    def model(self, task: str) -> str:
+        return self.route(task).model
+
+    def options(self, task: str) -> Dict[str, int]:
+        return self.route(task).options()
+
+    def table(self) -> Dict[str, Dict[str, any]]:
+        return {task: route.to_dict() for task, route in self.routes.items()}
+
+
+def load_model_routes(defaults: Dict[str, Dict[str, any]], serves=None) -> ModelRouter:
+    """Build the routing table from an app's defaults plus deployment overrides.
+
+    ``defaults`` maps task types to ``{'model', 'max_tokens', 'context_tokens'}``
+    and must include the answer task; auxiliary tasks not listed use the
+    shared small-model defaults.
+    """
+    merged = {task: dict(spec) for task, spec in AUXILIARY_DEFAULTS.items()}
+    for task, spec in defaults.items():
+        merged.setdefault(task, {}).update(spec)
+
+    routes_file = os.environ.get(MODEL_ROUTES_FILE_ENV)
+    if routes_file:
+        try:
+            with open(routes_file, 'r', encoding='utf-8') as f:
+                for task, spec in json.load(f).items():
+                    merged.setdefault(task, {}).update(spec)
+            logger.info(f"Loaded model routes from {routes_file}")
+        except Exception as e:
+            logger.error(f"Error loading model routes from {routes_file}: {str(e)}")
+            raise
+
+    for task in TASKS:
+        model = os.environ.get(f"{MODEL_ROUTE_ENV_PREFIX}{task.upper()}")
+        if model:
+            merged.setdefault(task, {})['model'] = model
+
+    routes = {}
+    for task, spec in merged.items():
+        if not spec.get('model'):
+            raise ValueError(f"Model route for '{task}' has no model")
+        routes[task] = Route(task, spec['model'], spec.get('max_tokens'), spec.get('context_tokens'))
+    router = ModelRouter(routes, serves)
+    logger.info("Model routes: " + ", ".join(f"{task}={route.model}" for task, route in routes.items()))
+    return router
@@ -0,0 +1,33 @@
+import hashlib
+from typing import Dict, List
+
+# Ollama reuses its KV cache for the longest prompt prefix it has already evaluated,
+# so everything that changes from turn to turn goes last:
+#   system (instructions + pinned repository context, byte-stable per chat)
+#   history (summary + recent turns, only ever appended to)
+#   user (this turn's retrieved context + question)
+
+
+def turn_message(query: str, context: str = '', instructions: str = '') -> Dict[str, str]:
+    """The final user message, carrying what was retrieved for this question only."""
+    parts = []
+    if instructions:
+        parts.append(instructions)
+    if context:
+        parts.append(f"Relevant code for this question:\n{context}")
+    parts.append(f"Question: {query}" if parts else query)
+    return {"role": "user", "content": "\n\n".join(parts)}
+
+
+def build_messages(prefix: str, history: List[Dict[str, str]], query: str, context: str = '',
+                   instructions: str = '') -> List[Dict[str, str]]:
+    """Messages with a stable ``prefix`` system message, the history, then this turn's context and question."""
+    messages = [{"role": "system", "content": prefix}]
+    messages.extend(history)
+    messages.append(turn_message(query, context, instructions))
+    return messages
+
+
+def prefix_digest(messages: List[Dict[str, str]]) -> str:
+    """Short fingerprint of the pinned system prefix, reported so prefix churn is visible."""
+    return hashlib.sha1(messages[0]['content'].encode('utf-8')).hexdigest()[:12]
@@ -0,0 +1,198 @@
+import os
+import re
+import ast
+import json
+import logging
+from typing import Dict, List, Tuple
+
+from chunkers import C_FAMILY_EXTENSIONS, brace_declarations
+
+logger = logging.getLogger(__name__)
+
+# Long signatures and docstrings are cut; the outline is a map, not a copy
+MAX_SIGNATURE_CHARS = 160
+MAX_DOC_CHARS = 100
+MAX_IMPORTS_PER_FILE = 15
+MAX_HEADINGS_PER_FILE = 12
+
+_IMPORT_LINE_RE = re.compile(
+    r'^\s*(?:import\s|export\s+\*?\s*(?:\{[^}]*\}\s*)?from\s|from\s+\S+\s+import\s|#include\s|using\s+[\w.]+\s*;|'
+    r'use\s+[\w:{}, ]+;|package\s+[\w.]+|(?:const|let|var)\s+[\w{}\s,]+=\s*require\()'
+)
+_IMPORT_SOURCE_RE = re.compile(r'''(?:from\s+|require\(\s*|#include\s*|import\s+)['"<]?([\w@./:-]+)''')
+_MARKDOWN_HEADING_RE = re.compile(r'^(#{1,3})\s+(.+)$')
+
+
+def _clip(text: str, limit: int) -> str:
+    text = ' '.join(text.split())
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+
+def _python_signature(node: ast.AST) -> str:
+    if isinstance(node, ast.ClassDef):
+        bases = ', '.join(ast.unparse(base) for base in node.bases)
+        return f"class {node.name}({bases})" if bases else f"class {node.name}"
+    prefix = 'async def' if isinstance(node, ast.AsyncFunctionDef) else 'def'
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns else ''
+    return f"{prefix} {node.name}({ast.unparse(node.args)}){returns}"
+
+
+def outline_python(content: str) -> Tuple[List[str], List[str]]:
+    """Imports and indented class/function signatures (with first docstring lines) of a Python file."""
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError):
+        return [], []
+
+    imports = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            imports.append('.' * node.level + (node.module or ''))
+
+    entries = []
+
+    def visit(body: List[ast.stmt], depth: int):
+        for node in body:
+            if not isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            line = '  ' * depth + _clip(_python_signature(node), MAX_SIGNATURE_CHARS)
+            docstring = ast.get_docstring(node)
+            if docstring and docstring.strip():
+                line += f"  # {_clip(docstring.strip().splitlines()[0], MAX_DOC_CHARS)}"
+            entries.append(line)
+            # Methods are part of a class's interface; nested helpers inside functions are not
+            if isinstance(node, ast.ClassDef):
+                visit(node.body, depth + 1)
+
+    visit(tree.body, 0)
+    return imports, entries
+
+
+def _leading_comment(lines: List[str], line_number: int) -> str:
+    """First meaningful line of the comment block right above ``line_number`` (1-based)."""
+    index = line_number - 2
+    block = []
+    while index >= 0:
+        stripped = lines[index].strip()
+        if not stripped.startswith(('//', '/*', '*', '#')) or stripped.startswith('#include'):
+            break
+        block.append(stripped)
+        index -= 1
+    for text in reversed(block):
+        text = text.lstrip('/*#! ').rstrip('*/ ').strip()
+        if text and not text.startswith('@'):
+            return text
+    return ''
+
+
+def outline_c_family(content: str, file_path: str) -> Tuple[List[str], List[str]]:
+    """Imports and indented declaration headers (with leading doc comments) of a brace-delimited file."""
+    lines = content.split('\n')
+    imports = []
+    for line in lines:
+        if _IMPORT_LINE_RE.match(line):
+            match = _IMPORT_SOURCE_RE.search(line)
+            imports.append(match.group(1) if match else line.strip())
+
+    entries = []
+    for unit in brace_declarations(content, file_path):
+        header = ' '.join(lines[unit['start_line'] - 1:unit['open_line']])
+        header = header.split('{', 1)[0] if '{' in header else header
+        header = _clip(header.strip().rstrip('=>').strip(), MAX_SIGNATURE_CHARS)
+        if not header or header.startswith('return'):
+            continue
+        line = '  ' * unit['depth'] + header
+        doc = _leading_comment(lines, unit['start_line'])
+        if doc:
+            line += f"  // {_clip(doc, MAX_DOC_CHARS)}"
+        entries.append(line)
+    return imports, entries
+
+
+def outline_markdown(content: str) -> List[str]:
+    headings = []
+    for line in content.split('\n'):
+        match = _MARKDOWN_HEADING_RE.match(line)
+        if match:
+            headings.append('  ' * (len(match.group(1)) - 1) + _clip(match.group(2), MAX_SIGNATURE_CHARS))
+            if len(headings) >= MAX_HEADINGS_PER_FILE:
+                break
+    return headings
+
+
+def outline_package_json(content: str) -> List[str]:
+    try:
+        package = json.loads(content)
+    except ValueError:
+        return []
+    if not isinstance(package, dict):
+        return []
+    entries = []
+    if package.get('name'):
+        entries.append(f"name: {package['name']}")
+    for key in ('scripts', 'dependencies', 'devDependencies'):
+        if isinstance(package.get(key), dict) and package[key]:
+            entries.append(f"{key}: {_clip(', '.join(package[key]), MAX_SIGNATURE_CHARS * 2)}")
+    return entries
+
+
+def directory_tree(paths: List[str]) -> List[str]:
+    """Indented directory tree of the given relative paths."""
+    tree: Dict[str, any] = {}
+    for path in paths:
+        node = tree
+        for part in path.replace('\\', '/').split('/'):
+            node = node.setdefault(part, {})
+
+    rendered = []
+
+    def walk(node: Dict[str, any], depth: int):
+        # Directories first, then files, each alphabetically
+        for name in sorted(node, key=lambda name: (not node[name], name)):
+            rendered.append('  ' * depth + (f"{name}/" if node[name] else name))
+            walk(node[name], depth + 1)
+
+    walk(tree, 0)
+    return rendered
+
+
+def build_outline(files: List[Tuple[str, str]]) -> str:
+    """Compact outline of a repository: directory tree, then per-file imports and signatures.
+
+    Files without any imports, declarations or headings appear only in the tree.
+    """
+    sections = ["Directory tree:"]
+    sections.extend(directory_tree([path for path, _ in files]))
+
+    for path, content in files:
+        ext = os.path.splitext(path)[1].lower()
+        name = os.path.basename(path)
+        imports, entries = [], []
+        try:
+            if ext in {'.py', '.pyi'}:
+                imports, entries = outline_python(content)
+            elif ext in C_FAMILY_EXTENSIONS:
+                imports, entries = outline_c_family(content, path)
+            elif ext in {'.md', '.rst'}:
+                entries = outline_markdown(content)
+            elif name == 'package.json':
+                entries = outline_package_json(content)
+        except Exception as e:
+            # One unusual file must not cost the whole outline
+            logger.warning(f"Could not outline {path}: {str(e)}")
+            continue
+        if not imports and not entries:
+            continue
+
+        sections.append(f"\nFile: {path} ({content.count(chr(10)) + 1} lines)")
+        if imports:
+            unique = list(dict.fromkeys(imports))
+            shown = ', '.join(unique[:MAX_IMPORTS_PER_FILE])
+            if len(unique) > MAX_IMPORTS_PER_FILE:
+                shown += f", ... ({len(unique) - MAX_IMPORTS_PER_FILE} more)"
+            sections.append(f"  imports: {shown}")
+        sections.extend('  ' + entry for entry in entries)
+
+    return '\n'.join(sections)
@@ -0,0 +1,428 @@
+import os
+import mmap
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FILE_SEPARATOR = "=" * 80
+HEADER_SEPARATOR = "-" * 80
+
+
+class RepoContentStore:
+    """Disk-backed store for the full text of loaded repositories.
+
+    Each distinct repository snapshot is one blob file of individually
+    zlib-compressed files, written once; identical files within a snapshot
+    are stored once, and a snapshot whose files and header match an existing
+    one reuses its blob. A SQLite catalog keeps the per-file offset index and
+    which snapshot each chat references, so a restart only reopens the
+    catalog. Blobs are memory-mapped on first use and rendered contents are
+    kept in a byte-bounded LRU of hot repositories.
+
+    Snapshots stored with a commit SHA can be attached to another chat by
+    repo@commit without cloning again, together with their precomputed
+    outline.
+
+    Chats idle for longer than ``chat_ttl_seconds`` release their snapshot,
+    and while the blobs exceed ``disk_quota_bytes`` the least recently used
+    snapshots are evicted (their chats must load the repository again).
+    """
+
+    def __init__(self, root: str = './repo_store', hot_cache_bytes: int = 256 * 1024 * 1024,
+                 compression_level: int = 6, disk_quota_bytes: Optional[int] = 2 * 1024 ** 3,
+                 chat_ttl_seconds: Optional[float] = 14 * 24 * 3600):
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.root = root
+        self.hot_cache_bytes = hot_cache_bytes
+        self.compression_level = compression_level
+        self.disk_quota_bytes = disk_quota_bytes
+        self.chat_ttl_seconds = chat_ttl_seconds
+        self._lock = threading.RLock()
+        self._hot: 'OrderedDict[str, str]' = OrderedDict()
+        self._hot_size = 0
+        self._maps: Dict[str, Tuple[object, mmap.mmap]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = sqlite3.connect(os.path.join(root, 'catalog.db'), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS repos (
+                repo_key TEXT PRIMARY KEY,
+                repo_url TEXT,
+                header TEXT NOT NULL,
+                file_count INTEGER,
+                raw_bytes INTEGER,
+                stored_bytes INTEGER,
+                created_at REAL,
+                outline BLOB
+            )
+        """)
+        # Catalogs created before outlines were stored lack the column
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(repos)")}
+        if 'outline' not in columns:
+            self._conn.execute("ALTER TABLE repos ADD COLUMN outline BLOB")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS commits (
+                repo_url TEXT NOT NULL,
+                commit_sha TEXT NOT NULL,
+                repo_key TEXT NOT NULL,
+                PRIMARY KEY (repo_url, commit_sha)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                repo_key TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                file_path TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                raw_size INTEGER NOT NULL,
+                PRIMARY KEY (repo_key, position)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_refs (
+                chat_id TEXT PRIMARY KEY,
+                repo_key TEXT NOT NULL,
+                last_accessed REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON files(repo_key, file_path)")
+        self._conn.commit()
+
+    def _blob_path(self, repo_key: str) -> str:
+        return os.path.join(self.root, f"{repo_key}.blob")
+
+    def put(self, chat_id: str, repo_url: str, header: str, files: List[Tuple[str, str]],
+            commit_sha: Optional[str] = None, outline: Optional[str] = None) -> str:
+        """Store a repository snapshot for a chat and return its key.
+
+        ``files`` is a list of ``(relative_path, content)`` in display order;
+        ``header`` is the text rendered before the first file. With a
+        ``commit_sha`` the snapshot is also findable by ``attach_commit``.
+        """
+        try:
+            digests = [hashlib.sha1(content.encode('utf-8')).hexdigest() for _, content in files]
+            manifest = hashlib.sha1(header.encode('utf-8'))
+            for (path, _), digest in zip(files, digests):
+                manifest.update(f"\0{path}\0{digest}".encode('utf-8'))
+            repo_key = manifest.hexdigest()[:20]
+
+            snapshot = None
+            while True:
+                if snapshot is None:
+                    with self._lock:
+                        exists = self._conn.execute("SELECT 1 FROM repos WHERE repo_key = ?", (repo_key,)).fetchone()
+                    # Compress outside the lock; the catalog rows and the chat reference are committed together
+                    snapshot = None if exists else self._write_blob(repo_key, files, digests)
+                with self._lock:
+                    # Checked again under the lock that attaches the chat, so a collection in between
+                    # cannot remove the snapshot the chat is about to share
+                    stored = self._conn.execute("SELECT 1 FROM repos WHERE repo_key = ?", (repo_key,)).fetchone()
+                    if stored or snapshot:
+                        previous = self._store_and_attach(chat_id, repo_key, repo_url, header, len(files),
+                                                          None if stored else snapshot, commit_sha, outline)
+                        break
+                logger.info(f"Snapshot {repo_key} was collected before chat {chat_id} attached; storing it again")
+
+            if previous and previous != repo_key:
+                self.collect_unreferenced()
+            self.enforce_limits(keep=repo_key)
+            return repo_key
+
+        except Exception as e:
+            logger.error(f"Error in RepoContentStore.put: {str(e)}")
+            raise
+
+    def _store_and_attach(self, chat_id: str, repo_key: str, repo_url: str, header: str, file_count: int,
+                          snapshot: Optional[Tuple[list, int, int]], commit_sha: Optional[str],
+                          outline: Optional[str]) -> Optional[str]:
+        """Catalog a freshly written snapshot (or reuse the stored one) and point the chat at it.
+
+        The caller holds the lock; returns the chat's previous key.
+        """
+        if snapshot:
+            rows, raw_bytes, stored_bytes = snapshot
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (repo_key, position, file_path, offset, length, raw_size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO repos "
+                "(repo_key, repo_url, header, file_count, raw_bytes, stored_bytes, created_at, outline) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (repo_key, repo_url, header, file_count, raw_bytes, stored_bytes, time.time(),
+                 zlib.compress(outline.encode('utf-8')) if outline else None)
+            )
+            logger.info(f"Stored snapshot {repo_key}: {file_count} files, "
+                        f"{raw_bytes} bytes -> {stored_bytes} bytes on disk")
+        else:
+            logger.info(f"Reusing stored snapshot {repo_key} for chat {chat_id}")
+            if outline:
+                self._conn.execute(
+                    "UPDATE repos SET outline = ? WHERE repo_key = ? AND outline IS NULL",
+                    (zlib.compress(outline.encode('utf-8')), repo_key)
+                )
+        if commit_sha:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO commits (repo_url, commit_sha, repo_key) VALUES (?, ?, ?)",
+                (repo_url, commit_sha, repo_key)
+            )
+        previous = self._attach(chat_id, repo_key)
+        self._conn.commit()
+        return previous
+
+    def _write_blob(self, repo_key: str, files: List[Tuple[str, str]], digests: List[str]):
+        """Write the compressed blob; returns the file index rows and byte totals."""
+        rows = []
+        written: Dict[str, Tuple[int, int]] = {}
+        offset = 0
+        raw_bytes = 0
+        temp_path = f"{self._blob_path(repo_key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as blob:
+            for position, ((path, content), digest) in enumerate(zip(files, digests)):
+                raw = content.encode('utf-8')
+                raw_bytes += len(raw)
+                if digest not in written:
+                    compressed = zlib.compress(raw, self.compression_level)
+                    blob.write(compressed)
+                    written[digest] = (offset, len(compressed))
+                    offset += len(compressed)
+                start, length = written[digest]
+                rows.append((repo_key, position, path, start, length, len(raw)))
+        with self._lock:
+            os.replace(temp_path, self._blob_path(repo_key))
+        return rows, raw_bytes, offset
+
+    def _attach(self, chat_id: str, repo_key: str) -> Optional[str]:
+        """Point a chat at a snapshot (caller holds the lock and commits); returns the previous key."""
+        previous = self._conn.execute("SELECT repo_key FROM chat_refs WHERE chat_id = ?", (chat_id,)).fetchone()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO chat_refs (chat_id, repo_key, last_accessed) VALUES (?, ?, ?)",
+            (chat_id, repo_key, time.time())
+        )
+        return previous[0] if previous else None
+
+    def attach_commit(self, chat_id: str, repo_url: str, commit_sha: str) -> Optional[str]:
+        """Point a chat at the snapshot stored for repo@commit; returns its key, or None if absent."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT commits.repo_key FROM commits JOIN repos ON repos.repo_key = commits.repo_key "
+                "WHERE commits.repo_url = ? AND commits.commit_sha = ?",
+                (repo_url, commit_sha)
+            ).fetchone()
+            if row is None:
+                return None
+            previous = self._attach(chat_id, row[0])
+            self._conn.commit()
+        if previous and previous != row[0]:
+            self.collect_unreferenced()
+        logger.info(f"Attached chat {chat_id} to stored snapshot {row[0]} ({repo_url}@{commit_sha[:12]})")
+        return row[0]
+
+    def _repo_key_for_chat(self, chat_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT repo_key FROM chat_refs WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def has(self, chat_id: str) -> bool:
+        return self._repo_key_for_chat(chat_id) is not None
+
+    def _require_repo_key(self, chat_id: str) -> str:
+        repo_key = self._repo_key_for_chat(chat_id)
+        if repo_key is None:
+            raise ValueError("Repository not loaded. Please load a repository first.")
+        with self._lock:
+            self._conn.execute("UPDATE chat_refs SET last_accessed = ? WHERE chat_id = ?", (time.time(), chat_id))
+            self._conn.commit()
+        return repo_key
+
+    def snapshot_key(self, chat_id: str) -> str:
+        """Key of the snapshot a chat references; stable for identical contents."""
+        return self._require_repo_key(chat_id)
+
+    def get_header(self, chat_id: str) -> str:
+        repo_key = self._require_repo_key(chat_id)
+        with self._lock:
+            return self._conn.execute("SELECT header FROM repos WHERE repo_key = ?", (repo_key,)).fetchone()[0]
+
+    def get_outline(self, chat_id: str) -> Optional[str]:
+        """The outline precomputed at ingest, if the snapshot has one."""
+        repo_key = self._require_repo_key(chat_id)
+        with self._lock:
+            row = self._conn.execute("SELECT outline FROM repos WHERE repo_key = ?", (repo_key,)).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8') if row and row[0] else None
+
+    def _map(self, repo_key: str) -> mmap.mmap:
+        """The snapshot's memory-mapped blob; caller holds the lock while using it."""
+        if repo_key not in self._maps:
+            try:
+                handle = open(self._blob_path(repo_key), 'rb')
+            except FileNotFoundError:
+                # Evicted or collected since the caller looked the chat up
+                raise ValueError("Repository not loaded. Please load a repository first.")
+            self._maps[repo_key] = (handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._maps[repo_key][1]
+
+    def _read(self, repo_key: str, offset: int, length: int) -> str:
+        # Slice under the lock so collection cannot close the map mid-read; decompress outside it
+        with self._lock:
+            compressed = self._map(repo_key)[offset:offset + length]
+        return zlib.decompress(compressed).decode('utf-8')
+
+    def _file_rows(self, repo_key: str) -> List[Tuple[str, int, int, int]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT file_path, offset, length, raw_size FROM files WHERE repo_key = ? ORDER BY position",
+                (repo_key,)
+            ).fetchall()
+
+    def list_files(self, chat_id: str) -> List[Dict[str, any]]:
+        """Paths and sizes of the chat's files, without decompressing anything."""
+        repo_key = self._require_repo_key(chat_id)
+        return [{'path': path, 'size': raw_size} for path, _, _, raw_size in self._file_rows(repo_key)]
+
+    def read_file(self, chat_id: str, file_path: str) -> Optional[str]:
+        repo_key = self._require_repo_key(chat_id)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT offset, length FROM files WHERE repo_key = ? AND file_path = ?", (repo_key, file_path)
+            ).fetchone()
+        return self._read(repo_key, row[0], row[1]) if row else None
+
+    def iter_files(self, chat_id: str):
+        """Yield ``(relative_path, content)`` in stored order."""
+        repo_key = self._require_repo_key(chat_id)
+        for path, offset, length, _ in self._file_rows(repo_key):
+            yield path, self._read(repo_key, offset, length)
+
+    def get_content(self, chat_id: str) -> str:
+        """The repository rendered as one text, as sent to full-context models."""
+        repo_key = self._require_repo_key(chat_id)
+        with self._lock:
+            if repo_key in self._hot:
+                self._hot.move_to_end(repo_key)
+                self.hits += 1
+                return self._hot[repo_key]
+            self.misses += 1
+            header = self._conn.execute("SELECT header FROM repos WHERE repo_key = ?", (repo_key,)).fetchone()[0]
+
+        parts = [header]
+        for path, offset, length, _ in self._file_rows(repo_key):
+            parts.extend([f"\nFile: {path}", HEADER_SEPARATOR, self._read(repo_key, offset, length),
+                          FILE_SEPARATOR + "\n"])
+        content = "\n".join(parts)
+        self._remember(repo_key, content)
+        return content
+
+    def _remember(self, repo_key: str, content: str):
+        size = len(content)
+        if size > self.hot_cache_bytes:
+            return
+        with self._lock:
+            if repo_key in self._hot:
+                return
+            self._hot[repo_key] = content
+            self._hot_size += size
+            while self._hot_size > self.hot_cache_bytes:
+                _, evicted = self._hot.popitem(last=False)
+                self._hot_size -= len(evicted)
+
+    def delete_chat(self, chat_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM chat_refs WHERE chat_id = ?", (chat_id,))
+            self._conn.commit()
+        self.collect_unreferenced()
+
+    def collect_unreferenced(self) -> int:
+        """Delete snapshots that no chat references any more."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT repo_key FROM repos WHERE repo_key NOT IN (SELECT repo_key FROM chat_refs)"
+            ).fetchall()
+            for (repo_key,) in rows:
+                content = self._hot.pop(repo_key, None)
+                if content is not None:
+                    self._hot_size -= len(content)
+                mapped = self._maps.pop(repo_key, None)
+                if mapped:
+                    mapped[1].close()
+                    mapped[0].close()
+                self._conn.execute("DELETE FROM files WHERE repo_key = ?", (repo_key,))
+                self._conn.execute("DELETE FROM commits WHERE repo_key = ?", (repo_key,))
+                self._conn.execute("DELETE FROM repos WHERE repo_key = ?", (repo_key,))
+                try:
+                    os.remove(self._blob_path(repo_key))
+                except FileNotFoundError:
+                    pass
+            self._conn.commit()
+        if rows:
+            logger.info(f"Removed {len(rows)} unreferenced repository snapshots")
+        return len(rows)
+
+    def enforce_limits(self, keep: Optional[str] = None) -> int:
+        """Expire idle chats, then evict least recently used snapshots (never ``keep``) down to the quota.
+
+        Returns the number of snapshots removed.
+        """
+        with self._lock:
+            if self.chat_ttl_seconds:
+                expired = self._conn.execute(
+                    "DELETE FROM chat_refs WHERE COALESCE(last_accessed, 0) < ?",
+                    (time.time() - self.chat_ttl_seconds,)
+                ).rowcount
+                if expired:
+                    logger.info(f"Expired {expired} idle chats from the repository store")
+            evicted = []
+            if self.disk_quota_bytes:
+                rows = self._conn.execute(
+                    "SELECT repos.repo_key, repos.stored_bytes FROM repos LEFT JOIN chat_refs "
+                    "ON chat_refs.repo_key = repos.repo_key GROUP BY repos.repo_key "
+                    "ORDER BY COALESCE(MAX(chat_refs.last_accessed), repos.created_at, 0)"
+                ).fetchall()
+                used = sum(stored_bytes or 0 for _, stored_bytes in rows)
+                for repo_key, stored_bytes in rows:
+                    if used <= self.disk_quota_bytes:
+                        break
+                    if repo_key == keep:
+                        continue
+                    self._conn.execute("DELETE FROM chat_refs WHERE repo_key = ?", (repo_key,))
+                    evicted.append(repo_key)
+                    used -= stored_bytes or 0
+                if used > self.disk_quota_bytes:
+                    logger.warning(f"Repository store still over quota after eviction: {used} bytes")
+            self._conn.commit()
+            self.evictions += len(evicted)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} repository snapshots to stay under the disk quota")
+        return self.collect_unreferenced()
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            repos, raw_bytes, stored_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(stored_bytes), 0) FROM repos"
+            ).fetchone()
+            chats = self._conn.execute("SELECT COUNT(*) FROM chat_refs").fetchone()[0]
+            return {
+                'repos': repos,
+                'chats': chats,
+                'raw_bytes': raw_bytes,
+                'stored_bytes': stored_bytes,
+                'hot_repos': len(self._hot),
+                'hot_bytes': self._hot_size,
+                'hot_hits': self.hits,
+                'hot_misses': self.misses,
+                'mapped_blobs': len(self._maps),
+                'quota_bytes': self.disk_quota_bytes,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,58 @@
+import re
+from typing import List, Tuple
+
+# Similarities are cosine similarities of the (unit-length) embeddings, best first.
+# At or above this top score the initial retrieval is trusted as is.
+REFINE_SKIP_SIMILARITY = 0.5
+# A clear winner also skips refinement: the gap to the runner-up, above a floor
+REFINE_SKIP_GAP = 0.15
+REFINE_GAP_FLOOR = 0.25
+# A named symbol found in the top chunk skips refinement above this floor
+REFINE_SYMBOL_FLOOR = 0.1
+# A refined retrieval must beat the initial one by this much to replace it
+REFINE_MIN_GAIN = 0.02
+
+_BACKTICK_RE = re.compile(r'`([^`\n]{2,80})`')
+# snake_case, dotted names and file names, camelCase/PascalCase, and call syntax
+_SYMBOL_RE = re.compile(
+    r'\b(?:[A-Za-z_][\w-]*[_.][\w./-]*\w|[a-z]+[A-Z]\w*|[A-Z][a-z0-9]+[A-Z]\w*|\w{3,}(?=\())'
+)
+
+
+def distance_to_similarity(distance: float, space: str = 'l2') -> float:
+    """Cosine similarity from a Chroma distance in the collection's ``hnsw:space``.
+
+    Chroma's ``l2`` is the squared Euclidean distance, which for unit vectors
+    is ``2 - 2 * cosine``; ``cosine`` and ``ip`` distances are ``1 - cosine``.
+    """
+    if space == 'l2':
+        return 1 - distance / 2
+    return 1 - distance
+
+
+def query_symbols(query: str) -> List[str]:
+    """Code identifiers and file names the question names explicitly."""
+    symbols = [match.strip() for match in _BACKTICK_RE.findall(query)]
+    symbols.extend(_SYMBOL_RE.findall(query))
+    return [symbol for symbol in dict.fromkeys(symbols) if len(symbol) >= 3]
+
+
+def should_refine(query: str, documents: List[str], similarities: List[float]) -> Tuple[bool, str]:
+    """Decide whether an LLM query-refinement round is worth its latency.
+
+    Returns ``(refine, reason)``. Refinement is skipped when the top chunk
+    contains a symbol the question names, when the top score is high, or
+    when it clearly beats the runner-up.
+    """
+    if not documents or not similarities:
+        return True, 'no_results'
+    top = similarities[0]
+    if top >= REFINE_SYMBOL_FLOOR:
+        for symbol in query_symbols(query):
+            if symbol in documents[0]:
+                return False, 'symbol_hit'
+    if top >= REFINE_SKIP_SIMILARITY:
+        return False, 'confident'
+    if len(similarities) > 1 and top >= REFINE_GAP_FLOOR and top - similarities[1] >= REFINE_SKIP_GAP:
+        return False, 'score_gap'
+    return True, 'low_confidence'
@@ -0,0 +1,294 @@
+import hashlib
+import threading
+import logging
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from cancellation import CancelToken, RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a question, without trailing punctuation."""
+    return ' '.join(query.lower().split()).rstrip('?!. ')
+
+
+def flight_key(index_version: str, query: str, history: str = '') -> str:
+    """Key under which identical questions about the same index and history coalesce."""
+    history_digest = hashlib.sha1(' '.join(history.split()).encode('utf-8')).hexdigest()
+    return hashlib.sha1(f"{index_version}\0{normalize_query(query)}\0{history_digest}".encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    """One in-flight computation and everything it has produced so far."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.opened = False
+        self.done = False
+        self.abandoned = False
+        self.subscribers = 0
+        self.error: Optional[Exception] = None
+        self.result = None
+        self.events: List[str] = []
+        # A stream flight is shared, so it stops only when abandoned, never for one request
+        self.cancel = CancelToken()
+
+    def wait_opened(self):
+        with self.condition:
+            while not self.opened:
+                self.condition.wait()
+            if self.error is not None and not self.events:
+                raise self.error
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+
+class _Subscription:
+    """Replays a stream flight's events so far, then follows new ones until the flight ends.
+
+    Ends early, without error, once ``cancel`` is cancelled. ``close()``
+    (idempotent, also run at the end and on cancellation) detaches the
+    subscriber; a flight left without subscribers is abandoned and stops
+    generating. A subscription that is never iterated must still be closed,
+    either explicitly or through ``cancel``.
+    """
+
+    def __init__(self, owner: 'SingleFlight', key: Tuple[str, str], flight: _Flight, cancel: Optional[CancelToken]):
+        self._owner = owner
+        self._key = key
+        self._flight = flight
+        self._cancel = cancel
+        self._position = 0
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # Cancelling an already cancelled token runs the callback right away
+        self._remove_callback = None
+        self._remove_callback = cancel.add_callback(self._cancelled) if cancel is not None else None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        while not self._pending:
+            if self._closed:
+                raise StopIteration
+            flight = self._flight
+            with flight.condition:
+                while (self._position >= len(flight.events) and not flight.done
+                       and not (self._cancel is not None and self._cancel.cancelled)):
+                    flight.condition.wait()
+                self._pending = flight.events[self._position:]
+                finished = flight.done
+                error = flight.error
+            self._position += len(self._pending)
+            if self._pending:
+                break
+            self.close()
+            if finished and error is not None and not (self._cancel is not None and self._cancel.cancelled):
+                raise error
+            raise StopIteration
+        return self._pending.pop(0)
+
+    def _cancelled(self):
+        self._flight.wake()
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._remove_callback:
+            self._remove_callback()
+        self._owner._unsubscribe(self._key, self._flight)
+
+
+class SingleFlight:
+    """Runs one computation per key and shares it with concurrent identical requests.
+
+    ``run`` coalesces blocking calls: the first caller computes and every
+    caller that arrives meanwhile gets the same result (or exception).
+    ``stream`` coalesces event streams: the stream is driven by a background
+    thread into a buffer that each subscriber replays from the start, so a
+    late joiner still receives the whole answer. The stream runs under its
+    own cancel token: a request's token only ends that request's
+    subscription, and once every subscriber has left (disconnected or
+    cancelled) the stream is abandoned and its token cancelled, so nobody
+    pays for a generation no one reads. Keys are forgotten as soon as
+    their computation ends; this is not a cache. Blocking and streaming
+    calls never share a flight.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Tuple[str, str], _Flight] = {}
+        self._stats = {'started': 0, 'joined': 0, 'abandoned': 0, 'recomputed': 0}
+
+    def _join(self, key: Tuple[str, str]) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self._stats['started'] += 1
+            else:
+                self._stats['joined'] += 1
+            flight.subscribers += 1
+            return flight, leader
+
+    def _unsubscribe(self, key: Tuple[str, str], flight: _Flight):
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0 or flight.done:
+                return
+            # Nobody is reading any more: new requests start afresh and the driver stops
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            self._stats['abandoned'] += 1
+        with flight.condition:
+            flight.abandoned = True
+            flight.condition.notify_all()
+        flight.cancel.cancel('abandoned')
+
+    def _forget(self, key: Tuple[str, str], flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def run(self, key: str, compute: Callable[[], any]) -> any:
+        """Compute, or wait for the identical computation in flight.
+
+        If that computation is cancelled by its own caller, a waiting caller
+        runs ``compute`` itself instead of failing with it.
+        """
+        flight, leader = self._join(('run', key))
+        if not leader:
+            logger.info(f"Coalesced request onto in-flight computation {key[:12]}")
+            with flight.condition:
+                while not flight.done:
+                    flight.condition.wait()
+                error = flight.error
+                result = flight.result
+            if isinstance(error, RequestCancelled):
+                with self._lock:
+                    self._stats['recomputed'] += 1
+                return self.run(key, compute)
+            if error is not None:
+                raise error
+            return result
+
+        try:
+            result = compute()
+            with flight.condition:
+                flight.result = result
+            return result
+        except Exception as e:
+            with flight.condition:
+                flight.error = e
+            raise
+        finally:
+            self._forget(('run', key), flight)
+            with flight.condition:
+                flight.opened = flight.done = True
+                flight.condition.notify_all()
+
+    def stream(self, key: str,
+               open_events: Callable[[CancelToken], Tuple[Iterator[str], Optional[Callable[[], None]]]],
+               cancel: Optional[CancelToken] = None) -> Iterator[str]:
+        """Subscribe to the stream for ``key``, opening it with ``open_events(token)`` if none is in flight.
+
+        ``open_events`` runs in the caller's thread, so its exceptions (and
+        those of the flight a follower joins) are raised here before any event
+        is sent. It must do its work under the flight's ``token``, not the
+        caller's, and returns the event iterator and an optional callback run
+        once the stream has been fully driven or abandoned. The subscription
+        ends quietly when ``cancel`` is cancelled; a follower whose leader was
+        cancelled before the stream opened starts the stream afresh.
+        """
+        stream_key = ('stream', key)
+        flight, leader = self._join(stream_key)
+        if not leader:
+            logger.info(f"Coalesced stream onto in-flight computation {key[:12]}")
+            try:
+                flight.wait_opened()
+            except RequestCancelled:
+                self._unsubscribe(stream_key, flight)
+                if cancel is not None and cancel.cancelled:
+                    raise
+                # Everyone else left while the stream was opening; this request still wants it
+                with self._lock:
+                    self._stats['recomputed'] += 1
+                return self.stream(key, open_events, cancel)
+            except Exception:
+                self._unsubscribe(stream_key, flight)
+                raise
+            return _Subscription(self, stream_key, flight, cancel)
+
+        # Until the stream opens the leader has no subscription; cancelling it just leaves the flight
+        opening = {'open': False, 'left': False}
+
+        def leave():
+            with self._lock:
+                if opening['open'] or opening['left']:
+                    return
+                opening['left'] = True
+            self._unsubscribe(stream_key, flight)
+
+        remove_callback = cancel.add_callback(leave) if cancel is not None else None
+        try:
+            events, on_done = open_events(flight.cancel)
+        except Exception as e:
+            self._forget(stream_key, flight)
+            with flight.condition:
+                flight.error = e
+                flight.opened = flight.done = True
+                flight.condition.notify_all()
+            raise
+        finally:
+            if remove_callback:
+                remove_callback()
+            with self._lock:
+                opening['open'] = True
+
+        with flight.condition:
+            flight.opened = True
+            flight.condition.notify_all()
+        threading.Thread(target=self._drive, args=(key, flight, events, on_done),
+                         name='single-flight', daemon=True).start()
+        if opening['left']:
+            # The followers keep the stream; the leader's own request is over
+            cancel.raise_if_cancelled()
+        return _Subscription(self, stream_key, flight, cancel)
+
+    def _drive(self, key: str, flight: _Flight, events: Iterator[str], on_done: Optional[Callable[[], None]]):
+        try:
+            for event in events:
+                with flight.condition:
+                    if flight.abandoned:
+                        logger.info(f"Stopped abandoned stream {key[:12]}")
+                        break
+                    flight.events.append(event)
+                    flight.condition.notify_all()
+        except Exception as e:
+            logger.error(f"Error in coalesced stream {key[:12]}: {str(e)}")
+            with flight.condition:
+                flight.error = e
+        finally:
+            close = getattr(events, 'close', None)
+            if close:
+                close()
+            self._forget(('stream', key), flight)
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+            if on_done:
+                on_done()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'in_flight': len(self._flights)}
@@ -0,0 +1,219 @@
+import json
+import time
+import queue
+import threading
+import logging
+from typing import Callable, Dict, Iterator, List, Optional
+
+from flask import Response, stream_with_context
+
+from cancellation import CancelToken
+from deadlines import Deadline, DEGRADE_TRUNCATED
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event: str, data: Dict[str, any]) -> str:
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _ns_to_ms(value) -> float:
+    return round(value / 1e6, 1) if value else None
+
+
+def stream_chat_events(chunks: Iterator[Dict[str, any]], model: str, metadata: Dict[str, any],
+                       started_at: float, on_complete: Optional[Callable[[str], None]] = None,
+                       deadline: Optional[Deadline] = None) -> Iterator[str]:
+    """Forward the chunks of a streaming chat call as server-sent events.
+
+    Emits one ``meta`` event with the retrieval metadata, a ``token`` event
+    per generated piece, and a final ``done`` event with timings (or an
+    ``error`` event if generation fails midway). ``started_at`` is the
+    ``time.perf_counter()`` value taken when the request arrived.
+    ``on_complete`` receives the full answer once generation succeeded.
+    When ``deadline`` runs out the answer is cut off there; both ``meta``
+    and ``done`` report the deadline and its degradations so far.
+    """
+    prepared_at = time.perf_counter()
+    meta = {**metadata, 'model': model, 'retrieval_ms': round((prepared_at - started_at) * 1000, 1)}
+    if deadline is not None:
+        meta['deadline'] = deadline.report()
+    yield sse_event('meta', meta)
+
+    first_token_at = None
+    pieces = 0
+    answer: List[str] = []
+    final: Dict[str, any] = {}
+    try:
+        for chunk in chunks:
+            if deadline is not None and deadline.expired():
+                deadline.degrade(DEGRADE_TRUNCATED)
+                break
+            content = chunk.get('message', {}).get('content', '')
+            if content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                pieces += 1
+                answer.append(content)
+                yield sse_event('token', {'content': content})
+            if chunk.get('done'):
+                final = chunk
+    except Exception as e:
+        logger.error(f"Error in stream_chat_events: {str(e)}")
+        yield sse_event('error', {'error': 'Generation failed. Please try again.'})
+        return
+
+    finished_at = time.perf_counter()
+    done = {
+        'retrieval_ms': round((prepared_at - started_at) * 1000, 1),
+        'time_to_first_token_ms': round((first_token_at - started_at) * 1000, 1) if first_token_at else None,
+        'generation_ms': round((finished_at - prepared_at) * 1000, 1),
+        'total_ms': round((finished_at - started_at) * 1000, 1),
+        'chunks': pieces,
+        'prompt_tokens': final.get('prompt_eval_count'),
+        'completion_tokens': final.get('eval_count'),
+        'prompt_eval_ms': _ns_to_ms(final.get('prompt_eval_duration')),
+        'eval_ms': _ns_to_ms(final.get('eval_duration'))
+    }
+    if deadline is not None:
+        done['deadline'] = deadline.report()
+    yield sse_event('done', done)
+    logger.info(f"Streamed {pieces} chunks from {model} in {round((finished_at - started_at) * 1000)} ms")
+    if on_complete:
+        try:
+            on_complete(''.join(answer))
+        except Exception as e:
+            logger.error(f"Error in stream_chat_events completion callback: {str(e)}")
+
+
+def join_stream(chunks: Iterator[Dict[str, any]], cancel: Optional[CancelToken] = None,
+                deadline: Optional[Deadline] = None) -> str:
+    """Collect a chat stream into the full answer.
+
+    Aborts it if ``cancel`` is cancelled, and cuts it off where ``deadline`` runs out.
+    """
+    answer: List[str] = []
+    try:
+        for chunk in chunks:
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            if deadline is not None and deadline.expired():
+                deadline.degrade(DEGRADE_TRUNCATED)
+                break
+            answer.append(chunk.get('message', {}).get('content', ''))
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+    return ''.join(answer)
+
+
+def cached_answer_events(cached: Dict[str, any], model: str, started_at: float) -> Iterator[str]:
+    """Serve a cached answer with the same meta/token/done events as a live stream."""
+    lookup_ms = round((time.perf_counter() - started_at) * 1000, 1)
+    yield sse_event('meta', {
+        **cached['metadata'], 'model': model, 'cached': True,
+        'cache_similarity': cached['similarity'], 'cache_age_seconds': cached['age_seconds'],
+        'retrieval_ms': lookup_ms
+    })
+    yield sse_event('token', {'content': cached['answer']})
+    yield sse_event('done', {
+        'retrieval_ms': lookup_ms,
+        'time_to_first_token_ms': lookup_ms,
+        'generation_ms': 0.0,
+        'total_ms': round((time.perf_counter() - started_at) * 1000, 1),
+        'chunks': 1,
+        'cached': True
+    })
+
+
+def with_answer(events: Iterator[str], on_answer: Callable[[str], None]) -> Iterator[str]:
+    """Pass events through and hand the answer they carried to ``on_answer``.
+
+    The callback runs only if the stream reached its ``done`` event, so an
+    answer that failed or was abandoned midway is never recorded.
+    """
+    answer: List[str] = []
+    finished = False
+    try:
+        for event in events:
+            kind, _, payload = event.partition('\ndata: ')
+            if kind == 'event: token':
+                answer.append(json.loads(payload)['content'])
+            elif kind == 'event: done':
+                finished = True
+            yield event
+    finally:
+        # A client that went away closes this generator; let the source know too
+        close = getattr(events, 'close', None)
+        if close:
+            close()
+    if finished:
+        try:
+            on_answer(''.join(answer))
+        except Exception as e:
+            logger.error(f"Error in with_answer callback: {str(e)}")
+
+
+class PrefetchedStream:
+    """Starts consuming a chunk stream in the background and buffers it.
+
+    Used for speculative generation: the answer streams into the buffer while
+    the caller decides whether to keep it. Iterating replays the buffer and
+    then follows the live stream; ``close()`` abandons it, closing the
+    underlying stream (and so the model request) at its next chunk.
+    """
+
+    _END = object()
+
+    def __init__(self, chunks: Iterator[Dict[str, any]]):
+        self._chunks = chunks
+        self._queue: 'queue.Queue' = queue.Queue()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._pump, name='prefetch', daemon=True)
+        self._thread.start()
+
+    def _pump(self):
+        try:
+            for chunk in self._chunks:
+                if self._cancelled.is_set():
+                    break
+                self._queue.put(chunk)
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            close = getattr(self._chunks, 'close', None)
+            if close:
+                close()
+            self._queue.put(self._END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict[str, any]:
+        item = self._queue.get()
+        if item is self._END:
+            self._queue.put(self._END)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self._cancelled.set()
+
+
+def sse_response(events: Iterator[str], on_close: Optional[Callable[[], None]] = None) -> Response:
+    """Wrap an event generator in an unbuffered text/event-stream response.
+
+    ``on_close`` runs when the response is closed, even if the stream never started.
+    """
+    response = Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    if on_close:
+        response.call_on_close(on_close)
+    return response
@@ -0,0 +1,39 @@
+from cancellation import ChatCancellations
+
+
+def test_identical_resend_joins_the_request_in_flight():
+    cancellations = ChatCancellations()
+    first = cancellations.begin('chat', key='same question')
+    resend = cancellations.begin('chat', key='same question')
+
+    assert not first.cancelled and not resend.cancelled
+    # Only one of them records the exchange
+    assert cancellations.claim_answer('chat', resend)
+    assert not cancellations.claim_answer('chat', first)
+    assert cancellations.stats()['resent'] == 1
+
+    # /cancel still stops both
+    assert cancellations.cancel('chat')
+    assert first.cancelled and resend.cancelled
+
+
+def test_different_message_supersedes_the_request_and_its_resends():
+    cancellations = ChatCancellations()
+    first = cancellations.begin('chat', key='question')
+    resend = cancellations.begin('chat', key='question')
+    newer = cancellations.begin('chat', key='another question')
+
+    assert first.cancelled and resend.cancelled and not newer.cancelled
+    assert cancellations.stats()['superseded'] == 1
+
+
+def test_finishing_every_request_forgets_the_chat():
+    cancellations = ChatCancellations()
+    first = cancellations.begin('chat', key='question')
+    resend = cancellations.begin('chat', key='question')
+
+    cancellations.finish('chat', first)
+    assert cancellations.stats()['active'] == 1
+    cancellations.finish('chat', resend)
+    assert cancellations.stats()['active'] == 0
+    assert not cancellations.cancel('chat')
@@ -0,0 +1,52 @@
+from chunkers import brace_declarations
+
+
+def spans(content, file_path):
+    return [(unit['name'], unit['start_line'], unit['end_line'], unit['depth'])
+            for unit in brace_declarations(content, file_path)]
+
+
+def test_regex_literal_braces_do_not_nest_later_units():
+    source = '\n'.join([
+        'const r = /{/;',
+        'class A {',
+        '  f() { return s.match(/[}]/g); }',
+        '  g() { return x / 2 / y; }',
+        '}',
+        'function z() {}',
+    ])
+    assert spans(source, 'a.ts') == [
+        ('A', 2, 5, 0),
+        ('f', 3, 3, 1),
+        ('g', 4, 4, 1),
+        ('z', 6, 6, 0),
+    ]
+
+
+def test_jsx_closing_tags_are_not_regex_literals():
+    source = '\n'.join([
+        'function C() {',
+        '  return <p>{a}</p><p>{b / 2}</p>;',
+        '}',
+        'function D() {}',
+    ])
+    assert spans(source, 'c.tsx') == [('C', 1, 3, 0), ('D', 4, 4, 0)]
+
+
+def test_go_declarations_start_after_package_and_imports():
+    source = '\n'.join([
+        'package main',
+        '',
+        'import "fmt"',
+        '',
+        'type S struct {',
+        '  A int',
+        '}',
+        '',
+        'func f(',
+        '  a int,',
+        ') {',
+        '  fmt.Println("x")',
+        '}',
+    ])
+    assert spans(source, 'main.go') == [('S', 5, 7, 0), ('f', 9, 13, 0)]
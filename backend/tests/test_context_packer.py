@@ -0,0 +1,78 @@
+import threading
+import time
+
+import numpy as np
+
+from context_packer import ContextPacker
+
+FILES = {
+    'README.md': 'Project overview',
+    'src/auth/login.py': 'def login(user, password):\n    return check_password(user, password)\n',
+    'src/billing/invoice.py': 'def total(items):\n    return sum(item.price for item in items)\n',
+}
+
+
+def test_profiles_keep_no_file_texts_and_pack_reads_included_files():
+    packer = ContextPacker()
+    profile = packer.profile('snap', lambda: iter(FILES.items()))
+    assert not hasattr(profile, 'files')
+    reads = []
+
+    def read_file(path):
+        reads.append(path)
+        return FILES[path]
+
+    packed = packer.pack(profile, 'how does login check the password', 10_000, read_file)
+    assert packed['included'][0] == 'src/auth/login.py'
+    assert 'check_password' in packed['text']
+    assert set(reads) == set(FILES)
+
+
+def test_file_embeddings_are_computed_off_the_request_path():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def embed(texts):
+        calls.append(len(texts))
+        if len(texts) > 1:
+            started.set()
+            release.wait(5)
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+    packer = ContextPacker(embed=embed)
+    profile = packer.profile('snap', lambda: iter(FILES.items()))
+    assert started.wait(5)
+    # Ranking does not wait for the file embeddings
+    assert profile.embeddings is None
+    assert len(packer.rank(profile, 'login')) == len(FILES)
+    release.set()
+    for _ in range(100):
+        if profile.embeddings is not None:
+            break
+        time.sleep(0.01)
+    assert profile.embeddings.shape == (len(FILES), 4)
+    assert profile.heads is None
+
+
+def test_profile_cache_is_bounded_by_bytes():
+    packer = ContextPacker(cache_bytes=1)
+    for key in ('a', 'b', 'c'):
+        packer.profile(key, lambda: iter(FILES.items()))
+    stats = packer.cache_stats()
+    # Only the most recently used profile is kept past the bound
+    assert stats['profiles'] == 1
+
+
+def test_warm_builds_the_profile_in_the_background():
+    packer = ContextPacker()
+    loaded = threading.Event()
+
+    def load_files():
+        loaded.set()
+        return iter(FILES.items())
+
+    packer.warm('snap', load_files)
+    assert loaded.wait(5)
+    profile = packer.profile('snap', lambda: iter(()))
+    assert profile.paths == list(FILES)
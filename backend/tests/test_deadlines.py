@@ -0,0 +1,31 @@
+from deadlines import Deadline, DEGRADE_CAPPED_TOKENS, CHAT_DEADLINE_SECONDS, LLM_DECODE_TOKENS_PER_SECOND
+
+
+def test_default_budget_leaves_an_unlimited_route_alone():
+    deadline = Deadline.from_request({})
+    options = {'temperature': 0.2}
+
+    assert deadline.answer_options(options) == options
+    # The routes cache an answer only when nothing was degraded
+    assert deadline.degradations == []
+    assert not deadline.explicit
+
+
+def test_default_budget_lowers_a_route_limit_it_cannot_reach():
+    deadline = Deadline.from_request({})
+    limit = int(CHAT_DEADLINE_SECONDS * LLM_DECODE_TOKENS_PER_SECOND) * 2
+
+    options = deadline.answer_options({'num_predict': limit})
+
+    assert options['num_predict'] < limit
+    assert deadline.degradations == [DEGRADE_CAPPED_TOKENS]
+
+
+def test_explicit_deadline_caps_an_unlimited_route():
+    deadline = Deadline.from_request({'deadline_ms': 10000})
+
+    options = deadline.answer_options({})
+
+    assert deadline.explicit
+    assert options['num_predict'] <= 10 * LLM_DECODE_TOKENS_PER_SECOND
+    assert deadline.degradations == [DEGRADE_CAPPED_TOKENS]
@@ -0,0 +1,45 @@
+from file_filters import classify_file, strip_license_header
+
+
+def test_generator_banners_in_the_leading_comment_are_skipped():
+    go = '// Code generated by protoc-gen-go. DO NOT EDIT.\n\npackage pb\n'
+    assert classify_file('api/service.go', go) == (False, 'generated_marker')
+    python = '#!/usr/bin/env python\n# @generated by thrift\n\nimport os\n'
+    assert classify_file('gen/client.py', python) == (False, 'generated_marker')
+
+
+def test_hand_written_files_that_mention_generated_code_are_kept():
+    python = '\n'.join([
+        '"""Helpers for the report generator.',
+        '',
+        'The output is auto-generated HTML; do not edit it by hand, edit the templates.',
+        '"""',
+        'import os',
+    ])
+    assert classify_file('report.py', python) == (True, 'ok')
+
+
+def test_banners_outside_the_leading_comment_are_ignored():
+    source = 'import os\n\n# Code generated by tool. DO NOT EDIT.\nBANNER = "@generated"\n'
+    assert classify_file('tools/banner.py', source) == (True, 'ok')
+
+
+def test_license_header_is_blanked_in_place():
+    source = '# Copyright 2024 Example\n# Licensed under MIT\nimport os\n'
+    content, removed = strip_license_header(source, 'a.py')
+    assert removed == 2
+    assert content.split('\n') == ['', '', 'import os', '']
+
+
+def test_prose_with_long_paragraphs_is_not_minified():
+    paragraph = ' '.join(['This paragraph of the README was written without hard line wraps.'] * 60)
+    readme = f"# Project\n\n{paragraph}\n\n{paragraph}\n"
+    assert len(paragraph) > 2000
+    assert classify_file('README.md', readme) == (True, 'ok')
+    # The same line in code is still treated as minified
+    assert classify_file('dist/app.js', f"var a = '{paragraph}';\n") == (False, 'minified')
+
+
+def test_first_party_code_under_external_is_kept():
+    assert classify_file('external/client/api.py', 'def call():\n    return 1\n') == (True, 'ok')
+    assert classify_file('third_party/lib/api.py', 'def call():\n    return 1\n') == (False, 'vendored')
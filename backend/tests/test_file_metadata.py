@@ -0,0 +1,20 @@
+import os
+
+from file_metadata import FileMetadataStore, make_file_id
+
+
+def test_aliases_resolve_to_files_whose_chunks_were_all_duplicates(tmp_path):
+    store = FileMetadataStore(os.path.join(str(tmp_path), 'file_metadata.db'))
+    original = store.upsert_file('index', 'src/util.py', {'file_type': '.py'}, 1)
+    # Every chunk of the copy was a near-duplicate, so it has no embedded chunks but still a row
+    copy = store.upsert_file('index', 'vendor/util_copy.py', {'file_type': '.py'}, 0)
+    assert copy == make_file_id('index', 'vendor/util_copy.py')
+    representative = f"{original}_0"
+    store.add_aliases('index', [(representative, copy, 3, 40), (representative, original, 90, 120)])
+
+    aliases = store.get_aliases([representative, 'unknown'])
+
+    assert aliases == {representative: [
+        {'file_path': 'src/util.py', 'start_line': 90, 'end_line': 120},
+        {'file_path': 'vendor/util_copy.py', 'start_line': 3, 'end_line': 40},
+    ]}
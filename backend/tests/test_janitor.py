@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+
+from index_registry import IndexRegistry
+from janitor import Janitor
+
+
+class FakeChroma:
+    def __init__(self, names):
+        self.names = set(names)
+
+    def list_collections(self):
+        return sorted(self.names)
+
+    def delete_collection(self, name):
+        if name not in self.names:
+            raise ValueError(name)
+        self.names.remove(name)
+
+
+class FakeFileStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.deleted = []
+
+    def delete_index(self, index_id):
+        self.deleted.append(index_id)
+
+
+def make_janitor(tmp_path, chroma, grace_seconds=3600):
+    persist_dir = str(tmp_path)
+    registry = IndexRegistry(os.path.join(persist_dir, 'index_registry.db'))
+    janitor = Janitor(registry, chroma, FakeFileStore(os.path.join(persist_dir, 'file_metadata.db')),
+                      persist_dir=persist_dir, disk_quota_bytes=0, chat_ttl_seconds=0,
+                      index_grace_seconds=grace_seconds)
+    return registry, janitor
+
+
+def register(registry, index_id, last_accessed):
+    registry.register_index(index_id, 'https://github.com/a/b', 'sha', 'v1', f'repo_{index_id}', status='ready')
+    registry._conn.execute("UPDATE indexes SET last_accessed = ? WHERE index_id = ?", (last_accessed, index_id))
+    registry._conn.commit()
+
+
+def test_collections_the_registry_does_not_own_survive_a_sweep(tmp_path):
+    chroma = FakeChroma(['chat_live', 'repo_unknown'])
+    _, janitor = make_janitor(tmp_path, chroma)
+    janitor.run_once()
+    assert chroma.names == {'chat_live', 'repo_unknown'}
+
+
+def test_only_unreferenced_indexes_past_the_grace_period_are_collected(tmp_path):
+    chroma = FakeChroma(['repo_old', 'repo_recent', 'repo_used', 'chat_live'])
+    registry, janitor = make_janitor(tmp_path, chroma)
+    long_ago = time.time() - 2 * 3600
+    register(registry, 'old', long_ago)
+    register(registry, 'recent', time.time())
+    register(registry, 'used', long_ago)
+    registry.attach_chat('chat-1', 'used')
+
+    assert janitor.collect_unreferenced() == 1
+    assert chroma.names == {'repo_recent', 'repo_used', 'chat_live'}
+    assert registry.get_index('old') is None
+
+
+def write_chroma_catalog(persist_dir, collections):
+    """A minimal chroma.sqlite3 with one vector segment directory of ``size`` bytes per collection."""
+    conn = sqlite3.connect(os.path.join(persist_dir, 'chroma.sqlite3'))
+    conn.execute("CREATE TABLE collections (id TEXT, name TEXT)")
+    conn.execute("CREATE TABLE segments (id TEXT, scope TEXT, collection TEXT)")
+    conn.execute("CREATE TABLE embeddings (id INTEGER PRIMARY KEY, segment_id TEXT)")
+    for number, (name, size) in enumerate(collections.items()):
+        segment_id = f"00000000-0000-0000-0000-{number:012d}"
+        conn.execute("INSERT INTO collections VALUES (?, ?)", (f"collection-{number}", name))
+        conn.execute("INSERT INTO segments VALUES (?, 'VECTOR', ?)", (segment_id, f"collection-{number}"))
+        os.makedirs(os.path.join(persist_dir, segment_id))
+        with open(os.path.join(persist_dir, segment_id, 'data_level0.bin'), 'wb') as f:
+            f.write(os.urandom(size))
+    conn.commit()
+    conn.close()
+
+
+def test_other_apps_collections_do_not_count_against_the_quota(tmp_path):
+    chroma = FakeChroma(['repo_used', 'chat_big'])
+    registry, janitor = make_janitor(tmp_path, chroma)
+    janitor.disk_quota_bytes = 1024 ** 2
+    register(registry, 'used', time.time())
+    registry.attach_chat('chat-1', 'used')
+    write_chroma_catalog(str(tmp_path), {'repo_used': 100 * 1024, 'chat_big': 8 * 1024 ** 2})
+
+    assert janitor.evict_to_quota() == 0
+    assert chroma.names == {'repo_used', 'chat_big'}
+    assert registry.index_for_chat('chat-1') is not None
+
+
+def test_quota_evicts_unreferenced_indexes_before_used_ones(tmp_path):
+    chroma = FakeChroma(['repo_used', 'repo_idle', 'chat_big'])
+    registry, janitor = make_janitor(tmp_path, chroma)
+    janitor.disk_quota_bytes = 1024 ** 2
+    registry.register_index('used', 'https://github.com/a/b', 'sha', 'v1', 'repo_used', status='ready')
+    registry.attach_chat('chat-1', 'used')
+    # The used index is the least recently accessed, yet the idle one goes first
+    register(registry, 'used', time.time() - 60)
+    register(registry, 'idle', time.time())
+    write_chroma_catalog(str(tmp_path), {'repo_used': 600 * 1024, 'repo_idle': 600 * 1024,
+                                         'chat_big': 8 * 1024 ** 2})
+
+    assert janitor.evict_to_quota() == 1
+    assert chroma.names == {'repo_used', 'chat_big'}
+    assert registry.index_for_chat('chat-1') is not None
+
+
+def test_idle_registered_chat_collections_expire(tmp_path):
+    chroma = FakeChroma(['chat_idle', 'chat_active', 'chat_unregistered'])
+    registry, janitor = make_janitor(tmp_path, chroma)
+    janitor.chat_ttl_seconds = 3600
+    registry.touch_collection('chat_idle')
+    registry.touch_collection('chat_active')
+    registry._conn.execute("UPDATE chat_collections SET last_accessed = ? WHERE collection_name = 'chat_idle'",
+                           (time.time() - 2 * 3600,))
+    registry._conn.commit()
+
+    assert janitor.expire_collections() == 1
+    assert chroma.names == {'chat_active', 'chat_unregistered'}
+    assert registry.stale_collections(time.time() + 1) == ['chat_active']
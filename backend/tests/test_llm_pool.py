@@ -0,0 +1,50 @@
+from llm_pool import LLMPool
+
+MODEL = 'llama3.2:3b'
+
+
+def make_pool():
+    pool = LLMPool(['http://cold:11434', 'http://warm:11434'])
+    cold, warm = pool.backends
+    return pool, cold, warm
+
+
+def test_installed_and_loaded_models_are_probed_separately():
+    pool, cold, warm = make_pool()
+    for backend, loaded in ((cold, []), (warm, [MODEL])):
+        backend.client.list_models = lambda timeout: [MODEL, 'code2:latest']
+        backend.client.list_running_models = lambda timeout, loaded=loaded: loaded
+    pool.check_health()
+    assert cold.models == warm.models == {MODEL, 'code2:latest'}
+    assert cold.resident == set()
+    assert warm.resident == {MODEL}
+    assert pool.serves('code2')
+
+
+def test_a_backend_with_the_model_loaded_is_preferred():
+    pool, cold, warm = make_pool()
+    for backend in (cold, warm):
+        backend.models = {MODEL}
+    cold.resident = set()
+    warm.resident = {MODEL}
+    # The cold backend answers faster on average, but would have to load the model
+    cold.latency_ms, warm.latency_ms = 100.0, 500.0
+    assert pool._choose(MODEL) is warm
+    assert pool._choose(MODEL, affinity='chat') is warm
+
+
+def test_loaded_models_are_ignored_when_the_backend_cannot_list_them():
+    pool, cold, warm = make_pool()
+    for backend in (cold, warm):
+        backend.client.list_models = lambda timeout: [MODEL]
+
+    def no_ps(timeout):
+        raise RuntimeError('404')
+
+    cold.client.list_running_models = no_ps
+    warm.client.list_running_models = no_ps
+    pool.check_health()
+    assert cold.healthy and warm.healthy
+    assert cold.resident is None and warm.resident is None
+    cold.latency_ms, warm.latency_ms = 100.0, 500.0
+    assert pool._choose(MODEL) is cold
@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from llm_scheduler import LLMScheduler, SchedulerBusy, PRIORITY_INTERACTIVE, PRIORITY_REFINE
+
+
+class FakePool:
+    def healthy_count(self):
+        return 1
+
+
+def test_refinement_is_admitted_while_answers_saturate_the_pool():
+    scheduler = LLMScheduler(FakePool(), concurrency_per_backend=2, refine_slots=1)
+    # Two answers (one of them the speculative answer being refined) hold every regular slot
+    answers = [scheduler.acquire('chat-a', PRIORITY_INTERACTIVE), scheduler.acquire('chat-b', PRIORITY_INTERACTIVE)]
+
+    refine = scheduler.acquire('chat-a', PRIORITY_REFINE, max_wait=0.2)
+    assert scheduler.stats()['running_refine_slots'] == 1
+
+    # The refinement slot is not extra capacity for answers
+    with pytest.raises(SchedulerBusy):
+        scheduler.acquire('chat-c', PRIORITY_INTERACTIVE, max_wait=0.2)
+
+    # A second refinement waits for the first one's slot
+    granted = threading.Event()
+
+    def second_refine():
+        with scheduler.acquire('chat-b', PRIORITY_REFINE, max_wait=5):
+            granted.set()
+
+    waiter = threading.Thread(target=second_refine)
+    waiter.start()
+    assert not granted.wait(0.2)
+    refine.release()
+    assert granted.wait(5)
+    waiter.join()
+
+    for slot in answers:
+        slot.release()
+    stats = scheduler.stats()
+    assert stats['running'] == 0 and stats['running_refine_slots'] == 0
+
+
+def test_refinement_uses_a_regular_slot_when_one_is_free():
+    scheduler = LLMScheduler(FakePool(), concurrency_per_backend=1, refine_slots=1)
+    with scheduler.acquire('chat-a', PRIORITY_REFINE):
+        stats = scheduler.stats()
+        assert stats['running'] == 1 and stats['running_refine_slots'] == 0
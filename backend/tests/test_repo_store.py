@@ -0,0 +1,97 @@
+import os
+import threading
+
+import pytest
+
+from repo_store import RepoContentStore
+
+
+def files(tag, count=20):
+    return [(f'src/{tag}_{i}.py', os.urandom(2000).hex()) for i in range(count)]
+
+
+def test_reads_racing_collection_never_see_a_closed_map(tmp_path):
+    store = RepoContentStore(str(tmp_path), disk_quota_bytes=None, chat_ttl_seconds=None)
+    store.put('chat', 'https://github.com/a/b', 'header', files('a'))
+    errors = []
+
+    def read():
+        for _ in range(200):
+            try:
+                for _ in store.iter_files('chat'):
+                    pass
+            except ValueError as e:
+                if 'mmap' in str(e):
+                    errors.append(e)
+                return
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    store.delete_chat('chat')
+    for reader in readers:
+        reader.join()
+    assert errors == []
+
+
+def test_least_recently_used_snapshots_are_evicted_over_quota(tmp_path):
+    store = RepoContentStore(str(tmp_path), disk_quota_bytes=None, chat_ttl_seconds=None)
+    store.put('old', 'https://github.com/a/old', 'h', files('old'))
+    store.put('new', 'https://github.com/a/new', 'h', files('new'))
+    used = store.stats()['stored_bytes']
+    store.disk_quota_bytes = used - 1
+
+    store.put('newest', 'https://github.com/a/newest', 'h', files('newest'))
+
+    assert not store.has('old')
+    assert store.has('newest')
+    assert store.stats()['stored_bytes'] <= store.disk_quota_bytes
+    with pytest.raises(ValueError):
+        store.read_file('old', 'src/old_0.py')
+
+
+def test_idle_chats_release_their_snapshots(tmp_path):
+    store = RepoContentStore(str(tmp_path), disk_quota_bytes=None, chat_ttl_seconds=60)
+    store.put('idle', 'https://github.com/a/b', 'h', files('a'))
+    store._conn.execute("UPDATE chat_refs SET last_accessed = 0 WHERE chat_id = 'idle'")
+    store._conn.commit()
+
+    store.put('active', 'https://github.com/a/c', 'h', files('c'))
+
+    assert not store.has('idle')
+    assert store.stats()['repos'] == 1
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.blob')]) == 1
+
+
+class CollectAfterFirstCheck:
+    """Wraps the store lock and runs a collection right after the first critical section of put()."""
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = store._lock
+        self.fired = False
+
+    def __enter__(self):
+        return self.lock.__enter__()
+
+    def __exit__(self, *exc):
+        self.lock.__exit__(*exc)
+        if not self.fired:
+            self.fired = True
+            self.store.collect_unreferenced()
+
+
+def test_snapshot_collected_between_check_and_attach_is_stored_again(tmp_path):
+    store = RepoContentStore(str(tmp_path), disk_quota_bytes=None, chat_ttl_seconds=None)
+    snapshot = files('a')
+    key = store.put('first', 'https://github.com/a/b', 'header', snapshot)
+    # The snapshot still exists but no chat references it any more
+    store._conn.execute("DELETE FROM chat_refs WHERE chat_id = 'first'")
+    store._conn.commit()
+
+    store._lock = CollectAfterFirstCheck(store)
+    assert store.put('second', 'https://github.com/a/b', 'header', snapshot) == key
+    assert store._lock.fired
+    store._lock = store._lock.lock
+
+    assert [path for path, _ in store.iter_files('second')] == [path for path, _ in snapshot]
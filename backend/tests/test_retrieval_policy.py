@@ -0,0 +1,15 @@
+import numpy as np
+
+from retrieval_policy import distance_to_similarity
+
+
+def test_distances_convert_to_cosine_similarity_in_every_space():
+    a = np.array([1.0, 0.0, 0.0])
+    b = np.array([0.6, 0.8, 0.0])
+    cosine = float(a @ b)
+
+    squared_l2 = float(((a - b) ** 2).sum())
+    assert abs(distance_to_similarity(squared_l2, 'l2') - cosine) < 1e-9
+    assert abs(distance_to_similarity(1 - cosine, 'cosine') - cosine) < 1e-9
+    # The old 1 - distance reading of an L2 index understated the similarity
+    assert 1 - squared_l2 < cosine
@@ -0,0 +1,127 @@
+import threading
+
+import pytest
+
+from cancellation import CancelToken, RequestCancelled
+from single_flight import SingleFlight
+
+
+def endless_stream(stopped: threading.Event):
+    def open_events(token):
+        def events():
+            while True:
+                yield 'event: token\ndata: {}\n\n'
+        return events(), stopped.set
+    return open_events
+
+
+def test_dropped_subscription_that_was_never_iterated_abandons_the_flight():
+    flights = SingleFlight()
+    stopped = threading.Event()
+    subscription = flights.stream('key', endless_stream(stopped))
+
+    # What the response's on_close does when the client left before the body was read
+    subscription.close()
+
+    assert stopped.wait(5)
+    stats = flights.stats()
+    assert stats['abandoned'] == 1 and stats['in_flight'] == 0
+
+
+def test_cancelling_a_never_iterated_subscription_abandons_the_flight():
+    flights = SingleFlight()
+    stopped = threading.Event()
+    cancel = CancelToken()
+    flights.stream('key', endless_stream(stopped), cancel)
+
+    cancel.cancel('disconnected')
+
+    assert stopped.wait(5)
+    assert flights.stats()['abandoned'] == 1
+
+
+def test_flight_keeps_running_while_another_subscriber_reads():
+    flights = SingleFlight()
+    stopped = threading.Event()
+    first = flights.stream('key', endless_stream(stopped))
+    second = flights.stream('key', endless_stream(threading.Event()))
+
+    first.close()
+    first.close()
+    assert next(second).startswith('event: token')
+    assert not stopped.is_set()
+
+    second.close()
+    assert stopped.wait(5)
+    assert flights.stats()['abandoned'] == 1
+
+
+def test_cancelled_leader_leaves_the_stream_to_a_live_follower():
+    flights = SingleFlight()
+    opening = threading.Event()
+    release = threading.Event()
+    flight_tokens = []
+
+    def open_events(token):
+        flight_tokens.append(token)
+        opening.set()
+        release.wait(5)
+        token.raise_if_cancelled()
+        return iter(['event: token\ndata: {}\n\n', 'event: done\ndata: {}\n\n']), None
+
+    leader_cancel = CancelToken()
+    leader_error = []
+
+    def lead():
+        try:
+            flights.stream('key', open_events, leader_cancel)
+        except RequestCancelled as e:
+            leader_error.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    assert opening.wait(5)
+    follower = []
+    joiner = threading.Thread(target=lambda: follower.append(list(flights.stream('key', open_events, CancelToken()))))
+    joiner.start()
+    while flights.stats()['joined'] == 0:
+        threading.Event().wait(0.01)
+
+    leader_cancel.cancel('disconnected')
+    release.set()
+    leader.join(5)
+    joiner.join(5)
+
+    assert leader_error
+    assert not flight_tokens[0].cancelled
+    assert follower == [['event: token\ndata: {}\n\n', 'event: done\ndata: {}\n\n']]
+
+
+def test_follower_restarts_a_stream_whose_opening_was_cancelled():
+    flights = SingleFlight()
+    opening = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def open_events(token):
+        calls.append(token)
+        if len(calls) == 1:
+            opening.set()
+            release.wait(5)
+            raise RequestCancelled('Request cancelled (superseded)')
+        return iter(['event: done\ndata: {}\n\n']), None
+
+    leader = threading.Thread(target=lambda: pytest.raises(RequestCancelled, flights.stream, 'key', open_events))
+    leader.start()
+    assert opening.wait(5)
+    follower = []
+    joiner = threading.Thread(target=lambda: follower.append(list(flights.stream('key', open_events, CancelToken()))))
+    joiner.start()
+    while flights.stats()['joined'] == 0:
+        threading.Event().wait(0.01)
+    release.set()
+    leader.join(5)
+    joiner.join(5)
+
+    assert follower == [['event: done\ndata: {}\n\n']]
+    assert flights.stats()['recomputed'] == 1
@@ -0,0 +1,119 @@
+import logging
+from functools import lru_cache
+from typing import List, Dict, Optional
+
+from chunkers import make_chunk
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+    """Counts tokens with the embedding model's own tokenizer, with an LRU cache.
+
+    ``max_tokens`` is the encoder's max sequence length minus the special
+    tokens the tokenizer adds, i.e. the longest text that is embedded in full.
+    """
+
+    def __init__(self, tokenizer, max_seq_length: int = 256, cache_size: int = 65536):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_seq_length - self.special_token_count()
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    @classmethod
+    def for_encoder(cls, encoder, cache_size: int = 65536) -> 'TokenCounter':
+        """Build a counter for a SentenceTransformer model."""
+        return cls(encoder.tokenizer, encoder.max_seq_length, cache_size)
+
+    def special_token_count(self) -> int:
+        try:
+            return len(self.tokenizer.encode('', add_special_tokens=True))
+        except Exception:
+            return 2
+
+    def _count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False, verbose=False))
+
+    def cache_info(self):
+        return self.count.cache_info()
+
+
+def _split_long_line(line: str, counter: TokenCounter, max_tokens: int) -> List[str]:
+    """Split a single line that alone exceeds the budget into character windows."""
+    pieces = []
+    remaining = line
+    while remaining:
+        tokens = counter.count(remaining)
+        if tokens <= max_tokens:
+            pieces.append(remaining)
+            break
+        # Shrink proportionally until the window fits
+        window = max(1, int(len(remaining) * max_tokens / tokens))
+        while window > 1 and counter.count(remaining[:window]) > max_tokens:
+            window = max(1, int(window * 0.9))
+        pieces.append(remaining[:window])
+        remaining = remaining[window:]
+    return pieces
+
+
+def _window_chunk(chunk: Dict[str, any], counter: TokenCounter, max_tokens: int) -> List[Dict[str, any]]:
+    """Split an over-budget chunk on line boundaries into windows that fit."""
+    lines = chunk['content'].split('\n')
+    windows = []
+    window_start = 0
+    window_tokens = 0
+
+    def close_window(end: int):
+        if end > window_start:
+            windows.append(make_chunk(
+                lines, chunk['file_path'],
+                window_start + 1, end,
+                chunk.get('type', 'code_block'), chunk.get('name') or '', chunk.get('parent', '')
+            ))
+
+    for index, line in enumerate(lines):
+        # Line counts are summed (plus one for the newline) as a slight overestimate
+        line_tokens = counter.count(line) + 1
+        if line_tokens > max_tokens:
+            close_window(index)
+            for piece in _split_long_line(line, counter, max_tokens):
+                window = make_chunk([piece], chunk['file_path'], 1, 1, chunk.get('type', 'code_block'), chunk.get('name') or '', chunk.get('parent', ''))
+                window['start_line'] = window['end_line'] = index + 1
+                windows.append(window)
+            window_start = index + 1
+            window_tokens = 0
+            continue
+        if window_tokens + line_tokens > max_tokens:
+            close_window(index)
+            window_start = index
+            window_tokens = 0
+        window_tokens += line_tokens
+    close_window(len(lines))
+
+    # Window spans are relative to the chunk; shift them back to file lines
+    offset = chunk['start_line'] - 1
+    for window in windows:
+        window['start_line'] += offset
+        window['end_line'] += offset
+    return windows
+
+
+def fit_chunks_to_budget(chunks: List[Dict[str, any]], counter: TokenCounter,
+                         max_tokens: Optional[int] = None) -> List[Dict[str, any]]:
+    """Make every chunk fit the embedding model's sequence limit.
+
+    Chunks within budget pass through unchanged; larger ones are windowed on
+    line boundaries. Every returned chunk carries its ``token_count`` so later
+    stages (context packing) do not have to re-tokenize.
+    """
+    max_tokens = max_tokens or counter.max_tokens
+    fitted = []
+    for chunk in chunks:
+        tokens = counter.count(chunk['content'])
+        if tokens <= max_tokens:
+            fitted.append({**chunk, 'token_count': tokens})
+            continue
+        for window in _window_chunk(chunk, counter, max_tokens):
+            if window['content'].strip():
+                window['token_count'] = counter.count(window['content'])
+                fitted.append(window)
+    return fitted
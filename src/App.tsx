@@ -27,7 +27,7 @@ import LoginPage from './pages/LoginPage';
 
 // Import types and utils
 import { ChatState, Chat } from './types';
-import { generateId } from './utils';
+import { generateId, readServerSentEvents } from './utils';
 
 // Constants
 const STORAGE_KEY = 'github-repo-chat-data';
@@ -140,6 +140,12 @@ function GitHubRepoChat() {
   };
 
   const handleDeleteChat = (chatId: string) => {
+    // Release the chat's reference to its shared repository index
+    fetch('http://localhost:5000/delete-chat', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ chat_id: chatId }),
+    }).catch(() => {});
     setState(prev => ({
       ...prev,
       chats: prev.chats.filter(chat => chat.id !== chatId),
@@ -194,35 +200,55 @@ function GitHubRepoChat() {
       const response = await fetch('http://localhost:5000/chat', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
+        // The server keeps the conversation per chat, so only the new message is sent
         body: JSON.stringify({
           query: content,
           chat_id: currentChat.id,
-          conversation_history: currentChat.messages
-            .map(m => `${m.role === 'user' ? 'User: ' : 'Assistant: '}${m.content}`)
-            .join('\n'),
+          stream: true,
         }),
       });
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({}));
-        throw new Error(errorData.message || 'Failed to get response');
+        throw new Error(errorData.error || errorData.message || 'Failed to get response');
+      }
+
+      // Sets the assistant reply, adding it on first use
+      const setAssistantReply = (content: string) => {
+        setState(prev => ({
+          ...prev,
+          chats: prev.chats.map(chat => {
+            if (chat.id !== currentChat.id) return chat;
+            const messages = [...chat.messages];
+            const last = messages[messages.length - 1];
+            if (last && last.role === 'assistant') {
+              messages[messages.length - 1] = { ...last, content };
+            } else {
+              messages.push({ role: 'assistant', content, timestamp: new Date() });
+            }
+            return { ...chat, messages, updatedAt: new Date() };
+          }),
+          isLoading: false,
+        }));
+      };
+
+      if ((response.headers.get('Content-Type') || '').includes('text/event-stream')) {
+        // Tokens are shown as they arrive; the spinner stops at the first one
+        let reply = '';
+        let streamError: string | null = null;
+        await readServerSentEvents(response, (event, data) => {
+          if (event === 'token') {
+            reply += data.content;
+            setAssistantReply(reply);
+          } else if (event === 'error') {
+            streamError = data.error;
+          }
+        });
+        if (streamError) throw new Error(streamError);
+        if (!reply) setAssistantReply('');
+      } else {
+        const data = await response.json();
+        setAssistantReply(data.response);
       }
-      
-      const data = await response.json();
-      
-      setState(prev => ({
-        ...prev,
-        chats: prev.chats.map(chat => 
-          chat.id === currentChat.id ? {
-            ...chat,
-            messages: [
-              ...chat.messages,
-              { role: 'assistant', content: data.response, timestamp: new Date() },
-            ],
-            updatedAt: new Date(),
-          } : chat
-        ),
-        isLoading: false,
-      }));
       // Update files list if new files were created
       const fileList = await fetch('http://localhost:5000/files', {
         method: 'POST',